@@ -1,301 +1,1542 @@
+import asyncio
+import hmac
 import os
 import json
-import csv  # <-- NEW: Import CSV module
-import google.generativeai as genai
-import markdown2
-from flask import Flask, request, jsonify, render_template
+import time
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, has_request_context, g, abort
 from flask_cors import CORS
 from dotenv import load_dotenv
 import prompts  # Import your prompts file
+from data_store import DataStore
+from profile_store import CSV_COLUMNS, ProfileStore
+from cache import LRUCache, content_hash
+from recipe_parser import RecipeSectionStreamer, render_cache, render_markdown, render_recipe
+from recipe_validator import validate_recipe
+from recipe_index import RecipeIndex, request_constraints
+from speculative import SpeculativePrefetcher
+from single_flight import SingleFlight
+from model_backend import create_backend, parse_agent_settings
+from resilience import AgentCaller, CircuitBreaker, CircuitOpenError, RetryBudget, start_budget
+from prompt_context import compact_context
+from local_briefing import synthesize_briefing
+from cooking_sessions import SessionStore
+from json_repair import extract_json
+from trace_store import TraceStore
+from request_log import RequestLog, note_agent_call, start_request
+from http_cache import COMPRESSIBLE_TYPES, CachedBody, StaticAssets, compress, negotiate_encoding
+from pipeline import NEXT_CHUNK, AgentCall, Blocking
+import pipeline
+import meal_plan
+import metrics
 
 # --- Configuration ---
 load_dotenv()
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)  # static/ is served by static_file() below
+static_assets = StaticAssets(os.path.join(app.root_path, "static"))
 CORS(app)
 
-# --- Gemini API Setup ---
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    raise ValueError("GEMINI_API_KEY not found. Please set it in the .env file.")
+# --- Model Backend ---
+# Every agent call goes through this backend. MODEL_BACKEND=gemini (default) uses
+# the Gemini API, with each agent's client built on its first call (GEMINI_MODEL,
+# AGENT_MODELS etc.); MODEL_BACKEND=fake uses a deterministic offline stand-in.
+backend = create_backend()
 
-genai.configure(api_key=api_key)
 
-# --- MODEL UPDATES ---
-agent_1_model = genai.GenerativeModel('gemini-2.5-flash') # Strategist
-agent_2_model = genai.GenerativeModel('gemini-2.5-flash') # Chef (Options)
-agent_3_model = genai.GenerativeModel('gemini-2.5-flash') # Chef (Full Recipe)
-agent_5_model = genai.GenerativeModel('gemini-2.5-flash') # The Judge
-agent_6_model = genai.GenerativeModel('gemini-2.5-flash') # Technique Coach
-agent_7_model = genai.GenerativeModel('gemini-2.5-flash') # Chatbot
+def record_agent_call(agent, prompt, response, seconds, first_chunk_seconds=None):
+    """Records an agent call in the metrics and in the current request's log entry."""
+    metrics.record_agent_call(agent, prompt, response, seconds, first_chunk_seconds)
+    note_agent_call(agent, prompt, response, seconds)
 
 
-# --- Helper function (MODIFIED) ---
-def read_file_content(filename):
+# --- Agent Call Guards ---
+# Every model call gets a deadline: its agent's timeout (AGENT_TIMEOUT_SECONDS, or
+# per agent in AGENT_TIMEOUTS, e.g. "agent_3=60,agent_5=45"), cut to what is left
+# of the request's REQUEST_BUDGET_SECONDS. Rate-limit and transient errors are
+# retried with jittered backoff (at most AGENT_MAX_ATTEMPTS attempts, and retries
+# at most AGENT_RETRY_BUDGET of all calls). AGENT_HEDGING=1 sends a duplicate of
+# a call still running after its agent's p95 latency. After
+# CIRCUIT_FAILURE_THRESHOLD failures in a row, calls fail fast for CIRCUIT_RESET_SECONDS.
+AGENT_TIMEOUT_SECONDS = float(os.getenv("AGENT_TIMEOUT_SECONDS", "90"))
+REQUEST_BUDGET_SECONDS = float(os.getenv("REQUEST_BUDGET_SECONDS", "0"))  # 0 = no budget
+agent_caller = AgentCaller(
+    lambda: backend,
+    timeout=AGENT_TIMEOUT_SECONDS,
+    agent_timeouts=parse_agent_settings(os.getenv("AGENT_TIMEOUTS", ""), float),
+    max_attempts=int(os.getenv("AGENT_MAX_ATTEMPTS", "3")),
+    retry_budget=RetryBudget(ratio=float(os.getenv("AGENT_RETRY_BUDGET", "0.2"))),
+    hedge=os.getenv("AGENT_HEDGING", "0") == "1",
+    hedge_min_seconds=float(os.getenv("AGENT_HEDGE_MIN_MS", "1000")) / 1000,
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+        reset_seconds=float(os.getenv("CIRCUIT_RESET_SECONDS", "30")),
+    ),
+    max_workers=int(os.getenv("AGENT_CALL_WORKERS", "64")),
+)
+metrics.register_agent_caller(agent_caller)
+
+
+def agent_error_status(e):
+    """HTTP status for an error from an agent call: 503 while the circuit is open, 504 on a timeout."""
+    if isinstance(e, CircuitOpenError):
+        return 503
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return 504
+    return 500
+
+
+def error_payload(e, where):
+    """(status, JSON payload) for an error in a route's pipeline."""
+    print(f"An error occurred in {where}: {e}")
+    message = str(e)
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)) and not message:
+        # A waiter on an identical call in flight that gave up (asgi.py)
+        message = f"The AI took longer than {AGENT_TIMEOUT_SECONDS:g}s to respond. Please try again."
+    return agent_error_status(e), {"error": message}
+
+
+# --- Single-Flight Agent Calls ---
+# Identical agent calls (same agent and prompt) that overlap in time share one
+# model call: later callers wait for the first one's text or error, for at most
+# SINGLE_FLIGHT_WAIT_SECONDS. SINGLE_FLIGHT=0 turns this off.
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "120"))
+agent_flights = SingleFlight(name="agent_calls")
+metrics.register_single_flight(agent_flights)
+
+
+def agent_call_key(agent, prompt):
+    return content_hash(agent, prompt)
+
+
+def _generate(agent, prompt):
+    started = time.perf_counter()
+    try:
+        response = agent_caller.call(agent, prompt)
+    except Exception:
+        record_agent_call(agent, prompt, None, time.perf_counter() - started)
+        raise
+    record_agent_call(agent, prompt, response, time.perf_counter() - started)
+    return response
+
+
+def _stream(agent, prompt):
+    started = time.perf_counter()
+    first_chunk_seconds = None
+    parts = []
+    try:
+        for chunk in agent_caller.stream(agent, prompt):
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.perf_counter() - started
+            parts.append(chunk)
+            yield chunk
+    except Exception:
+        record_agent_call(agent, prompt, None, time.perf_counter() - started, first_chunk_seconds)
+        raise
+    record_agent_call(agent, prompt, "".join(parts), time.perf_counter() - started, first_chunk_seconds)
+
+
+def call_agent(agent, prompt):
+    """Calls one agent (e.g. "agent_1") and returns its response text."""
+    if not SINGLE_FLIGHT:
+        return _generate(agent, prompt)
+    started = time.perf_counter()
+    response, shared = agent_flights.call(
+        agent_call_key(agent, prompt), lambda: _generate(agent, prompt), SINGLE_FLIGHT_WAIT_SECONDS)
+    if shared:
+        note_agent_call(agent, prompt, response, time.perf_counter() - started, shared=True)
+    return response
+
+
+def stream_agent(agent, prompt):
+    """Yields the response text of an agent call chunk by chunk, as it is generated."""
+    if not SINGLE_FLIGHT:
+        yield from _stream(agent, prompt)
+        return
+    started = time.perf_counter()
+    chunks, shared = agent_flights.stream(
+        agent_call_key(agent, prompt), lambda: _stream(agent, prompt), SINGLE_FLIGHT_WAIT_SECONDS)
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    if shared:
+        note_agent_call(agent, prompt, "".join(parts), time.perf_counter() - started, shared=True)
+
+
+# --- Route Pipelines ---
+# Each agent route's pipeline is a generator of steps (see pipeline.py), run here
+# with blocking agent calls and by asgi.py with awaitable ones.
+def run_steps(steps):
+    return pipeline.run(steps, call_agent, stream_agent)
+
+
+def json_result(result):
+    status, payload = result
+    return jsonify(payload), status
+
+# --- User Data Store ---
+# The CSVs are read once and kept in memory (raw text for the AI, parsed rows
+# for the frontend). They are only re-read when a file's mtime/size changes.
+DATA_FILES = {
+    "ingredients": "ingredients.csv",
+    "calendar": "calendar.csv",
+    "ruleset": "ruleset.csv",
+}
+data_store = DataStore(DATA_FILES)
+
+# --- Multi-User Profile Store (opt-in) ---
+# With PROFILE_DB set, each user's data lives in SQLite (profile_store.py) and a
+# request picks the user with "user_id" (in the JSON body, or the query string
+# for GETs). The agents then get targeted queries instead of whole files. On the
+# first start the CSV files above are imported as PROFILE_DEFAULT_USER, which is
+# also used when no user_id is sent. Without PROFILE_DB, the CSVs are the only profile.
+PROFILE_DB = os.getenv("PROFILE_DB", "")
+DEFAULT_USER_ID = os.getenv("PROFILE_DEFAULT_USER", "default")
+profile_store = None
+if PROFILE_DB:
+    profile_store = ProfileStore(PROFILE_DB, pantry_limit=int(os.getenv("PROFILE_PANTRY_LIMIT", "40")))
+    if not profile_store.has_user(DEFAULT_USER_ID):
+        counts = profile_store.import_files(DEFAULT_USER_ID, DATA_FILES)
+        print(f"--- Imported the CSV files as user '{DEFAULT_USER_ID}': {counts} ---")
+
+UNKNOWN_USER = {"error": "Unknown user.", "unknown_user": True}
+
+# Exporting or replacing a user's data (GET/PUT /api/users/<user_id>/data/<file>.csv)
+# needs "Authorization: Bearer <PROFILE_ADMIN_TOKEN>". Without a token, both are disabled.
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+
+
+def is_profile_admin(authorization):
+    if not PROFILE_ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest((authorization or "").encode("utf-8"), f"Bearer {PROFILE_ADMIN_TOKEN}".encode("utf-8"))
+
+
+def load_snapshot(user_id=None):
+    """Returns the data snapshot for a user, or None if there is no such user."""
+    if profile_store is None:
+        return data_store.snapshot()
+    return profile_store.snapshot(user_id or DEFAULT_USER_ID)
+
+
+def snapshot_steps(user_id=None):
+    """load_snapshot() as a pipeline step; only the SQLite queries (PROFILE_DB) are blocking."""
+    if profile_store is None:
+        return data_store.snapshot()
+    return (yield Blocking(load_snapshot, user_id))
+
+# --- Agent 1 Briefing Cache ---
+# Agent 1's briefing only depends on its filled prompt (the three CSVs, meal type
+# and user input), so it is cached under a hash of that prompt.
+# Set BRIEFING_CACHE_DIR to keep the briefings on disk across restarts.
+briefing_cache = LRUCache(
+    maxsize=int(os.getenv("BRIEFING_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("BRIEFING_CACHE_TTL", "86400")),
+    disk_dir=os.getenv("BRIEFING_CACHE_DIR") or None,
+    name="briefing_cache",
+)
+metrics.register_cache(briefing_cache)
+
+# --- Briefing Store ---
+# Every briefing is also kept under an ID (its content hash), which is returned
+# to the client. If Agent 2 fails, the client retries with {"briefing_id": ...}
+# and the pipeline resumes at Agent 2 without calling Agent 1 again.
+briefing_store = LRUCache(
+    maxsize=int(os.getenv("BRIEFING_STORE_SIZE", "1024")),
+    ttl=float(os.getenv("BRIEFING_CACHE_TTL", "86400")),
+    disk_dir=os.path.join(os.getenv("BRIEFING_CACHE_DIR"), "by_id") if os.getenv("BRIEFING_CACHE_DIR") else None,
+    name="briefing_store",
+)
+metrics.register_cache(briefing_store)
+metrics.register_cache(render_cache)
+
+
+def save_briefing(user_profile_briefing):
+    """Stores a briefing and returns its ID."""
+    briefing_id = content_hash(user_profile_briefing)[:32]
+    briefing_store.set(briefing_id, user_profile_briefing)
+    return briefing_id
+
+# --- Agent Traces ---
+# Responses don't embed the full prompts: each request's agent logs are kept
+# server-side under the response's "trace_id" and fetched from /api/traces/<id>.
+# Send {"debug": true} (or ?debug=1), or set DEBUG_AGENT_LOGS=1, to get them inline.
+DEBUG_AGENT_LOGS = os.getenv("DEBUG_AGENT_LOGS", "0") == "1"
+trace_store = TraceStore(
+    max_bytes=int(os.getenv("TRACE_STORE_MAX_BYTES", str(32 * 1024 * 1024))),
+    max_traces=int(os.getenv("TRACE_STORE_MAX_TRACES", "10000")),
+    ttl=float(os.getenv("TRACE_STORE_TTL", "3600")),
+)
+metrics.register_cache(trace_store)
+
+
+def wants_debug(data):
+    """True if the agent logs should be sent inline with the response."""
+    if DEBUG_AGENT_LOGS or (data or {}).get("debug"):
+        return True
+    return has_request_context() and request.args.get("debug") == "1"
+
+
+def attach_trace(payload, debug):
     """
-    Safely reads the content of a file.
-    If it's a CSV, it returns it as a list of dictionaries.
-    Otherwise, returns as plain text.
+    Moves the payload's "agent_logs" into the trace store and adds "trace_id".
+    Returns a new payload; the logs stay inline only if `debug` is set.
     """
-    if not os.path.exists(filename):
-        return [] if filename.endswith('.csv') else ""
-        
-    try:
-        with open(filename, mode='r', encoding='utf-8') as f:
-            if filename.endswith('.csv'):
-                # Use DictReader to read CSV into a list of dictionaries
-                reader = csv.DictReader(f)
-                return [row for row in reader]
-            else:
-                return f.read()
-    except Exception as e:
-        print(f"Error reading file {filename}: {e}")
-        return [] if filename.endswith('.csv') else f"[Error reading file: {e}]"
+    agent_logs = payload.get("agent_logs", [])
+    payload = {key: value for key, value in payload.items() if key != "agent_logs"}
+    payload["trace_id"] = trace_store.save(agent_logs)
+    if debug:
+        payload["agent_logs"] = agent_logs
+    return payload
+
+
+# --- Prompt Compaction ---
+# By default the prompts get a compact version of the CSVs (today's calendar row,
+# active rules, ranked pantry) instead of the raw files. PROMPT_COMPACTION=0 disables it.
+PROMPT_COMPACTION = os.getenv("PROMPT_COMPACTION", "1") == "1"
+
+
+def prompt_context(snapshot):
+    """The CSV texts to paste into the prompts: compacted, or the raw files."""
+    return compact_context(snapshot) if PROMPT_COMPACTION else snapshot.texts
+
+
+def report_prompt_compaction(agent, prompt, snapshot, context, names):
+    """Records how many bytes compaction saved on one prompt."""
+    if context is snapshot.texts:
+        return
+    compact_bytes = len(prompt.encode("utf-8"))
+    raw_bytes = compact_bytes + sum(
+        len(snapshot.texts[name].encode("utf-8")) - len(context[name].encode("utf-8")) for name in names
+    )
+    metrics.PROMPT_BYTES.inc(raw_bytes, agent=agent, stage="raw")
+    metrics.PROMPT_BYTES.inc(compact_bytes, agent=agent, stage="compact")
+    saved = (raw_bytes - compact_bytes) / raw_bytes if raw_bytes else 0
+    print(f"--- Prompt compaction ({agent}): {raw_bytes} -> {compact_bytes} bytes (-{saved:.0%}) ---")
+
+
+# --- Local Briefing (opt-in) ---
+# With LOCAL_BRIEFING=1 the briefing is built from the CSVs by local rules instead
+# of calling Agent 1. Free-text input that the rules don't understand still goes
+# to the model.
+LOCAL_BRIEFING = os.getenv("LOCAL_BRIEFING", "0") == "1"
+
+
+def local_briefing_log(snapshot, meal_type, user_input):
+    """Returns the agent log entry of a locally built briefing, or None if Agent 1 is needed."""
+    if not LOCAL_BRIEFING:
+        return None
+    started = time.perf_counter()
+    briefing = synthesize_briefing(snapshot, meal_type, user_input)
+    if briefing is None:
+        print("--- Local briefing: user input needs the model, falling back to Agent 1 ---")
+        return None
+    metrics.BRIEFING_SOURCE.inc(source="local")
+    print(f"--- Local briefing built in {(time.perf_counter() - started) * 1000:.1f} ms (Agent 1 skipped) ---")
+    return {
+        "agent": "Agent 1 (Local Briefing)",
+        "input": f"Meal Type: {meal_type}\nUser Input: {user_input}",
+        "output": briefing
+    }
+
+
+# --- Local Recipe Validator ---
+# Agent 3's recipe is checked locally (structure, hard rules, today's time limit)
+# before Agent 5. The Judge only runs if something fails, and then gets the list
+# of violations to fix. RECIPE_VALIDATOR=0 always runs the Judge, as before.
+RECIPE_VALIDATOR = os.getenv("RECIPE_VALIDATOR", "1") == "1"
+
+
+def run_recipe_validator(recipe_details_markdown, snapshot):
+    """
+    Returns (violations, agent log entry). `violations` is empty if Agent 5 can
+    be skipped, and (None, None) is returned if the validator is disabled.
+    """
+    if not RECIPE_VALIDATOR:
+        return None, None
+    result = validate_recipe(recipe_details_markdown, snapshot)
+    verdict = "fail" if result.violations else "pass"
+    metrics.RECIPE_VALIDATIONS.inc(verdict=verdict)
+    if result.violations:
+        print(f"--- Recipe Validator: {len(result.violations)} violations, sending them to Agent 5 ---")
+        output = "FAIL: Agent 5 will fix:\n" + "\n".join(f"- {violation}" for violation in result.violations)
+    else:
+        print("--- Recipe Validator: PASS, skipping Agent 5 ---")
+        output = "PASS: Agent 5 skipped."
+    return result.violations, {
+        "agent": "Recipe Validator",
+        "input": "Checked: " + "; ".join(result.checks),
+        "output": output
+    }
+
+
+# --- Near-Duplicate Recipe Index (opt-in) ---
+# With RECIPE_INDEX=1 every finished recipe is indexed by its title and main
+# ingredients. A later request for a dish that is similar enough (e.g. the same
+# words in another order) gets the stored recipe instead of Agents 3 + 5, if it
+# also fits the request's hard rules and time limit.
+RECIPE_INDEX = os.getenv("RECIPE_INDEX", "0") == "1"
+recipe_index = RecipeIndex(
+    maxsize=int(os.getenv("RECIPE_INDEX_SIZE", "500")),
+    ttl=float(os.getenv("RECIPE_INDEX_TTL", "604800")),
+    threshold=float(os.getenv("RECIPE_INDEX_THRESHOLD", "0.85")),
+)
+metrics.register_cache(recipe_index)
+
+
+def main_ingredients_of(data):
+    """The "main_ingredients" of the selected option, as sent by the page (optional)."""
+    ingredients = (data or {}).get("main_ingredients")
+    if not isinstance(ingredients, list):
+        return []
+    return [str(ingredient) for ingredient in ingredients if ingredient][:10]
+
+
+def find_indexed_recipe(user_profile, selected_dish_name, main_ingredients, snapshot):
+    """Returns the response payload of a stored near-duplicate recipe, or None."""
+    if not RECIPE_INDEX:
+        return None
+    found = recipe_index.find(selected_dish_name, main_ingredients, request_constraints(snapshot, user_profile))
+    if found is None:
+        return None
+    recipe_markdown, similarity, stored_title = found
+    print(f"--- Recipe Index: serving '{stored_title}' for '{selected_dish_name}' (similarity {similarity:.2f}) ---")
+    return build_recipe_payload(selected_dish_name, recipe_markdown, [{
+        "agent": "Recipe Index",
+        "input": f"Request for: {selected_dish_name}",
+        "output": f"Served the stored recipe for '{stored_title}' (similarity {similarity:.2f}); Agents 3 and 5 skipped."
+    }])
+
+
+def index_recipe(user_profile, selected_dish_name, main_ingredients, judged_recipe_markdown):
+    if RECIPE_INDEX:
+        recipe_index.add(selected_dish_name, main_ingredients, judged_recipe_markdown, user_profile)
+
+
+# --- Agent Pipeline Helpers (shared by the Flask routes and the async server in asgi.py) ---
+def build_agent_1_prompt(snapshot, meal_type, user_input):
+    context = prompt_context(snapshot)
+    agent_1_prompt = prompts.AGENT_1_PROMPT_TEMPLATE.replace("{{INGREDIENTS_CSV}}", context["ingredients"])
+    agent_1_prompt = agent_1_prompt.replace("{{CALENDAR_CSV}}", context["calendar"])
+    agent_1_prompt = agent_1_prompt.replace("{{RULESET_CSV}}", context["ruleset"])
+    agent_1_prompt = agent_1_prompt.replace("{{MEAL_TYPE}}", meal_type)
+    agent_1_prompt = agent_1_prompt.replace("{{USER_INPUT}}", user_input)
+    report_prompt_compaction("agent_1", agent_1_prompt, snapshot, context, ["ingredients", "calendar", "ruleset"])
+    return agent_1_prompt
+
+
+def build_agent_2_prompt(user_profile_briefing, snapshot):
+    context = prompt_context(snapshot)
+    agent_2_prompt = prompts.AGENT_2_PROMPT_TEMPLATE.replace("{{USER_PROFILE_BRIEFING}}", user_profile_briefing)
+    agent_2_prompt = agent_2_prompt.replace("{{INGREDIENTS_CSV}}", context["ingredients"])
+    report_prompt_compaction("agent_2", agent_2_prompt, snapshot, context, ["ingredients"])
+    return agent_2_prompt
+
+
+# Max Agent 2 calls per request; after the first, the briefing is reused and only Agent 2 is retried
+AGENT_2_MAX_ATTEMPTS = int(os.getenv("AGENT_2_MAX_ATTEMPTS", "2"))
+
+
+def build_agent_2_retry_prompt(agent_2_prompt, error):
+    return agent_2_prompt + prompts.AGENT_2_RETRY_TEMPLATE.replace("{{ERROR}}", str(error))
+
+
+def parse_recipe_options(response_text):
+    """
+    Parses Agent 2's JSON array of options, repairing near-JSON. Raises
+    ValueError (json.JSONDecodeError if it is not JSON at all) if no usable
+    options can be recovered.
+    """
+    options = extract_json(response_text)
+    if isinstance(options, dict):
+        # e.g. {"recipes": [...]}: use the first list inside the object
+        options = next((value for value in options.values() if isinstance(value, list)), options)
+    if not isinstance(options, list):
+        raise ValueError(f"expected a JSON array of options, got {type(options).__name__}")
+    options = [option for option in options if isinstance(option, dict) and option.get("title")]
+    if not options:
+        raise ValueError("the JSON array contains no options with a title")
+    return options
+
+
+def build_agent_3_prompt(user_profile, selected_dish_name, snapshot):
+    context = prompt_context(snapshot)
+    agent_3_prompt = prompts.AGENT_3_PROMPT_TEMPLATE.replace("{{USER_PROFILE_BRIEFING}}", user_profile)
+    agent_3_prompt = agent_3_prompt.replace("{{INGREDIENTS_CSV}}", context["ingredients"])
+    agent_3_prompt = agent_3_prompt.replace("{{SELECTED_DISH_NAME}}", selected_dish_name)
+    report_prompt_compaction("agent_3", agent_3_prompt, snapshot, context, ["ingredients"])
+    return agent_3_prompt
+
+
+def build_agent_5_prompt(recipe_details_markdown, violations=None):
+    validation_issues = ""
+    if violations:
+        validation_issues = prompts.AGENT_5_VALIDATION_ISSUES_TEMPLATE.replace(
+            "{{VIOLATIONS}}", "\n".join(f"- {violation}" for violation in violations))
+    agent_5_prompt = prompts.AGENT_5_PROMPT_TEMPLATE.replace("{{VALIDATION_ISSUES}}", validation_issues)
+    return agent_5_prompt.replace("{{RECIPE_MARKDOWN}}", recipe_details_markdown)
+
+
+def build_recipe_payload(selected_dish_name, judged_recipe_markdown, agent_logs):
+    """
+    Adds the hero image and renders the judged markdown into the final response
+    payload: the full HTML, the HTML of each table ("sections") and the parsed
+    recipe ("recipe": ingredients, ordered steps, nutrition).
+    """
+    # --- Static Image Selection ---
+    hero_image_url = static_assets.url("default_food.png")
+    print(f"--- Using static image: {hero_image_url} ---")
+    
+    agent_logs.append({
+        "agent": "Agent 4 (Image Placeholder)",
+        "input": f"Request for: {selected_dish_name}",
+        "output": f"Serving static image: {hero_image_url}"
+    })
+
+    # --- Format Output (parsed and rendered once per recipe text) ---
+    rendered = render_recipe(judged_recipe_markdown)
+    
+    return {
+        "hero_image_url": hero_image_url,
+        "recipe_html": rendered["html"],
+        "sections": rendered["sections"],
+        "recipe": rendered["recipe"],
+        "agent_logs": agent_logs 
+    }
+
+
+def build_agent_6_prompt(recipe_context, instruction):
+    agent_6_prompt = prompts.AGENT_6_PROMPT_TEMPLATE.replace("{{FULL_RECIPE_CONTEXT}}", recipe_context)
+    agent_6_prompt = agent_6_prompt.replace("{{INSTRUCTION_TEXT}}", instruction)
+    return agent_6_prompt
+
+
+def normalize_instruction(instruction):
+    """Lower-cased instruction text with collapsed whitespace and no trailing punctuation."""
+    return " ".join(str(instruction).lower().split()).rstrip(".!;: ")
+
+
+def explanation_key(recipe_context, instruction):
+    """Key of an Agent 6 explanation: (recipe hash, normalized instruction)."""
+    return content_hash(content_hash(recipe_context), normalize_instruction(instruction))
+
+
+def build_agent_6_batch_prompt(recipe_context, steps):
+    steps_json = json.dumps([{"step": step["step"], "instruction": step["instruction"]} for step in steps], indent=2)
+    agent_6_prompt = prompts.AGENT_6_BATCH_PROMPT_TEMPLATE.replace("{{FULL_RECIPE_CONTEXT}}", recipe_context)
+    agent_6_prompt = agent_6_prompt.replace("{{STEPS_JSON}}", steps_json)
+    return agent_6_prompt
+
+
+def parse_step_explanations(response_text):
+    """
+    Parses Agent 6's batch JSON array into {step: explanation}. Raises
+    ValueError (json.JSONDecodeError if it is not JSON at all) if there is no array.
+    """
+    items = extract_json(response_text)
+    if isinstance(items, dict):
+        # e.g. {"explanations": [...]}: use the first list inside the object
+        items = next((value for value in items.values() if isinstance(value, list)), items)
+    if not isinstance(items, list):
+        raise ValueError(f"expected a JSON array of explanations, got {type(items).__name__}")
+    return {
+        str(item["step"]): item["explanation"]
+        for item in items
+        if isinstance(item, dict) and item.get("step") is not None and item.get("explanation")
+    }
+
+
+def build_agent_7_prompt(recipe_context, current_step, chat_history, summary=""):
+    # --- Format the chat history for the AI ---
+    lines = []
+    if summary:
+        lines.append(f"(Summary of the earlier conversation)\n{summary}\n(Most recent messages)")
+    for message in chat_history:
+        if message['role'] == 'user':
+            lines.append(f"User: {message['content']}")
+        else:
+            lines.append(f"Bot: {message['content']}")
+    formatted_history = "\n".join(lines) + "\n" if lines else ""
+
+    agent_7_prompt = prompts.AGENT_7_PROMPT_TEMPLATE.replace("{{FULL_RECIPE_CONTEXT}}", recipe_context)
+    agent_7_prompt = agent_7_prompt.replace("{{CURRENT_STEP}}", str(current_step))
+    agent_7_prompt = agent_7_prompt.replace("{{CHAT_HISTORY}}", formatted_history)
+    return agent_7_prompt
+
+
+def sse_event(event, data):
+    """Formats one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# --- Response Compression ---
+# JSON and text responses of at least GZIP_MIN_BYTES are compressed with brotli
+# (if the optional `brotli` package is installed) or gzip, as the client accepts.
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+
+
+@app.after_request
+def compress_response(response):
+    if (response.mimetype not in COMPRESSIBLE_TYPES or response.direct_passthrough
+            or "Content-Encoding" in response.headers):
+        return response
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# --- Conditional Responses ---
+# Bodies that only change with a file on disk (the page, static files, the CSV
+# data) are encoded once and served with ETag / Last-Modified, so a client that
+# already has them gets an empty 304.
+def cached_response(cached, cache_control):
+    """Serves a CachedBody in the client's preferred encoding, or 304 if the client's copy is current."""
+    body, encoding = cached.encoded(negotiate_encoding(request.headers.get("Accept-Encoding")))
+    response = Response(body, mimetype=cached.mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if cached.compressible:
+        response.vary.add("Accept-Encoding")
+    response.set_etag(cached.etag_for(encoding))
+    if cached.last_modified:
+        response.last_modified = cached.last_modified
+    response.headers["Cache-Control"] = cache_control
+    return response.make_conditional(request)
+
+
+@app.context_processor
+def static_asset_urls():
+    # {{ asset_url('script.js') }} -> /static/script.js?v=<content hash>
+    return {"asset_url": static_assets.url}
+
+
+# A user's data as JSON, built once per version of it
+all_data_cache = LRUCache(maxsize=256, name="all_data_json")
+metrics.register_cache(all_data_cache)
+
+
+def all_data_body(user_id=None):
+    """The /api/get-all-data body for a user, or None if there is no such user."""
+    if profile_store is None:
+        snapshot = data_store.snapshot()
+        key = repr(snapshot.version)
+        mtimes = [stat_key[0] for _, stat_key in snapshot.version if stat_key]
+        last_modified = max(mtimes) / 1e9 if mtimes else None
+        load_rows = lambda: snapshot.rows
+    else:
+        user_id = user_id or DEFAULT_USER_ID
+        version = profile_store.version(user_id)
+        if version is None:
+            return None
+        key = repr(("profile", user_id, version[0]))
+        last_modified = version[1]
+        load_rows = lambda: profile_store.export_rows(user_id)[0]
+
+    cached = all_data_cache.get(key)
+    if cached is None:
+        rows = load_rows()
+        body = json.dumps({
+            "ingredients": rows["ingredients"],
+            "calendar": rows["calendar"],
+            "ruleset": rows["ruleset"]
+        }).encode("utf-8")
+        cached = CachedBody(body, "application/json", last_modified=last_modified)
+        all_data_cache.set(key, cached)
+    return cached
+
+
+# --- Request Log ---
+# Every /api/ request is appended to REQUEST_LOG_PATH as one JSON line (request
+# body, status, timing, and each agent call with its prompt and output) by a
+# background writer thread; replay.py re-drives the recorded traffic.
+# Set REQUEST_LOG_PATH to an empty string to turn it off.
+REQUEST_LOG_PATH = os.getenv("REQUEST_LOG_PATH", os.path.join("logs", "requests.jsonl"))
+request_log = None
+if REQUEST_LOG_PATH:
+    request_log = RequestLog(
+        REQUEST_LOG_PATH,
+        max_bytes=int(os.getenv("REQUEST_LOG_MAX_BYTES", str(64 * 1024 * 1024))),
+        backups=int(os.getenv("REQUEST_LOG_BACKUPS", "5")),
+    )
+    metrics.register_request_log(request_log)
+
+# IDs that later requests send back; replay.py maps the recorded ones to the new ones
+REPLAY_IDS = ("session_id", "briefing_id")
+
+
+def log_request(method, path, query, data, status, started_at, seconds, agent_calls, payload=None):
+    """Queues one request's log entry. `payload` is the JSON response, if there was one."""
+    if request_log is None:
+        return
+    entry = {
+        "ts": round(started_at, 3),
+        "method": method,
+        "path": path,
+        "query": query,
+        "status": status,
+        "seconds": round(seconds, 4),
+        "request": data,
+        "agent_calls": agent_calls,
+    }
+    if isinstance(payload, dict):
+        response_ids = {key: payload[key] for key in REPLAY_IDS if payload.get(key)}
+        if response_ids:
+            entry["response_ids"] = response_ids
+    request_log.record(entry)
+
+
+@app.before_request
+def start_request_log():
+    g.request_started = (time.time(), time.perf_counter())
+    g.agent_calls = start_request()
+    start_budget(REQUEST_BUDGET_SECONDS)
+
+
+# Registered after compress_response, so it runs first and sees the uncompressed body
+@app.after_request
+def finish_request_log(response):
+    if request_log is None or not request.path.startswith("/api/"):
+        return response
+    started_at, started = g.request_started
+    args = (request.method, request.path, request.query_string.decode("utf-8", "replace"),
+            request.get_json(silent=True), response.status_code, started_at)
+    agent_calls = g.agent_calls
+    if response.is_streamed:
+        # Logged once the whole stream has been sent
+        response.call_on_close(lambda: log_request(*args, time.perf_counter() - started, agent_calls))
+    else:
+        payload = None
+        if response.is_json and "Content-Encoding" not in response.headers:
+            payload = response.get_json(silent=True)
+        log_request(*args, time.perf_counter() - started, agent_calls, payload)
+    return response
+
 
 # --- Frontend Route (Unchanged) ---
 @app.route('/')
 def index():
-    return render_template('index.html')
+    html = render_template('index.html')  # Changes when a static file's hash does
+    return cached_response(page_body(html), "no-cache")
+
+
+# The rendered page and its compressed variants, reused while the HTML is the same
+page_cache = LRUCache(maxsize=4, name="page")
+metrics.register_cache(page_cache)
+
+
+def page_body(html):
+    key = content_hash(html)
+    cached = page_cache.get(key)
+    if cached is None:
+        cached = CachedBody(html.encode("utf-8"), "text/html")
+        page_cache.set(key, cached)
+    return cached
+
+
+# --- Static Files: hashed URLs are cached by the browser for a year ---
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    found = static_assets.get(filename)
+    if found is None:
+        abort(404)
+    cached, version = found
+    if request.args.get("v") == version:
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = "no-cache"
+    return cached_response(cached, cache_control)
 
 
 # --- NEW: API Route to load all CSV data for the frontend ---
 @app.route('/api/get-all-data', methods=['GET'])
 def get_all_data():
     try:
-        ingredients_data = read_file_content('ingredients.csv')
-        calendar_data = read_file_content('calendar.csv')
-        ruleset_data = read_file_content('ruleset.csv')
-        
-        return jsonify({
-            "ingredients": ingredients_data,
-            "calendar": calendar_data,
-            "ruleset": ruleset_data
-        })
+        cached = all_data_body(request.args.get('user_id'))
+        if cached is None:
+            return jsonify(UNKNOWN_USER), 404
+        # Revalidated on every load; a 304 if the data hasn't changed
+        return cached_response(cached, "no-cache")
     except Exception as e:
         print(f"Error in get_all_data: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+# --- User Data Route (PROFILE_DB only): a user's CSV files, imported or exported ---
+@app.route('/api/users/<user_id>/data/<name>.csv', methods=['GET', 'PUT'])
+def user_data_csv(user_id, name):
+    if profile_store is None:
+        return jsonify({"error": "Multi-user profiles are disabled (set PROFILE_DB)."}), 404
+    if name not in CSV_COLUMNS:
+        return jsonify({"error": f"Unknown file {name}.csv, expected one of: {', '.join(CSV_COLUMNS)}"}), 404
+    if not is_profile_admin(request.headers.get("Authorization")):
+        return jsonify({"error": "A user's data files need the admin token (PROFILE_ADMIN_TOKEN)."}), 403
+    try:
+        if request.method == 'PUT':
+            count = profile_store.import_csv(user_id, name, request.get_data(as_text=True))
+            print(f"--- Imported {count} rows into {name} for user '{user_id}' ---")
+            return jsonify({"user_id": user_id, "file": f"{name}.csv", "rows": count})
+
+        text = profile_store.export_csv(user_id, name)
+        if text is None:
+            return jsonify(UNKNOWN_USER), 404
+        return Response(text, mimetype="text/csv")
+    except Exception as e:
+        print(f"Error in user_data_csv: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- Trace Route: the agent logs of one response, fetched on demand ---
+@app.route('/api/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    agent_logs = trace_store.get(trace_id)
+    if agent_logs is None:
+        return jsonify({"error": "Trace not found or expired"}), 404
+    return jsonify({"trace_id": trace_id, "agent_logs": agent_logs})
+
+
+# --- Metrics Route (Prometheus text format) ---
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 # --- API Route 1: /api/call-gemini (MODIFIED) ---
 @app.route('/api/call-gemini', methods=['POST'])
 def call_gemini():
+    return json_result(run_steps(call_gemini_steps(request.get_json(silent=True) or {}, request.remote_addr)))
+
+
+def call_gemini_steps(data, client_key):
+    """Pipeline of /api/call-gemini: the briefing (Agent 1) and the recipe options (Agent 2)."""
     try:
         agent_logs = []
-        
-        data = request.get_json()
         meal_type = data.get('mealType')
         user_input = data.get('userInput', '') 
-        if not meal_type:
-            return jsonify({"error": "mealType is required"}), 400
-
-        # --- Read Data Files (now using the same CSV helper) ---
-        # We read the raw file content as text for the AI
-        ingredients_data = ""
-        with open('ingredients.csv', 'r', encoding='utf-8') as f:
-            ingredients_data = f.read()
-            
-        calendar_data = ""
-        with open('calendar.csv', 'r', encoding='utf-8') as f:
-            calendar_data = f.read()
-            
-        ruleset_data = ""
-        with open('ruleset.csv', 'r', encoding='utf-8') as f:
-            ruleset_data = f.read()
+        briefing_id = data.get('briefing_id')
+        if not meal_type and not briefing_id:
+            return 400, {"error": "mealType is required"}
+
+        # --- Read the User's Data (in-memory CSVs, or targeted queries with PROFILE_DB) ---
+        # One snapshot is used for the whole pipeline, so every prompt sees the same data
+        user_id = data.get('user_id')
+        snapshot = yield from snapshot_steps(user_id)
+        if snapshot is None:
+            return 404, UNKNOWN_USER
 
         # --- AGENT 1 (STRATEGIST) EXECUTION ---
-        print("--- Calling Agent 1 (Strategist) ---")
-        agent_1_prompt = prompts.AGENT_1_PROMPT_TEMPLATE.replace("{{INGREDIENTS_CSV}}", ingredients_data)
-        agent_1_prompt = agent_1_prompt.replace("{{CALENDAR_CSV}}", calendar_data)
-        agent_1_prompt = agent_1_prompt.replace("{{RULESET_CSV}}", ruleset_data)
-        agent_1_prompt = agent_1_prompt.replace("{{MEAL_TYPE}}", meal_type)
-        agent_1_prompt = agent_1_prompt.replace("{{USER_INPUT}}", user_input)
-        
-        response_1 = agent_1_model.generate_content(agent_1_prompt)
-        user_profile_briefing = response_1.text
-        
-        agent_logs.append({
-            "agent": "Agent 1 (Strategist)",
-            "input": agent_1_prompt,
-            "output": user_profile_briefing
-        })
-        print("--- Agent 1 Success: Profile Generated ---")
+        if briefing_id:
+            # Retry of a failed request: resume at Agent 2 with the stored briefing
+            user_profile_briefing = briefing_store.get(briefing_id)
+            if user_profile_briefing is None:
+                return 404, {"error": "This profile has expired. Please start again.", "briefing_expired": True}
+            metrics.BRIEFING_SOURCE.inc(source="resumed")
+            print(f"--- Resuming at Agent 2 with stored briefing {briefing_id} ---")
+            agent_logs.append({
+                "agent": "Agent 1 (Strategist) [resumed]",
+                "input": f"Stored briefing: {briefing_id}",
+                "output": user_profile_briefing
+            })
+        else:
+            user_profile_briefing, briefing_log = yield from briefing_steps(snapshot, meal_type, user_input)
+            agent_logs.append(briefing_log)
+            briefing_id = save_briefing(user_profile_briefing)
 
         # --- AGENT 2 (CHEF AI) EXECUTION ---
-        print("--- Calling Agent 2 (Chef AI) ---")
-        agent_2_prompt = prompts.AGENT_2_PROMPT_TEMPLATE.replace("{{USER_PROFILE_BRIEFING}}", user_profile_briefing)
-        agent_2_prompt = agent_2_prompt.replace("{{INGREDIENTS_CSV}}", ingredients_data)
+        try:
+            recipes_json, options_log = yield from recipe_options_steps(user_profile_briefing, snapshot)
+        except Exception as e:
+            # The briefing is kept, so the retry starts at Agent 2
+            status, payload = error_payload(e, "Agent 2")
+            return status, dict(payload, briefing_id=briefing_id)
+        if recipes_json is None:
+            return 500, {
+                "error": "The AI Chef returned an invalid response. Please try again.",
+                "briefing_id": briefing_id
+            }
+        agent_logs.append(options_log)
 
-        response_2 = agent_2_model.generate_content(agent_2_prompt)
+        schedule_speculative_recipes(user_profile_briefing, recipes_json, speculative_user_key(data, client_key),
+                                     snapshot, user_id)
         
+        return 200, attach_trace({
+            "user_profile": user_profile_briefing,
+            "briefing_id": briefing_id,
+            "recipe_options": recipes_json,
+            "agent_logs": agent_logs 
+        }, wants_debug(data))
+
+    except Exception as e:
+        return error_payload(e, "Agent 1 or 2")
+
+
+# --- Briefing (Agent 1) and Options (Agent 2) ---
+def briefing_steps(snapshot, meal_type, user_input):
+    """
+    Returns (briefing, agent log entry). The briefing is built locally if
+    LOCAL_BRIEFING allows it, else served from the briefing cache or Agent 1.
+    """
+    local_log = local_briefing_log(snapshot, meal_type, user_input)
+    if local_log is not None:
+        return local_log["output"], local_log
+
+    print("--- Calling Agent 1 (Strategist) ---")
+    agent_1_prompt = build_agent_1_prompt(snapshot, meal_type, user_input)
+
+    briefing_key = content_hash(agent_1_prompt)
+    user_profile_briefing = briefing_cache.get(briefing_key)
+    briefing_cached = user_profile_briefing is not None
+    if not briefing_cached:
+        user_profile_briefing = yield AgentCall("agent_1", agent_1_prompt)
+        briefing_cache.set(briefing_key, user_profile_briefing)
+    metrics.BRIEFING_SOURCE.inc(source="cache" if briefing_cached else "model")
+
+    stats = briefing_cache.stats()
+    print(f"--- Agent 1 Success: Profile {'served from cache' if briefing_cached else 'Generated'} "
+          f"(cache hits={stats['hits']}, misses={stats['misses']}) ---")
+    return user_profile_briefing, {
+        "agent": "Agent 1 (Strategist)" + (" [cached]" if briefing_cached else ""),
+        "input": agent_1_prompt,
+        "output": user_profile_briefing
+    }
+
+
+def recipe_options_steps(user_profile_briefing, snapshot):
+    """
+    Runs Agent 2 and returns (options, agent log entry), or (None, None) if no
+    attempt gave usable output. Output that can't be parsed (even after local
+    repair) is retried with Agent 2 alone, up to AGENT_2_MAX_ATTEMPTS calls.
+    """
+    print("--- Calling Agent 2 (Chef AI) ---")
+    agent_2_prompt = build_agent_2_prompt(user_profile_briefing, snapshot)
+
+    prompt = agent_2_prompt
+    for attempt in range(1, AGENT_2_MAX_ATTEMPTS + 1):
+        response_2_text = yield AgentCall("agent_2", prompt)
         try:
-            cleaned_text = response_2.text.strip().lstrip("```json").rstrip("```")
-            recipes_json = json.loads(cleaned_text)
-            
-            agent_logs.append({
-                "agent": "Agent 2 (Chef Options)",
-                "input": agent_2_prompt,
-                "output": json.dumps(recipes_json, indent=2) 
-            })
-            
-            return jsonify({
-                "user_profile": user_profile_briefing,
-                "recipe_options": recipes_json,
-                "agent_logs": agent_logs 
-            })
+            recipes_json = parse_recipe_options(response_2_text)
+        except ValueError as e:
+            metrics.JSON_PARSE_FAILURES.inc(agent="agent_2")
+            print(f"Agent 2 attempt {attempt}/{AGENT_2_MAX_ATTEMPTS} returned an invalid response ({e}). "
+                  f"Raw response: {response_2_text}")
+            prompt = build_agent_2_retry_prompt(agent_2_prompt, e)
+            continue
+        return recipes_json, {
+            "agent": "Agent 2 (Chef Options)" + (f" [attempt {attempt}]" if attempt > 1 else ""),
+            "input": prompt,
+            "output": json.dumps(recipes_json, indent=2)
+        }
+    return None, None
 
-        except json.JSONDecodeError:
-            print(f"Agent 2 failed to return valid JSON. Raw response: {response_2.text}")
-            return jsonify({"error": "The AI Chef returned an invalid response. Please try again."}), 500
 
-    except Exception as e:
-        print(f"An error occurred: {e}") 
-        return jsonify({"error": str(e)}), 500
+def generate_briefing(snapshot, meal_type, user_input):
+    """briefing_steps() with blocking agent calls, for meal plans."""
+    return run_steps(briefing_steps(snapshot, meal_type, user_input))
+
+
+def generate_recipe_options(user_profile_briefing, snapshot):
+    """recipe_options_steps() with blocking agent calls, for meal plans."""
+    return run_steps(recipe_options_steps(user_profile_briefing, snapshot))
+
+
+# --- Recipe Generation (Agent 3 + Agent 5) ---
+def recipe_steps(user_profile, selected_dish_name, snapshot, main_ingredients=None):
+    """
+    Runs Agent 3 (full recipe) and Agent 5 (judge) and returns the final response
+    payload, unless a near-duplicate recipe is served from the recipe index.
+    """
+    payload = find_indexed_recipe(user_profile, selected_dish_name, main_ingredients, snapshot)
+    if payload is not None:
+        return payload
+    agent_logs = []
+
+    print(f"--- Calling Agent 3 for dish: {selected_dish_name} ---")
+    
+    # --- AGENT 3 (FULL RECIPE) EXECUTION ---
+    agent_3_prompt = build_agent_3_prompt(user_profile, selected_dish_name, snapshot)
+
+    recipe_details_markdown = yield AgentCall("agent_3", agent_3_prompt) # This is the "raw" recipe
+    
+    agent_logs.append({
+        "agent": "Agent 3 (Full Recipe)",
+        "input": agent_3_prompt,
+        "output": recipe_details_markdown
+    })
+    print("--- Agent 3 Success: Full Recipe Generated ---")
+
+    # --- LOCAL VALIDATOR: decides whether the Judge is needed ---
+    violations, validator_log = run_recipe_validator(recipe_details_markdown, snapshot)
+    if validator_log:
+        agent_logs.append(validator_log)
+
+    if violations == []:
+        judged_recipe_markdown = recipe_details_markdown
+    else:
+        # --- AGENT 5 (JUDGE) EXECUTION ---
+        print("--- Calling Agent 5 (Judge) to critique recipe ---")
+        agent_5_prompt = build_agent_5_prompt(recipe_details_markdown, violations)
+
+        judged_recipe_markdown = yield AgentCall("agent_5", agent_5_prompt) # This is the "corrected" recipe
+
+        agent_logs.append({
+            "agent": "Agent 5 (Culinary Judge)",
+            "input": agent_5_prompt,
+            "output": judged_recipe_markdown
+        })
+        print("--- Agent 5 Success: Recipe Judged ---")
+
+    index_recipe(user_profile, selected_dish_name, main_ingredients, judged_recipe_markdown)
+    return build_recipe_payload(selected_dish_name, judged_recipe_markdown, agent_logs)
+
+
+def generate_recipe(user_profile, selected_dish_name, snapshot, main_ingredients=None):
+    """recipe_steps() with blocking agent calls, for meal plans and speculative jobs."""
+    return run_steps(recipe_steps(user_profile, selected_dish_name, snapshot, main_ingredients))
+
+
+# --- Speculative Pre-generation (opt-in) ---
+# When enabled, all four options returned by /api/call-gemini are generated in the
+# background right away, so a card click is usually served from memory.
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "0") == "1"
+SPECULATIVE_WAIT_SECONDS = float(os.getenv("SPECULATIVE_WAIT_SECONDS", "120"))
+speculative_prefetcher = SpeculativePrefetcher(
+    generate_recipe,
+    max_workers=int(os.getenv("SPECULATIVE_WORKERS", "4")),
+    per_user_limit=int(os.getenv("SPECULATIVE_PER_USER", "2")),
+)
+metrics.register_cache(speculative_prefetcher.results)
+
+
+def recipe_key(user_profile, selected_dish_name, user_id=None):
+    """Key of a generated recipe: (briefing hash, dish title, user)."""
+    return content_hash(content_hash(user_profile), selected_dish_name, user_id or "")
+
+
+def speculative_user_key(data, client_key):
+    """Whose batch a set of options is: the user, else the page's per-tab "client_id", else the client address."""
+    if data.get('user_id'):
+        return f"user:{str(data['user_id'])[:128]}"
+    if data.get('client_id'):
+        return f"client:{str(data['client_id'])[:128]}"
+    return f"addr:{client_key}"
+
+
+def schedule_speculative_recipes(user_profile, recipe_options, user_key, snapshot, user_id=None):
+    if not SPECULATIVE_PREFETCH:
+        return
+    jobs = [
+        (recipe_key(user_profile, option["title"], user_id),
+         (user_profile, option["title"], snapshot, main_ingredients_of(option)))
+        for option in recipe_options
+        if isinstance(option, dict) and option.get("title")
+    ]
+    speculative_prefetcher.schedule(user_key, jobs)
+    print(f"--- Speculatively generating {len(jobs)} recipes in the background ---")
+
+
+def take_speculative_recipe(user_profile, selected_dish_name, user_id=None):
+    """Returns a copy of a pre-generated recipe payload, or None if there is none."""
+    if not SPECULATIVE_PREFETCH:
+        return None
+    payload = speculative_prefetcher.take(
+        recipe_key(user_profile, selected_dish_name, user_id), timeout=SPECULATIVE_WAIT_SECONDS
+    )
+    if payload is None:
+        return None
+    print(f"--- Serving pre-generated recipe for: {selected_dish_name} ---")
+    agent_logs = list(payload["agent_logs"]) + [{
+        "agent": "Speculative Prefetch",
+        "input": f"Request for: {selected_dish_name}",
+        "output": "Served the recipe generated in the background."
+    }]
+    return dict(payload, agent_logs=agent_logs)
+
+
+def speculative_recipe_steps(user_profile, selected_dish_name, user_id=None):
+    if not SPECULATIVE_PREFETCH:
+        return None
+    # May wait on a background job, so it is a blocking step
+    return (yield Blocking(take_speculative_recipe, user_profile, selected_dish_name, user_id))
 
 
 # --- API Route 2: /api/get-recipe-details (MODIFIED) ---
 @app.route('/api/get-recipe-details', methods=['POST'])
 def get_recipe_details():
+    return json_result(run_steps(recipe_details_steps(request.get_json(silent=True) or {})))
+
+
+def recipe_details_steps(data):
     try:
-        agent_logs = []
-        
-        data = request.get_json()
         user_profile = data.get('user_profile')
         selected_dish_name = data.get('selected_dish_name')
 
         if not user_profile or not selected_dish_name:
-            return jsonify({"error": "Missing user_profile or selected_dish_name"}), 400
-        
-        print(f"--- Calling Agent 3 for dish: {selected_dish_name} ---")
-        
-        # Read raw ingredient text for the AI
-        ingredients_data = ""
-        with open('ingredients.csv', 'r', encoding='utf-8') as f:
-            ingredients_data = f.read()
-        
-        # --- AGENT 3 (FULL RECIPE) EXECUTION ---
-        agent_3_prompt = prompts.AGENT_3_PROMPT_TEMPLATE.replace("{{USER_PROFILE_BRIEFING}}", user_profile)
-        agent_3_prompt = agent_3_prompt.replace("{{INGREDIENTS_CSV}}", ingredients_data)
-        agent_3_prompt = agent_3_prompt.replace("{{SELECTED_DISH_NAME}}", selected_dish_name) 
+            return 400, {"error": "Missing user_profile or selected_dish_name"}
+        user_id = data.get('user_id')
+        snapshot = yield from snapshot_steps(user_id)
+        if snapshot is None:
+            return 404, UNKNOWN_USER
 
-        response_3 = agent_3_model.generate_content(agent_3_prompt)
-        recipe_details_markdown = response_3.text # This is the "raw" recipe
-        
-        agent_logs.append({
+        payload = yield from speculative_recipe_steps(user_profile, selected_dish_name, user_id)
+        if payload is None:
+            payload = yield from recipe_steps(user_profile, selected_dish_name, snapshot, main_ingredients_of(data))
+
+        return 200, attach_trace(payload, wants_debug(data))
+
+    except Exception as e:
+        return error_payload(e, "Agent 3 or 5")
+
+
+# --- API Route 2b: /api/get-recipe-details/stream (Server-Sent Events) ---
+# Same pipeline as above, but streamed so the UI can show content early:
+#   event: progress  -> {"agent": "Agent 3", "chars": N} while Agent 3 is generating
+#   event: agent_log -> one agent log entry as soon as that agent is finished (debug only)
+#   event: section   -> {"name": "ingredients"|"instructions"|"nutrition", "html": "<table>..."}
+#                       as soon as that table of the judged recipe is complete
+#                       (all at once if the validator passed and Agent 5 is skipped)
+#   event: done      -> the exact same payload /api/get-recipe-details returns (with its trace_id)
+#   event: error     -> {"error": "..."}
+@app.route('/api/get-recipe-details/stream', methods=['POST'])
+def get_recipe_details_stream():
+    status, result = run_steps(recipe_stream_steps(request.get_json(silent=True) or {}))
+    if status != 200:
+        return jsonify(result), status
+    return Response(
+        stream_with_context(pipeline.events(result, call_agent, stream_agent)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def recipe_stream_steps(data):
+    """Returns (200, the steps of the event stream), or an error (status, payload) to send as JSON instead."""
+    user_profile = data.get('user_profile')
+    selected_dish_name = data.get('selected_dish_name')
+
+    if not user_profile or not selected_dish_name:
+        return 400, {"error": "Missing user_profile or selected_dish_name"}
+    user_id = data.get('user_id')
+    snapshot = yield from snapshot_steps(user_id)
+    if snapshot is None:
+        return 404, UNKNOWN_USER
+    return 200, recipe_event_steps(user_profile, selected_dish_name, snapshot, user_id,
+                                   main_ingredients_of(data), wants_debug(data))
+
+
+def recipe_event_steps(user_profile, selected_dish_name, snapshot, user_id, main_ingredients, debug):
+    agent_logs = []
+    try:
+        # A recipe pre-generated in the background is sent as a single "done" event
+        payload = yield from speculative_recipe_steps(user_profile, selected_dish_name, user_id)
+        if payload is None:
+            payload = find_indexed_recipe(user_profile, selected_dish_name, main_ingredients, snapshot)
+        if payload is not None:
+            yield sse_event("done", attach_trace(payload, debug))
+            return
+
+        # --- AGENT 3 (FULL RECIPE) EXECUTION, streamed as progress ---
+        print(f"--- Streaming Agent 3 for dish: {selected_dish_name} ---")
+        agent_3_prompt = build_agent_3_prompt(user_profile, selected_dish_name, snapshot)
+
+        recipe_parts = []
+        chars = 0
+        text = yield AgentCall("agent_3", agent_3_prompt, stream=True)
+        while text is not None:
+            recipe_parts.append(text)
+            chars += len(text)
+            yield sse_event("progress", {"agent": "Agent 3", "chars": chars})
+            text = yield NEXT_CHUNK
+        recipe_details_markdown = "".join(recipe_parts)
+
+        log = {
             "agent": "Agent 3 (Full Recipe)",
             "input": agent_3_prompt,
             "output": recipe_details_markdown
-        })
+        }
+        agent_logs.append(log)
+        if debug:
+            yield sse_event("agent_log", log)
         print("--- Agent 3 Success: Full Recipe Generated ---")
-        
-        
-        # --- AGENT 5 (JUDGE) EXECUTION ---
-        print("--- Calling Agent 5 (Judge) to critique recipe ---")
-        agent_5_prompt = prompts.AGENT_5_PROMPT_TEMPLATE.replace("{{RECIPE_MARKDOWN}}", recipe_details_markdown)
-        
-        response_5 = agent_5_model.generate_content(agent_5_prompt)
-        judged_recipe_markdown = response_5.text # This is the "corrected" recipe
-        
-        agent_logs.append({
-            "agent": "Agent 5 (Culinary Judge)",
-            "input": agent_5_prompt,
-            "output": judged_recipe_markdown
-        })
-        print("--- Agent 5 Success: Recipe Judged ---")
 
-        
-        # --- Static Image Selection ---
-        hero_image_url = "/static/default_food.png"
-        print(f"--- Using static image: {hero_image_url} ---")
-        
-        agent_logs.append({
-            "agent": "Agent 4 (Image Placeholder)",
-            "input": f"Request for: {selected_dish_name}",
-            "output": f"Serving static image: {hero_image_url}"
-        })
+        # --- LOCAL VALIDATOR: decides whether the Judge is needed ---
+        violations, validator_log = run_recipe_validator(recipe_details_markdown, snapshot)
+        if validator_log:
+            agent_logs.append(validator_log)
+            if debug:
+                yield sse_event("agent_log", validator_log)
 
-        # --- Format Output ---
-        recipe_details_html = markdown2.markdown(judged_recipe_markdown, extras=["tables"])
-        
-        return jsonify({
-            "hero_image_url": hero_image_url,
-            "recipe_html": recipe_details_html,
-            "agent_logs": agent_logs 
-        })
+        if violations == []:
+            judged_recipe_markdown = recipe_details_markdown
+            for name, html in render_recipe(judged_recipe_markdown)["sections"].items():
+                yield sse_event("section", {"name": name, "html": html})
+        else:
+            # --- AGENT 5 (JUDGE) EXECUTION, streamed section by section ---
+            print("--- Streaming Agent 5 (Judge) to critique recipe ---")
+            agent_5_prompt = build_agent_5_prompt(recipe_details_markdown, violations)
+
+            streamer = RecipeSectionStreamer()
+            judged_parts = []
+            text = yield AgentCall("agent_5", agent_5_prompt, stream=True)
+            while text is not None:
+                judged_parts.append(text)
+                for name, table_markdown in streamer.feed(text):
+                    yield sse_event("section", {"name": name, "html": render_markdown(table_markdown)})
+                text = yield NEXT_CHUNK
+            for name, table_markdown in streamer.finish():
+                yield sse_event("section", {"name": name, "html": render_markdown(table_markdown)})
+            judged_recipe_markdown = "".join(judged_parts)
+
+            log = {
+                "agent": "Agent 5 (Culinary Judge)",
+                "input": agent_5_prompt,
+                "output": judged_recipe_markdown
+            }
+            agent_logs.append(log)
+            if debug:
+                yield sse_event("agent_log", log)
+            print("--- Agent 5 Success: Recipe Judged ---")
+
+        # The final payload is built from the full judged text exactly like the JSON route
+        index_recipe(user_profile, selected_dish_name, main_ingredients, judged_recipe_markdown)
+        payload = build_recipe_payload(selected_dish_name, judged_recipe_markdown, agent_logs)
+        yield sse_event("done", attach_trace(payload, debug))
+
+    except Exception as e:
+        status, payload = error_payload(e, "streamed Agent 3 or 5")
+        yield sse_event("error", payload)
+
+
+# --- Batch Meal Plans ---
+# Plans every meal window of the calendar in the background (see meal_plan.py,
+# which is also the CLI). Results and checkpoints go to MEAL_PLAN_DIR/<job id>.
+MEAL_PLAN_DIR = os.getenv("MEAL_PLAN_DIR", "meal_plans")
+MEAL_PLAN_WORKERS = int(os.getenv("MEAL_PLAN_WORKERS", "4"))
+MEAL_PLAN_RATE = float(os.getenv("MEAL_PLAN_RATE", "0"))
+
+
+def plan_meal(snapshot, meal_type, user_input, state, save, wait):
+    """
+    Plans one meal of a batch job: briefing, options, then the full recipe of
+    the first option. Stages already in `state` (from the job's checkpoint) are
+    skipped; each new one is passed to save(stage, data). wait() is called
+    before every stage, to keep to the job's rate limit.
+    """
+    user_profile_briefing = state.get("briefing")
+    if user_profile_briefing is None:
+        wait()
+        user_profile_briefing, _ = generate_briefing(snapshot, meal_type, user_input)
+        save("briefing", user_profile_briefing)
+
+    recipe_options = state.get("options")
+    if recipe_options is None:
+        wait()
+        recipe_options, _ = generate_recipe_options(user_profile_briefing, snapshot)
+        if recipe_options is None:
+            raise ValueError("The AI Chef returned an invalid response.")
+        save("options", recipe_options)
+
+    selected_dish_name = recipe_options[0]["title"]
+    recipe = state.get("recipe")
+    if recipe is None:
+        wait()
+        recipe = generate_recipe(user_profile_briefing, selected_dish_name, snapshot,
+                                 main_ingredients_of(recipe_options[0]))
+        recipe.pop("agent_logs", None)
+        save("recipe", recipe)
+
+    return {
+        "dish": selected_dish_name,
+        "user_profile": user_profile_briefing,
+        "recipe_options": recipe_options,
+        "recipe": recipe,
+    }
+
+
+def run_meal_plan_job(params, output_dir, progress=None, workers=None, rate=None):
+    """Runs a meal plan job (parameters from meal_plan.normalize_params) and returns its summary."""
+    snapshot = load_snapshot(params["user_id"])
+    if snapshot is None:
+        raise ValueError(UNKNOWN_USER["error"])
+    calendar_rows = snapshot.rows["calendar"]
+    if profile_store is not None:
+        # The snapshot only has today's row; the plan needs the whole calendar
+        exported = profile_store.export_rows(params["user_id"] or DEFAULT_USER_ID)
+        calendar_rows = exported[0]["calendar"] if exported else []
+
+    items = meal_plan.plan_items(calendar_rows, params["start"], params["end"], params["meals"])
+    print(f"--- Meal plan: {len(items)} meals to plan in {output_dir} ---")
+    return meal_plan.run_meal_plan(
+        plan_meal, snapshot, items, output_dir,
+        workers=MEAL_PLAN_WORKERS if workers is None else workers,
+        rate=MEAL_PLAN_RATE if rate is None else rate,
+        user_input=params["userInput"], progress=progress,
+    )
+
+
+meal_plan_jobs = meal_plan.MealPlanJobs(run_meal_plan_job, MEAL_PLAN_DIR)
+
+
+@app.route('/api/meal-plans', methods=['POST'])
+def create_meal_plan():
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            params = meal_plan.normalize_params(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if profile_store is not None and not profile_store.has_user(params["user_id"] or DEFAULT_USER_ID):
+            return jsonify(UNKNOWN_USER), 404
+
+        job = meal_plan_jobs.submit(params)
+        print(f"--- Meal plan job {job['job_id']}: {job['status']} ---")
+        return jsonify(job), 202
+
+    except Exception as e:
+        print(f"An error occurred while starting a meal plan: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/meal-plans/<job_id>', methods=['GET'])
+def get_meal_plan(job_id):
+    """The job's status and progress; once it is done, also the plan itself."""
+    try:
+        job = meal_plan_jobs.status(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown meal plan job."}), 404
+        if job["status"] == "done":
+            with open(meal_plan_jobs.plan_path(job_id), encoding="utf-8") as f:
+                job["plan"] = json.load(f)
+        return jsonify(job)
+
+    except Exception as e:
+        print(f"An error occurred while reading meal plan {job_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- Cooking Sessions (Agent 6 + Agent 7) ---
+# "Let's Cook!" creates a server-side session that stores the recipe text once.
+# The chatbot then only receives the session ID and the new message; the session
+# keeps the recent turns plus a rolling summary of older ones. Sessions are
+# evicted LRU-first and after COOKING_SESSION_IDLE_SECONDS without use.
+cooking_sessions = SessionStore(
+    maxsize=int(os.getenv("COOKING_SESSION_MAX", "1000")),
+    idle_ttl=float(os.getenv("COOKING_SESSION_IDLE_SECONDS", "3600")),
+    max_turns=int(os.getenv("COOKING_SESSION_TURNS", "8")),
+    summary_chars=int(os.getenv("COOKING_SESSION_SUMMARY_CHARS", "1500")),
+)
+metrics.register_cache(cooking_sessions.sessions)
+SESSION_EXPIRED = {"error": "Your cooking session has expired. Please start cooking again.", "session_expired": True}
+
+
+@app.route('/api/cooking-session', methods=['POST'])
+def create_cooking_session():
+    try:
+        return json_result(start_cooking_session(request.get_json(silent=True) or {}))
 
     except Exception as e:
-        print(f"An error occurred in Agent 3 or 5: {e}")
+        print(f"An error occurred while creating a cooking session: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-# --- API ROUTE 3: /api/explain-step (Unchanged) ---
+def start_cooking_session(data):
+    recipe_context = data.get('recipe_context')
+    if not recipe_context:
+        return 400, {"error": "Missing recipe context"}
+
+    session = cooking_sessions.create(recipe_context)
+    print(f"--- Cooking session started: {session.id} ---")
+    return 200, {"session_id": session.id}
+
+
+# --- Agent 6 Explanation Cache ---
+# Step explanations are cached by (recipe hash, normalized instruction), so the
+# same step of the same recipe is only explained once, for every user.
+explanation_cache = LRUCache(
+    maxsize=int(os.getenv("EXPLANATION_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("EXPLANATION_CACHE_TTL", "604800")),
+    disk_dir=os.getenv("EXPLANATION_CACHE_DIR") or None,
+    name="explanation_cache",
+)
+metrics.register_cache(explanation_cache)
+
+
+def parse_steps(steps):
+    """Returns the valid {"step", "instruction"} entries of a request's "steps" list."""
+    return [
+        {"step": str(step["step"]), "instruction": str(step["instruction"])}
+        for step in (steps if isinstance(steps, list) else [])
+        if isinstance(step, dict) and step.get("step") is not None and step.get("instruction")
+    ]
+
+
+def cached_explanations(recipe_context, steps):
+    """Returns ({step: explanation} for the cached steps, [steps still to explain])."""
+    explanations, missing = {}, []
+    for step in steps:
+        explanation = explanation_cache.get(explanation_key(recipe_context, step["instruction"]))
+        if explanation is None:
+            missing.append(step)
+        else:
+            explanations[step["step"]] = explanation
+    return explanations, missing
+
+
+def store_explanations(recipe_context, steps, explanations):
+    """Caches the new explanations and returns only those for the requested steps."""
+    stored = {}
+    for step in steps:
+        explanation = explanations.get(step["step"])
+        if explanation:
+            explanation_cache.set(explanation_key(recipe_context, step["instruction"]), explanation)
+            stored[step["step"]] = explanation
+    return stored
+
+
+# --- API ROUTE 3: /api/explain-step ---
+# Takes the recipe either from a cooking session ("session_id") or inline ("recipe_context").
 @app.route('/api/explain-step', methods=['POST'])
 def explain_step():
+    return json_result(run_steps(explanation_steps(request.get_json(silent=True) or {})))
+
+
+def explanation_steps(data):
     try:
-        data = request.get_json()
         instruction = data.get('instruction_text')
         recipe_context = data.get('recipe_context')
 
+        session_id = data.get('session_id')
+        if session_id:
+            session = cooking_sessions.get(session_id)
+            if session is None:
+                return 404, SESSION_EXPIRED
+            recipe_context = session.recipe_context
+
         if not instruction or not recipe_context:
-            return jsonify({"error": "Missing instruction or recipe context"}), 400
+            return 400, {"error": "Missing instruction or recipe context"}
 
-        print(f"--- Calling Agent 6 (Coach) for step: {instruction} ---")
+        key = explanation_key(recipe_context, instruction)
+        explanation_text = explanation_cache.get(key)
+        if explanation_text is not None:
+            print(f"--- Agent 6 explanation served from cache for step: {instruction} ---")
+        else:
+            print(f"--- Calling Agent 6 (Coach) for step: {instruction} ---")
 
-        # --- AGENT 6 (TECHNIQUE COACH) EXECUTION ---
-        agent_6_prompt = prompts.AGENT_6_PROMPT_TEMPLATE.replace("{{FULL_RECIPE_CONTEXT}}", recipe_context)
-        agent_6_prompt = agent_6_prompt.replace("{{INSTRUCTION_TEXT}}", instruction)
+            # --- AGENT 6 (TECHNIQUE COACH) EXECUTION ---
+            agent_6_prompt = build_agent_6_prompt(recipe_context, instruction)
 
-        response_6 = agent_6_model.generate_content(agent_6_prompt)
-        explanation_text = response_6.text
+            explanation_text = yield AgentCall("agent_6", agent_6_prompt)
+            explanation_cache.set(key, explanation_text)
 
-        print("--- Agent 6 Success: Explanation Generated ---")
+            print("--- Agent 6 Success: Explanation Generated ---")
 
-        return jsonify({
+        return 200, {
             "explanation": explanation_text
-        })
+        }
 
     except Exception as e:
-        print(f"An error occurred in Agent 6: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_payload(e, "Agent 6")
+
+
+# --- API ROUTE 3b: /api/explain-steps (all steps in one Agent 6 call) ---
+# Request: {"session_id" or "recipe_context", "steps": [{"step": "1", "instruction": "..."}, ...]}
+# Response: {"explanations": {"1": "...", ...}}. Cached steps are not sent to the model;
+# a step the model left out is simply missing, and the client can fall back to /api/explain-step.
+@app.route('/api/explain-steps', methods=['POST'])
+def explain_steps():
+    return json_result(run_steps(batch_explanation_steps(request.get_json(silent=True) or {})))
+
+
+def batch_explanation_steps(data):
+    try:
+        recipe_context = data.get('recipe_context')
+        steps = parse_steps(data.get('steps'))
+
+        session_id = data.get('session_id')
+        if session_id:
+            session = cooking_sessions.get(session_id)
+            if session is None:
+                return 404, SESSION_EXPIRED
+            recipe_context = session.recipe_context
+
+        if not steps or not recipe_context:
+            return 400, {"error": "Missing steps or recipe context"}
+
+        explanations, missing = cached_explanations(recipe_context, steps)
+        print(f"--- Agent 6 batch: {len(explanations)} of {len(steps)} steps served from cache ---")
 
+        if missing:
+            print(f"--- Calling Agent 6 (Coach) for {len(missing)} steps in one call ---")
+            agent_6_prompt = build_agent_6_batch_prompt(recipe_context, missing)
+            response_text = yield AgentCall("agent_6", agent_6_prompt)
+            try:
+                explanations.update(store_explanations(recipe_context, missing, parse_step_explanations(response_text)))
+            except (ValueError, TypeError):
+                metrics.JSON_PARSE_FAILURES.inc(agent="agent_6")
+                print(f"Agent 6 failed to return valid JSON. Raw response: {response_text}")
+                return 500, {"error": "The AI Coach returned an invalid response. Please try again."}
+            print("--- Agent 6 Success: Batch Explanations Generated ---")
 
-# --- API ROUTE 4: /api/ask-chatbot (Unchanged) ---
+        return 200, {
+            "explanations": explanations
+        }
+
+    except Exception as e:
+        return error_payload(e, "Agent 6")
+
+
+# --- API ROUTE 4: /api/ask-chatbot ---
+# With a "session_id", only the new "message" is sent and the history is kept on
+# the server. Without one, the old payload (recipe_context + chat_history) still works.
 @app.route('/api/ask-chatbot', methods=['POST'])
 def ask_chatbot():
+    return json_result(run_steps(chatbot_steps(request.get_json(silent=True) or {})))
+
+
+def chatbot_steps(data):
     try:
-        data = request.get_json()
-        recipe_context = data.get('recipe_context')
         current_step = data.get('current_step')
-        chat_history = data.get('chat_history') # This is our new memory array
+        session_id = data.get('session_id')
+        session = None
+        summary = ""
 
-        if not recipe_context or not current_step or not chat_history:
-            return jsonify({"error": "Missing recipe, step, or chat history"}), 400
+        if session_id:
+            question = data.get('message')
+            if not current_step or not question:
+                return 400, {"error": "Missing step or message"}
+            session = cooking_sessions.get(session_id)
+            if session is None:
+                return 404, SESSION_EXPIRED
+            recipe_context = session.recipe_context
+            summary, chat_history = session.history(question)
+        else:
+            recipe_context = data.get('recipe_context')
+            chat_history = data.get('chat_history') # This is our new memory array
+            if not recipe_context or not current_step or not chat_history:
+                return 400, {"error": "Missing recipe, step, or chat history"}
 
         print(f"--- Calling Agent 7 (Chatbot) for step: {current_step} ---")
 
-        # --- Format the chat history for the AI ---
-        formatted_history = ""
-        for message in chat_history:
-            if message['role'] == 'user':
-                formatted_history += f"User: {message['content']}\n"
-            else:
-                formatted_history += f"Bot: {message['content']}\n"
-
         # --- AGENT 7 (CHATBOT) EXECUTION ---
-        agent_7_prompt = prompts.AGENT_7_PROMPT_TEMPLATE.replace("{{FULL_RECIPE_CONTEXT}}", recipe_context)
-        agent_7_prompt = agent_7_prompt.replace("{{CURRENT_STEP}}", str(current_step))
-        agent_7_prompt = agent_7_prompt.replace("{{CHAT_HISTORY}}", formatted_history)
+        agent_7_prompt = build_agent_7_prompt(recipe_context, current_step, chat_history, summary)
 
-        response_7 = agent_7_model.generate_content(agent_7_prompt)
-        bot_response = response_7.text
+        bot_response = yield AgentCall("agent_7", agent_7_prompt)
+        if session is not None:
+            session.add_exchange(question, bot_response)
 
         print("--- Agent 7 Success: Chat Response Generated ---")
 
-        return jsonify({
+        return 200, {
             "answer": bot_response
-        })
+        }
 
     except Exception as e:
-        print(f"An error occurred in Agent 7: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_payload(e, "Agent 7")
 
 
 # --- Run the App (Unchanged) ---
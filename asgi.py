@@ -0,0 +1,273 @@
+# asgi.py
+#
+# Async serving mode. Run with:
+#     uvicorn asgi:app --port 5000
+#
+# The agent routes (/api/call-gemini, /api/get-recipe-details[/stream],
+# /api/cooking-session, /api/explain-step[s], /api/ask-chatbot) are served
+# natively on the event loop, so a request waiting on the model does not hold
+# a worker thread. Everything else (the page, static files, /api/get-all-data)
+# is passed through to the Flask app in app.py. The routes run the same
+# pipelines as app.py's (see pipeline.py), so the JSON contracts are exactly the same.
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.wsgi import WsgiToAsgi
+
+import app as core  # The Flask app module: backend, caches and the route pipelines
+import metrics
+import pipeline
+from http_cache import compress, negotiate_encoding
+from request_log import note_agent_call, start_request
+from resilience import start_budget
+from single_flight import AsyncSingleFlight
+
+# --- Configuration ---
+# Max number of agent calls in flight at once across the whole process
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY", "200"))
+# Deadlines, retries, hedging and the circuit breaker are core.agent_caller's (AGENT_TIMEOUT_SECONDS etc.)
+AGENT_TIMEOUT_SECONDS = core.AGENT_TIMEOUT_SECONDS
+
+agent_semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+
+# Used for short blocking helpers that must stay off the event loop
+_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_CONCURRENCY, thread_name_prefix="async-fallback")
+
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+# --- Async Agent Calls ---
+# Identical calls in flight share one model call (core.SINGLE_FLIGHT). The call
+# runs in its own task under the concurrency limit, guarded by core.agent_caller
+# (deadline, retries, hedging, circuit breaker); callers waiting on it give up
+# after AGENT_TIMEOUT_SECONDS.
+agent_flights = AsyncSingleFlight(name="async_agent_calls")
+metrics.register_single_flight(agent_flights)
+
+
+async def _stream(agent, prompt):
+    """Streams one upstream agent call, under the global concurrency limit and the agent call guards."""
+    async with agent_semaphore:
+        started = time.perf_counter()
+        first_chunk_seconds = None
+        parts = []
+        try:
+            async for chunk in core.agent_caller.astream(agent, prompt):
+                if first_chunk_seconds is None:
+                    first_chunk_seconds = time.perf_counter() - started
+                parts.append(chunk)
+                yield chunk
+        except Exception:
+            core.record_agent_call(agent, prompt, None, time.perf_counter() - started, first_chunk_seconds)
+            raise
+        core.record_agent_call(agent, prompt, "".join(parts), time.perf_counter() - started, first_chunk_seconds)
+
+
+async def _generate(agent, prompt):
+    """One upstream agent call through the backend's async API, as a single-chunk stream."""
+    async with agent_semaphore:
+        started = time.perf_counter()
+        try:
+            response = await core.agent_caller.acall(agent, prompt)
+        except Exception:
+            core.record_agent_call(agent, prompt, None, time.perf_counter() - started)
+            raise
+        core.record_agent_call(agent, prompt, response, time.perf_counter() - started)
+    yield response
+
+
+async def run_agent(agent, prompt):
+    """Calls one agent and returns its response text."""
+    if not core.SINGLE_FLIGHT:
+        return "".join([chunk async for chunk in _generate(agent, prompt)])
+    started = time.perf_counter()
+    response, shared = await agent_flights.call(
+        core.agent_call_key(agent, prompt), lambda: _generate(agent, prompt), AGENT_TIMEOUT_SECONDS)
+    if shared:
+        note_agent_call(agent, prompt, response, time.perf_counter() - started, shared=True)
+    return response
+
+
+async def stream_agent(agent, prompt):
+    """Async version of core.stream_agent: yields response text chunks as they are generated."""
+    if not core.SINGLE_FLIGHT:
+        async for chunk in _stream(agent, prompt):
+            yield chunk
+        return
+    started = time.perf_counter()
+    chunks, shared = agent_flights.stream(
+        core.agent_call_key(agent, prompt), lambda: _stream(agent, prompt), AGENT_TIMEOUT_SECONDS)
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    if shared:
+        note_agent_call(agent, prompt, "".join(parts), time.perf_counter() - started, shared=True)
+
+
+# --- Minimal ASGI Router ---
+class AsyncAPI:
+    """
+    Routes POST requests for registered paths to async handlers and passes
+    everything else to a fallback ASGI app.
+
+    A handler receives (data, client_key) and returns either a
+    (status, payload) tuple, which is sent as JSON, or an async iterator of
+    strings, which is sent as a text/event-stream.
+    """
+
+    def __init__(self, fallback):
+        self._routes = {}
+        self._fallback = fallback
+
+    def post(self, path):
+        def decorator(handler):
+            self._routes[path] = handler
+            return handler
+        return decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+
+        handler = None
+        if scope["type"] == "http" and scope["method"] == "POST":
+            handler = self._routes.get(scope["path"])
+        if handler is None:
+            await self._fallback(scope, receive, send)
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            await self._send_json(send, 400, {"error": "Request body must be JSON"})
+            return
+        if not isinstance(data, dict):
+            data = {}
+
+        client_key = (scope.get("client") or ("unknown",))[0]
+        accept_encoding = dict(scope.get("headers") or []).get(b"accept-encoding", b"").decode("latin-1")
+        started_at, started = time.time(), time.perf_counter()
+        agent_calls = start_request()  # Each request runs in its own task, so its own context
+        start_budget(core.REQUEST_BUDGET_SECONDS)
+        log_args = ("POST", scope["path"], scope.get("query_string", b"").decode("utf-8", "replace"), data)
+        result = await handler(data, client_key)
+        if isinstance(result, tuple):
+            await self._send_json(send, *result, encoding=negotiate_encoding(accept_encoding))
+            status, payload = result
+            core.log_request(*log_args, status, started_at, time.perf_counter() - started, agent_calls, payload)
+        else:
+            await self._send_stream(send, result)
+            core.log_request(*log_args, 200, started_at, time.perf_counter() - started, agent_calls)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                _executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _send_json(self, send, status, payload, encoding=None):
+        body = json.dumps(payload).encode("utf-8")
+        headers = [(b"content-type", b"application/json"), (b"access-control-allow-origin", b"*")]
+        if encoding and len(body) >= core.GZIP_MIN_BYTES:
+            body = compress(body, encoding)
+            headers += [(b"content-encoding", encoding.encode()), (b"vary", b"Accept-Encoding")]
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def _send_stream(self, send, events):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                (b"access-control-allow-origin", b"*"),
+            ],
+        })
+        async for event in events:
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+app = AsyncAPI(fallback=WsgiToAsgi(core.app))
+
+
+async def run_steps(steps):
+    """Runs a route's pipeline (see core.run_steps) with the agent calls on the event loop."""
+    return await pipeline.arun(steps, run_agent, stream_agent, run_blocking)
+
+
+# --- API Route 1: /api/call-gemini ---
+@app.post('/api/call-gemini')
+async def call_gemini(data, client_key):
+    return await run_steps(core.call_gemini_steps(data, client_key))
+
+
+# --- API Route 2: /api/get-recipe-details ---
+@app.post('/api/get-recipe-details')
+async def get_recipe_details(data, client_key):
+    return await run_steps(core.recipe_details_steps(data))
+
+
+# --- API Route 2b: /api/get-recipe-details/stream (same events as app.py) ---
+@app.post('/api/get-recipe-details/stream')
+async def get_recipe_details_stream(data, client_key):
+    status, result = await run_steps(core.recipe_stream_steps(data))
+    if status != 200:
+        return status, result
+    return pipeline.aevents(result, run_agent, stream_agent, run_blocking)
+
+
+# --- Cooking Sessions ---
+@app.post('/api/cooking-session')
+async def create_cooking_session(data, client_key):
+    return core.start_cooking_session(data)
+
+
+# --- API Route 3: /api/explain-step ---
+@app.post('/api/explain-step')
+async def explain_step(data, client_key):
+    return await run_steps(core.explanation_steps(data))
+
+
+# --- API Route 3b: /api/explain-steps ---
+@app.post('/api/explain-steps')
+async def explain_steps(data, client_key):
+    return await run_steps(core.batch_explanation_steps(data))
+
+
+# --- API Route 4: /api/ask-chatbot ---
+@app.post('/api/ask-chatbot')
+async def ask_chatbot(data, client_key):
+    return await run_steps(core.chatbot_steps(data))
+
+
+# --- Run the App ---
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run("asgi:app", port=5000)
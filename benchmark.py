@@ -0,0 +1,297 @@
+# benchmark.py
+#
+# Offline latency benchmark for the whole agent pipeline.
+# Drives every /api/* route through the Flask test client, with the model
+# replaced by the deterministic FakeBackend, and reports per-route,
+# per-agent and end-to-end latency percentiles, throughput and prompt sizes,
+# plus the startup time and memory of a fresh process importing the app.
+#
+#     python benchmark.py --sessions 50 --concurrency 8 --latency-ms 200 --jitter-ms 50
+#     python benchmark.py --error-rate 0.05 --slow-rate 0.02 --slow-ms 2000 --hedge   # faults and tail latency
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+MEAL_TYPES = ["Breakfast", "Lunch", "Dinner", "Snack"]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class RecordingBackend:
+    """Wraps a backend and records the duration and prompt/response size of every agent call."""
+
+    def __init__(self, inner):
+        self._inner = inner
+        self._lock = threading.Lock()
+        self.calls = defaultdict(list)  # agent -> [(seconds, prompt_bytes, response_bytes)]
+
+    def _record(self, agent, started, prompt, response):
+        with self._lock:
+            self.calls[agent].append((
+                time.perf_counter() - started,
+                len(prompt.encode("utf-8")),
+                len(response.encode("utf-8")),
+            ))
+
+    def generate(self, agent, prompt, timeout=None):
+        started = time.perf_counter()
+        response = self._inner.generate(agent, prompt, timeout)
+        self._record(agent, started, prompt, response)
+        return response
+
+    def stream(self, agent, prompt, timeout=None):
+        started = time.perf_counter()
+        parts = []
+        for chunk in self._inner.stream(agent, prompt, timeout):
+            parts.append(chunk)
+            yield chunk
+        self._record(agent, started, prompt, "".join(parts))
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+
+class RouteTimer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = defaultdict(list)  # route -> [seconds]
+        self.errors = defaultdict(int)
+
+    def request(self, client, method, route, payload=None):
+        started = time.perf_counter()
+        if method == "GET":
+            response = client.get(route)
+        else:
+            response = client.post(route, json=payload)
+        body = response.get_data()  # Drains streamed responses too
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.durations[route].append(elapsed)
+            if response.status_code != 200:
+                self.errors[route] += 1
+        return response, body
+
+
+def run_session(flask_app, timer, index, warm_cache):
+    """One user session: load data, get options, open two recipes, explain a step, ask the chatbot."""
+    client = flask_app.test_client()
+    started = time.perf_counter()
+
+    timer.request(client, "GET", "/api/get-all-data")
+
+    # A unique userInput per session defeats the briefing cache unless --warm-cache is set
+    user_input = "" if warm_cache else f"benchmark session {index}"
+    response, _ = timer.request(client, "POST", "/api/call-gemini", {
+        "mealType": MEAL_TYPES[index % len(MEAL_TYPES)],
+        "userInput": user_input,
+    })
+    options = response.get_json()
+    user_profile = options["user_profile"]
+    titles = [option["title"] for option in options["recipe_options"]]
+
+    response, _ = timer.request(client, "POST", "/api/get-recipe-details", {
+        "user_profile": user_profile,
+        "selected_dish_name": titles[0],
+    })
+    recipe = response.get_json()
+    recipe_text = recipe["recipe_html"]
+    steps = recipe["recipe"]["steps"]
+
+    timer.request(client, "POST", "/api/get-recipe-details/stream", {
+        "user_profile": user_profile,
+        "selected_dish_name": titles[1 % len(titles)],
+    })
+
+    # Cook mode, as the frontend does it: one session, all steps explained in one call
+    response, _ = timer.request(client, "POST", "/api/cooking-session", {"recipe_context": recipe_text})
+    session_id = response.get_json()["session_id"]
+
+    timer.request(client, "POST", "/api/explain-steps", {"session_id": session_id, "steps": steps})
+
+    timer.request(client, "POST", "/api/explain-step", {
+        "session_id": session_id,
+        "instruction_text": steps[1]["instruction"],
+    })
+
+    timer.request(client, "POST", "/api/ask-chatbot", {
+        "session_id": session_id,
+        "current_step": "2",
+        "message": "Can I use olive oil instead?",
+    })
+
+    return time.perf_counter() - started
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+    }
+
+
+# Run in a fresh interpreter: prints the seconds taken by `import app` and the peak RSS in MB
+STARTUP_SCRIPT = """
+import json, resource, time
+started = time.perf_counter()
+import app
+print(json.dumps({"import_s": round(time.perf_counter() - started, 3),
+                  "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}))
+"""
+
+
+def measure_startup(model_backend):
+    """Cold start of one worker: import time and peak memory of a new process that imports the app."""
+    env = dict(os.environ, MODEL_BACKEND=model_backend)
+    result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(sessions, concurrency, warm_cache):
+    # Imported here so the environment (MODEL_BACKEND etc.) is set up first
+    import app as core
+    import metrics
+
+    recorder = RecordingBackend(core.backend)
+    core.backend = recorder
+    core.briefing_cache.clear()
+    timer = RouteTimer()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        session_times = list(pool.map(
+            lambda i: run_session(core.app, timer, i, warm_cache), range(sessions)
+        ))
+    wall_time = time.perf_counter() - started
+
+    total_requests = sum(len(v) for v in timer.durations.values())
+    report = {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "wall_time_s": round(wall_time, 3),
+        "throughput": {
+            "sessions_per_s": round(sessions / wall_time, 2),
+            "requests_per_s": round(total_requests / wall_time, 2),
+        },
+        "end_to_end": summarize(session_times),
+        "routes": {
+            route: dict(summarize(durations), errors=timer.errors[route])
+            for route, durations in sorted(timer.durations.items())
+        },
+        "agents": {},
+    }
+    for agent, calls in sorted(recorder.calls.items()):
+        report["agents"][agent] = dict(
+            summarize([c[0] for c in calls]),
+            avg_prompt_bytes=round(sum(c[1] for c in calls) / len(calls)),
+            max_prompt_bytes=max(c[1] for c in calls),
+            avg_response_bytes=round(sum(c[2] for c in calls) / len(calls)),
+            retries=metrics.AGENT_RETRIES.value(agent=agent),
+            hedges=metrics.AGENT_HEDGES.value(agent=agent),
+            timeouts=metrics.AGENT_TIMEOUTS.value(agent=agent),
+        )
+    report["circuit_breaker"] = core.agent_caller.stats()
+    report["startup"] = {model_backend: measure_startup(model_backend) for model_backend in ("fake", "gemini")}
+    return report
+
+
+def print_report(report):
+    print(f"\n=== Benchmark: {report['sessions']} sessions, concurrency {report['concurrency']} ===")
+    print(f"Wall time: {report['wall_time_s']}s | "
+          f"{report['throughput']['sessions_per_s']} sessions/s | "
+          f"{report['throughput']['requests_per_s']} requests/s")
+
+    header = f"{'':38} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    for model_backend, startup in report["startup"].items():
+        if "error" in startup:
+            print(f"Startup ({model_backend}): failed, {startup['error']}")
+        else:
+            print(f"Startup ({model_backend}): {startup['import_s'] * 1000:.0f} ms to import the app, "
+                  f"{startup['max_rss_mb']} MB peak memory")
+
+    print("\n" + header)
+    e2e = report["end_to_end"]
+    print(f"{'End-to-end session':38} {e2e['count']:>6} {e2e['p50_ms']:>9} {e2e['p95_ms']:>9} {e2e['p99_ms']:>9}")
+    for route, stats in report["routes"].items():
+        errors = f"  ({stats['errors']} errors)" if stats["errors"] else ""
+        print(f"{route:38} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}{errors}")
+
+    print("\n" + header + f" {'avg prompt B':>13} {'max prompt B':>13}")
+    for agent, stats in report["agents"].items():
+        print(f"{agent:38} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}"
+              f" {stats['avg_prompt_bytes']:>13} {stats['max_prompt_bytes']:>13}")
+
+    guarded = {agent: stats for agent, stats in report["agents"].items()
+               if stats["retries"] or stats["hedges"] or stats["timeouts"]}
+    if guarded:
+        print(f"\n{'':38} {'retries':>9} {'hedges':>9} {'timeouts':>9}")
+        for agent, stats in guarded.items():
+            print(f"{agent:38} {stats['retries']:>9g} {stats['hedges']:>9g} {stats['timeouts']:>9g}")
+    breaker = report["circuit_breaker"]
+    if breaker["circuit_rejected"] or breaker["retry_budget_exhausted"]:
+        print(f"Circuit breaker: {breaker['circuit_state']}, {breaker['circuit_rejected']} calls rejected; "
+              f"{breaker['retry_budget_exhausted']} retries skipped by the retry budget")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency benchmark for the recipe agent pipeline.")
+    parser.add_argument("--sessions", type=int, default=20, help="Number of simulated user sessions.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Sessions running at the same time.")
+    parser.add_argument("--latency-ms", type=float, default=100, help="Fake model latency per call.")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="Extra random latency per call (0 to N).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake model's jitter.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of fake model calls that fail.")
+    parser.add_argument("--slow-rate", type=float, default=0, help="Fraction of fake model calls that are slow.")
+    parser.add_argument("--slow-ms", type=float, default=2000, help="Extra latency of a slow call.")
+    parser.add_argument("--hedge", action="store_true", help="Turn on hedged agent calls (AGENT_HEDGING=1).")
+    parser.add_argument("--warm-cache", action="store_true", help="Reuse the same request so caches can hit.")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own log output.")
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    os.environ["MODEL_BACKEND"] = "fake"
+    os.environ["FAKE_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_JITTER_MS"] = str(args.jitter_ms)
+    os.environ["FAKE_SEED"] = str(args.seed)
+    os.environ["FAKE_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_SLOW_RATE"] = str(args.slow_rate)
+    os.environ["FAKE_SLOW_MS"] = str(args.slow_ms)
+    if args.hedge:
+        os.environ["AGENT_HEDGING"] = "1"
+    os.environ["REQUEST_LOG_PATH"] = ""  # Keep benchmark traffic out of the request log
+
+    # The app prints a line per agent call; keep that out of the report unless asked for
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        report = run_benchmark(args.sessions, args.concurrency, args.warm_cache)
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
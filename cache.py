@@ -0,0 +1,140 @@
+# cache.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_hash(*parts):
+    """
+    Returns a stable sha256 hex digest for a sequence of strings.
+    Used to build content-addressed cache keys (e.g. from a filled prompt).
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b"\x00")  # Separator so ("ab", "c") != ("a", "bc")
+    return h.hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache with optional TTL expiry.
+
+    If disk_dir is set, every entry is also written there as a JSON file
+    (so values must be JSON-serialisable). A memory miss then falls back to
+    the disk tier, which survives restarts.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, disk_dir=None, name="cache"):
+        self.maxsize = maxsize
+        self.ttl = ttl  # Seconds, or None for no expiry
+        self.disk_dir = disk_dir
+        self.name = name
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and (time.time() - stored_at) > self.ttl
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                record = json.load(f)
+            return record["stored_at"], record["value"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, stored_at, value):
+        # Write to a temp file and rename, so readers never see a half-written entry
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"stored_at": stored_at, "value": value}, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            print(f"[{self.name}] Could not write disk entry {key}: {e}")
+
+    def _delete_disk(self, key):
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _put(self, key, stored_at, value):
+        # Caller must hold the lock
+        self._data[key] = (stored_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+
+            if self.disk_dir:
+                record = self._read_disk(key)
+                if record is not None:
+                    if not self._expired(record[0]):
+                        self._put(key, record[0], record[1])
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return record[1]
+                    self._delete_disk(key)
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        stored_at = time.time()
+        with self._lock:
+            self._put(key, stored_at, value)
+        if self.disk_dir:
+            self._write_disk(key, stored_at, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.disk_dir:
+            self._delete_disk(key)
+
+    def clear(self):
+        """Drops all in-memory entries (the disk tier, if any, is left alone)."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+            }
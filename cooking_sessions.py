@@ -0,0 +1,118 @@
+# cooking_sessions.py
+#
+# Server-side cooking sessions for Agent 7 (Chatbot). A session is created when
+# the user clicks "Let's Cook!" and stores the recipe text once. The chat is
+# kept in a ring buffer of the most recent turns; turns that fall out of it are
+# folded into a rolling summary of at most `summary_chars` characters, so the
+# Agent 7 prompt stays roughly the same size for the whole meal:
+# - Each folded turn becomes one line: its first sentence, plus every later
+#   sentence that has a number in it (quantities, temperatures, times).
+# - When the lines outgrow the limit, the oldest ones are compacted into an
+#   "Earlier:" line that keeps only their sentences with numbers. Only when that
+#   alone is over the limit are its oldest facts dropped.
+
+import re
+import secrets
+import threading
+from collections import deque
+
+from cache import LRUCache
+
+_FACT = re.compile(r"\d")
+
+
+def _sentences(text):
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s", " ".join(str(text).split())) if sentence]
+
+
+def _cut(text, limit):
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+
+def _gist(text, limit):
+    """The first sentence of `text` and every later one with a number in it, cut to at most `limit` characters."""
+    sentences = _sentences(text)
+    return _cut(" ".join(sentences[:1] + [s for s in sentences[1:] if _FACT.search(s)]), limit)
+
+
+class CookingSession:
+    """The recipe, the recent chat turns and a rolling summary of older turns."""
+
+    def __init__(self, session_id, recipe_context, max_turns=8, summary_chars=1500, line_chars=240):
+        self.id = session_id
+        self.recipe_context = recipe_context
+        self.max_turns = max_turns
+        self.summary_chars = summary_chars
+        self.line_chars = line_chars
+        self.turns = deque()  # {"role", "content"}, oldest first
+        self.summary = deque()  # One line per folded turn, oldest first
+        self.earlier = deque()  # Sentences with numbers from lines compacted out of `summary`
+        self.folded_turns = 0
+        self._lock = threading.Lock()
+
+    def add_exchange(self, question, answer):
+        """Appends one user question and the bot's answer, folding old turns into the summary."""
+        with self._lock:
+            self.turns.append({"role": "user", "content": question})
+            self.turns.append({"role": "model", "content": answer})
+            while len(self.turns) > self.max_turns:
+                turn = self.turns.popleft()
+                speaker = "User" if turn["role"] == "user" else "Bot"
+                self.summary.append(f"{speaker}: {_gist(turn['content'], self.line_chars)}")
+                self.folded_turns += 1
+            self._compact()
+
+    def _compact(self):
+        # Caller must hold the lock
+        while self.summary and self._summary_size() > self.summary_chars:
+            line = self.summary.popleft()
+            self.earlier.extend(s for s in _sentences(line.partition(": ")[2])
+                                if _FACT.search(s) and s not in self.earlier)
+        while self.earlier and self._summary_size() > self.summary_chars:
+            self.earlier.popleft()
+
+    def _summary_size(self):
+        return len(self._summary_text())
+
+    def _summary_text(self):
+        lines = list(self.summary)
+        if self.earlier:
+            lines.insert(0, "Earlier: " + " ".join(self.earlier))
+        return "\n".join(lines)
+
+    def history(self, question=None):
+        """Returns (summary_text, recent turns), with `question` appended as the newest user turn."""
+        with self._lock:
+            turns = list(self.turns)
+            summary = self._summary_text()
+        if question is not None:
+            turns.append({"role": "user", "content": question})
+        return summary, turns
+
+
+class SessionStore:
+    """
+    Cooking sessions by ID, in an LRU cache. Every lookup refreshes the
+    session's timestamp, so the cache TTL acts as an idle timeout.
+    """
+
+    def __init__(self, maxsize=1000, idle_ttl=3600, max_turns=8, summary_chars=1500):
+        self.max_turns = max_turns
+        self.summary_chars = summary_chars
+        self.sessions = LRUCache(maxsize=maxsize, ttl=idle_ttl, name="cooking_sessions")
+
+    def create(self, recipe_context):
+        session = CookingSession(secrets.token_urlsafe(16), recipe_context,
+                                 max_turns=self.max_turns, summary_chars=self.summary_chars)
+        self.sessions.set(session.id, session)
+        return session
+
+    def get(self, session_id):
+        """Returns the session, or None if it does not exist or has been idle for too long."""
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None:
+            self.sessions.set(session_id, session)  # Restart the idle timer
+        return session
+
+    def delete(self, session_id):
+        self.sessions.delete(session_id)
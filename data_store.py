@@ -0,0 +1,77 @@
+# data_store.py
+
+import csv
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+
+# One consistent view of all the user data files.
+# - texts:   {name: raw file text}      -> pasted into the AI prompts
+# - rows:    {name: [dict, ...]}        -> parsed CSV rows for the frontend / local logic
+# - version: tuple of (name, mtime, size) for every file, changes whenever any file changes
+DataSnapshot = namedtuple("DataSnapshot", ["texts", "rows", "version"])
+
+
+class DataStore:
+    """
+    In-process store for the user data CSV files.
+    Each file is read and parsed once, then served from memory until its
+    mtime or size changes on disk. Safe to share across request threads.
+    """
+
+    def __init__(self, files):
+        # files: {name: path}, e.g. {"ingredients": "ingredients.csv"}
+        self._files = dict(files)
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> (stat_key, text, rows)
+        self._snapshot = None
+
+    def _stat_key(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None  # Missing file
+
+    def _load(self, path, stat_key):
+        if stat_key is None:
+            return ("", [])
+        try:
+            started = time.perf_counter()
+            with open(path, mode='r', encoding='utf-8') as f:
+                text = f.read()
+            rows = [row for row in csv.DictReader(io.StringIO(text))]
+            metrics.CSV_LOAD_SECONDS.observe(time.perf_counter() - started, file=path)
+            return (text, rows)
+        except Exception as e:
+            print(f"Error reading file {path}: {e}")
+            return ("", [])
+
+    def snapshot(self):
+        """
+        Returns a DataSnapshot of all files.
+        Only files whose mtime/size changed since the last call are re-read;
+        if nothing changed, the same snapshot object is returned.
+        """
+        stat_keys = {name: self._stat_key(path) for name, path in self._files.items()}
+
+        with self._lock:
+            changed = False
+            for name, path in self._files.items():
+                entry = self._entries.get(name)
+                if entry is None or entry[0] != stat_keys[name]:
+                    text, rows = self._load(path, stat_keys[name])
+                    self._entries[name] = (stat_keys[name], text, rows)
+                    changed = True
+
+            if changed or self._snapshot is None:
+                self._snapshot = DataSnapshot(
+                    texts={name: entry[1] for name, entry in self._entries.items()},
+                    rows={name: entry[2] for name, entry in self._entries.items()},
+                    version=tuple((name, entry[0]) for name, entry in sorted(self._entries.items())),
+                )
+            return self._snapshot
@@ -0,0 +1,126 @@
+# http_cache.py
+#
+# HTTP caching and compression helpers shared by app.py and asgi.py.
+# - negotiate_encoding() / compress(): brotli if the client accepts it and the
+#   optional `brotli` package is installed, otherwise gzip.
+# - CachedBody: a response body with its ETag and compressed variants, each
+#   encoded once and reused until the underlying data changes.
+# - StaticAssets: the files in static/, re-read only when they change on disk,
+#   with content-hashed URLs (/static/script.js?v=<hash>) that can be cached
+#   forever by the browser.
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # Optional: without it, responses are only gzipped
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/javascript", "text/javascript", "text/css", "text/html",
+    "text/plain", "image/svg+xml",
+}
+
+
+def negotiate_encoding(accept_encoding):
+    """Returns "br", "gzip" or None for an Accept-Encoding header value."""
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding, best=False):
+    """Compresses `body` (bytes). `best` trades CPU for size, for bodies encoded only once."""
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else 5)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=9 if best else 6)
+    return body
+
+
+class CachedBody:
+    """A response body with a strong ETag; compressed variants are made on first use and kept."""
+
+    def __init__(self, body, mimetype, last_modified=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.last_modified = last_modified  # Unix time, or None
+        self.etag = hashlib.sha256(body).hexdigest()[:20]
+        self.compressible = mimetype in COMPRESSIBLE_TYPES and len(body) >= 256
+        self._variants = {None: body}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding):
+        """Returns (body, encoding actually used) for a negotiated encoding."""
+        if not self.compressible or encoding is None:
+            return self.body, None
+        with self._lock:
+            variant = self._variants.get(encoding)
+            if variant is None:
+                variant = self._variants[encoding] = compress(self.body, encoding, best=True)
+        return variant, encoding
+
+    def etag_for(self, encoding):
+        # Each encoding is a different representation, so it gets its own ETag
+        return f"{self.etag}-{encoding}" if encoding else self.etag
+
+
+class StaticAssets:
+    """
+    Serves the files of a directory from memory. A file is re-read only when
+    its mtime or size changes, and its URL carries a hash of its content.
+    """
+
+    def __init__(self, folder, url_prefix="/static"):
+        self.folder = folder
+        self.url_prefix = url_prefix
+        self._lock = threading.Lock()
+        self._entries = {}  # filename -> (stat_key, CachedBody, version)
+
+    def get(self, filename):
+        """Returns (CachedBody, version) for a file, or None if it does not exist."""
+        path = safe_join(self.folder, filename)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        stat_key = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == stat_key:
+                return entry[1], entry[2]
+        with open(path, "rb") as f:
+            body = f.read()
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        cached = CachedBody(body, mimetype, last_modified=st.st_mtime)
+        version = cached.etag[:12]
+        with self._lock:
+            self._entries[filename] = (stat_key, cached, version)
+        return cached, version
+
+    def url(self, filename):
+        """The versioned URL of a static file, e.g. /static/script.js?v=1a2b3c4d5e6f."""
+        found = self.get(filename)
+        if found is None:
+            return f"{self.url_prefix}/{filename}"
+        return f"{self.url_prefix}/{filename}?v={found[1]}"
@@ -0,0 +1,54 @@
+# json_repair.py
+#
+# Tolerant extraction of JSON from model output. Models often return
+# near-JSON: wrapped in ```json fences, with a sentence before or after it,
+# with trailing commas, "smart" quotes or Python literals. extract_json()
+# fixes those cases locally, so they don't cost another model call.
+
+import json
+import re
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([\]}])")
+_PYTHON_LITERALS = re.compile(r"(?<![\"\w])(True|False|None)(?![\"\w])")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+
+def _outermost(text):
+    """The text from the first '[' or '{' to its last matching closing bracket, or None."""
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+    end = text.rfind("]" if text[start] == "[" else "}")
+    return text[start:end + 1] if end > start else None
+
+
+def _repair(text):
+    text = text.translate(_SMART_QUOTES)
+    text = _TRAILING_COMMA.sub(r"\1", text)
+    return _PYTHON_LITERALS.sub(lambda m: {"True": "true", "False": "false", "None": "null"}[m.group(1)], text)
+
+
+def extract_json(text):
+    """
+    Parses the JSON value in a model response, repairing common near-JSON
+    mistakes. Raises json.JSONDecodeError if no JSON can be recovered.
+    """
+    text = (text or "").strip()
+    candidates = [text]
+    fenced = _FENCE.search(text)
+    if fenced:
+        candidates.append(fenced.group(1).strip())
+    outermost = _outermost(text)
+    if outermost:
+        candidates.append(outermost)
+
+    error = None
+    for candidate in candidates:
+        for attempt in (candidate, _repair(candidate)):
+            try:
+                return json.loads(attempt)
+            except json.JSONDecodeError as e:
+                error = error or e
+    raise error
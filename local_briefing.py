@@ -0,0 +1,213 @@
+# local_briefing.py
+#
+# Local, rule-based replacement for Agent 1 (Strategist).
+# Builds the same "User Profile Briefing" sections as AGENT_1_PROMPT_TEMPLATE's
+# <FORMAT> directly from the parsed CSVs, following the prompt's <PROCESS>:
+# today's calendar row, hard vs soft rules, ranked ingredients, and conflict
+# resolution (e.g. the stricter time limit wins).
+#
+# Free-text user input is only handled locally when every clause of it is a
+# simple, recognised constraint ("under 15 minutes", "no onions", "vegetarian").
+# Anything else returns None, and the caller falls back to the model.
+
+import re
+
+from prompt_context import active_rules, profile_date, rank_ingredients, select_calendar_row
+
+_TIME_LIMIT = re.compile(
+    r"^(?:in|under|within|less than|max(?:imum)?|at most)?\s*(\d{1,3})\s*(?:min|mins|minutes)(?: max| or less)?$"
+)
+_EXCLUSION = re.compile(r"^(?:no|without|avoid|nothing with)\s+([a-z][a-z _-]{1,40})$")
+_DIETS = {
+    "vegetarian": "Vegetarian (no meat or fish).",
+    "vegan": "Vegan (no animal products).",
+    "pescatarian": "Pescatarian (no meat except fish).",
+    "gluten free": "Gluten-free.",
+    "high protein": "High-protein.",
+    "low carb": "Low-carb.",
+}
+_CLAUSE_SPLIT = re.compile(r"\s*(?:,|;|\.|\band\b|\bplease\b)\s*")
+
+
+def parse_user_input(user_input):
+    """
+    Parses simple free-text constraints. Returns a dict with "time_limit",
+    "exclusions" and "diets", or None if any part of the text is not understood.
+    """
+    parsed = {"time_limit": None, "exclusions": [], "diets": []}
+    text = (user_input or "").strip().lower()
+    for clause in _CLAUSE_SPLIT.split(text):
+        clause = clause.strip().replace("-", " ")
+        if not clause:
+            continue
+        match = _TIME_LIMIT.match(clause)
+        if match:
+            minutes = int(match.group(1))
+            parsed["time_limit"] = min(minutes, parsed["time_limit"] or minutes)
+            continue
+        match = _EXCLUSION.match(clause)
+        if match:
+            parsed["exclusions"].append(match.group(1).strip())
+            continue
+        if clause in _DIETS:
+            parsed["diets"].append(_DIETS[clause])
+            continue
+        return None
+    return parsed
+
+
+def _number(value):
+    match = re.search(r"\d+(?:\.\d+)?", str(value or ""))
+    return float(match.group()) if match else None
+
+
+def meal_windows(text):
+    """Parses e.g. '{breakfast: "08:00–09:00", dinner: "19:00–20:00"}' into [(meal, window), ...]."""
+    return re.findall(r'(\w+)\s*:\s*"([^"]*)"', text or "")
+
+
+def _meal_window(text, meal_type):
+    """Finds the time window for a meal in a calendar row's meal_windows, or None."""
+    for name, window in meal_windows(text):
+        if name.lower() == meal_type.lower():
+            return window
+    return None
+
+
+def _label(value):
+    return str(value or "").replace("_", " ").strip()
+
+
+def _join(items, empty="None.", sep="; "):
+    items = [item for item in items if item]
+    return sep.join(items) + "." if items else empty
+
+
+def resolve_time_limit(calendar_row, rules, user_limit=None):
+    """
+    Resolves the max cook time from all sources; the stricter limit wins.
+    Returns (minutes or None, explanation).
+    """
+    sources = []
+    if calendar_row:
+        available = _number(calendar_row.get("time_available_min"))
+        if available:
+            sources.append((available, "today's calendar only allows"))
+        preferred = _number(calendar_row.get("cook_time_pref"))
+        if preferred:
+            sources.append((preferred, "today's cook-time preference is"))
+    for rule in rules:
+        if rule.get("category") == "cooking_time_limit":
+            limit = _number(rule.get("description"))
+            if limit:
+                sources.append((limit, "the time rule prefers under"))
+    if user_limit:
+        sources.append((float(user_limit), "the request asks for"))
+
+    if not sources:
+        return None, "No time limit."
+    minutes, reason = min(sources, key=lambda source: source[0])
+    others = sorted({int(m) for m, _ in sources if m != minutes})
+    explanation = f"Max cook time: {int(minutes)} mins ({reason} {int(minutes)} mins"
+    if others:
+        explanation += f"; stricter than {', '.join(str(m) for m in others)} mins from the other sources"
+    return int(minutes), explanation + ")."
+
+
+def synthesize_briefing(snapshot, meal_type, user_input="", today=None):
+    """
+    Returns the "User Profile Briefing" text built locally from the CSVs, or
+    None if the user input needs the model.
+    """
+    request = parse_user_input(user_input)
+    if request is None:
+        return None
+    if meal_type.strip().lower() == "custom" and not (user_input or "").strip():
+        return None
+
+    today = today or profile_date()
+    calendar_row = select_calendar_row(snapshot.rows["calendar"], today) or {}
+    rules = active_rules(snapshot.rows["ruleset"])
+    hard_rules = [rule for rule in rules if rule.get("enforcement", "").strip().lower() == "hard"]
+    soft_rules = [rule for rule in rules if rule not in hard_rules]
+    ingredients = rank_ingredients(snapshot.rows["ingredients"])
+
+    # --- 1. Current Goal & Context ---
+    goal = _label(calendar_row.get("goal_type")).capitalize() or "General health"
+    goal_value = calendar_row.get("goal_value")
+    timeframe = calendar_row.get("goal_timeframe_days")
+    primary_goal = goal + (f" ({goal_value} over {timeframe} days)." if goal_value and timeframe else ".")
+
+    progress = _number(calendar_row.get("goal_progress"))
+    status = f"{progress:.0%} of the way to the goal." if progress is not None else "Unknown."
+
+    strategy = _join([_label(rule.get("description")) for rule in soft_rules
+                      if rule.get("rule_type") in ("dietary", "nutritional", "health")])
+
+    time_limit, time_text = resolve_time_limit(calendar_row, rules, request["time_limit"])
+    context_parts = []
+    if calendar_row.get("day") or calendar_row.get("date"):
+        context_parts.append(f"{calendar_row.get('day', '')} {calendar_row.get('date', '')}".strip())
+    if calendar_row.get("activity_level"):
+        context_parts.append(f"{_label(calendar_row['activity_level']).capitalize()} activity day")
+    if calendar_row.get("special_events"):
+        context_parts.append(f"event: {_label(calendar_row['special_events'])}")
+    window = _meal_window(calendar_row.get("meal_windows"), meal_type)
+    if window:
+        context_parts.append(f"{meal_type} window {window}")
+    if calendar_row.get("calorie_target_day"):
+        context_parts.append(f"daily calorie target {calendar_row['calorie_target_day']} kcal")
+    context_parts.append(time_text.rstrip("."))
+
+    # --- 2. Hard Constraints ---
+    allergies = [_label(rule.get("description")) for rule in hard_rules if rule.get("category") == "allergy"]
+    dietary_hard = [_label(rule.get("description")) for rule in hard_rules if rule.get("category") != "allergy"]
+    dietary_hard += [diet.rstrip(".") for diet in request["diets"]]
+    dietary_hard += [f"no {item}" for item in request["exclusions"]]
+
+    # --- 3. Soft Constraints ---
+    cuisine = [_label(rule.get("description")) for rule in soft_rules if rule.get("category") == "cuisine_preference"]
+    sustainability = [_label(rule.get("description")) for rule in soft_rules if rule.get("rule_type") == "environmental"]
+
+    # --- 4. Key Ingredient Opportunities ---
+    excluded = set(request["exclusions"])
+    must_use, opportunity, available = [], [], []
+    for item in ingredients:
+        name = item.get("ingredient_name", "")
+        if not name or _label(name) in excluded:
+            continue
+        availability = item.get("availability", "")
+        preference = _number(item.get("preference_score")) or 0
+        if availability == "in_pantry" and preference >= 0.5:
+            must_use.append(name)
+        elif "discount" in availability or preference < 0.3:
+            opportunity.append(f"{name} ({_label(availability)})")
+        else:
+            available.append(name)
+
+    goal_name = _label(calendar_row.get("goal_type")).title().replace(" ", "-") or "Health"
+    lines = [
+        f"**User Profile Briefing: The {goal_name}-Focused Student**",
+        "",
+        "**1. Current Goal & Context:**",
+        f"* **Primary Goal:** {primary_goal}",
+        f"* **Current Status:** {status}",
+        f"* **Dietary Strategy:** {strategy}",
+        f"* **Today's Context:** {'. '.join(context_parts)}.",
+        "",
+        "**2. Hard Constraints (Must-Follow Rules):**",
+        f"* **Allergies:** {_join(allergies)}",
+        f"* **Dietary (Hard):** {_join(dietary_hard)}",
+        f"* **Request:** Meal Type: {meal_type}." + (f" Custom Details: \"{user_input.strip()}\"" if (user_input or "").strip() else ""),
+        "",
+        "**3. Soft Constraints (Preferences):**",
+        f"* **Cuisine:** {_join(cuisine, 'No preference.')}",
+        f"* **Time:** " + (f"Must be ready in {time_limit} minutes or less." if time_limit else "No time limit."),
+        f"* **Sustainability:** {_join(sustainability, 'No preference.')}",
+        "",
+        "**4. Key Ingredient Opportunities:**",
+        f"* **Must Use (High Preference/Pantry):** {_join(must_use, sep=', ')}",
+        f"* **Opportunity (Discounted/Low Pref):** {_join(opportunity, sep=', ')}",
+        f"* **Available:** {_join(available, sep=', ')}",
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,329 @@
+# meal_plan.py
+#
+# Batch meal planning: every meal window of every day in the calendar is run
+# through the same pipeline as the interactive routes (briefing -> options ->
+# full recipe), so a week of plans can be precomputed instead of generated at
+# mealtime.
+# - A bounded worker pool plans meals in parallel, and a token bucket caps how
+#   many pipeline stages start per second (and so the model request rate).
+# - One data snapshot is shared by the whole job; each day only swaps in its own
+#   calendar row, so the ranked pantry, the rules and the briefing cache are reused.
+# - Every finished stage is appended to checkpoint.jsonl in the job's directory.
+#   Running the same job again skips what is already there, so an interrupted
+#   run resumes where it stopped. The result is written to plan.json.
+#
+#     python meal_plan.py --start 2025-10-06 --days 7 --workers 4 --rate 2
+#
+# The API runs the same jobs in the background (POST /api/meal-plans).
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from cache import content_hash
+from data_store import DataSnapshot
+from local_briefing import meal_windows
+from prompt_context import to_csv
+from request_log import read_entries
+
+
+def normalize_params(data):
+    """
+    Validated job parameters from an API body or the CLI: user_id, start/end
+    (ISO dates, inclusive; "days" counts from start), meals and userInput.
+    Raises ValueError for invalid values.
+    """
+    start = date.fromisoformat(data["start"]) if data.get("start") else None
+    end = date.fromisoformat(data["end"]) if data.get("end") else None
+    if data.get("days"):
+        if start is None:
+            raise ValueError("days needs a start date")
+        days = int(data["days"])
+        if days < 1:
+            raise ValueError("days must be at least 1")
+        end = start + timedelta(days=days - 1)
+    if start and end and end < start:
+        raise ValueError("end is before start")
+    meals = data.get("meals") or []
+    if isinstance(meals, str):
+        meals = meals.split(",")
+    return {
+        "user_id": data.get("user_id") or None,
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "meals": sorted({str(meal).strip().lower() for meal in meals if str(meal).strip()}),
+        "userInput": str(data.get("userInput") or "").strip(),
+    }
+
+
+def job_id(params):
+    """Jobs are named after their parameters, so the same plan always maps to the same directory."""
+    return content_hash(json.dumps(params, sort_keys=True))[:16]
+
+
+def plan_items(calendar_rows, start=None, end=None, meals=None):
+    """
+    The meals to plan, in date order: one item per meal window of every
+    calendar row from `start` to `end` (ISO dates, inclusive), limited to `meals` if given.
+    """
+    items = []
+    for row in sorted(calendar_rows, key=lambda row: row.get("date", "")):
+        day = row.get("date", "")
+        try:
+            date.fromisoformat(day)
+        except ValueError:
+            continue
+        if (start and day < start) or (end and day > end):
+            continue
+        for meal_type, window in meal_windows(row.get("meal_windows")):
+            if meals and meal_type.lower() not in meals:
+                continue
+            items.append({
+                "key": f"{day}|{meal_type}",
+                "date": day,
+                "day": row.get("day", ""),
+                "meal_type": meal_type,
+                "window": window,
+                "calendar_row": row,
+            })
+    return items
+
+
+def day_snapshot(snapshot, calendar_row):
+    """The shared snapshot with only one day's calendar row, so every prompt plans that day."""
+    return DataSnapshot(
+        texts=dict(snapshot.texts, calendar=to_csv([calendar_row], list(calendar_row))),
+        rows=dict(snapshot.rows, calendar=[calendar_row]),
+        version=tuple(snapshot.version) + (("calendar_day", calendar_row.get("date")),),
+    )
+
+
+class RateLimiter:
+    """Token bucket: acquire() blocks until the next start is allowed. A rate of 0 means no limit."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate  # Starts per second
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until it is available. Returns the seconds waited."""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now; callers that arrive later queue up behind it
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Checkpoint:
+    """
+    Append-only record of finished stages, one {"key", "stage", "data"} JSON
+    line each. Torn lines from an interrupted run are ignored when loading.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = defaultdict(dict)  # key -> {stage: data}
+        for entry in read_entries(path):
+            if isinstance(entry, dict) and "key" in entry and "stage" in entry:
+                self.done[entry["key"]][entry["stage"]] = entry.get("data")
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # End the torn line, so new entries start on their own
+
+    def save(self, key, stage, data):
+        line = json.dumps({"key": key, "stage": stage, "data": data}, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.done[key][stage] = data
+
+
+def write_json(path, data):
+    """Writes a JSON file atomically, so readers never see a partial plan."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def run_meal_plan(plan_meal, snapshot, items, output_dir, workers=4, rate=0, user_input="", progress=None):
+    """
+    Plans every item and writes plan.json to `output_dir`. `plan_meal` is
+    app.plan_meal; `progress(planned, failed, total)` is called as meals finish.
+    Returns a summary with the counts and the path of the plan.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(output_dir, "checkpoint.jsonl"))
+    limiter = RateLimiter(rate)
+    lock = threading.Lock()
+    counts = {"planned": 0, "failed": 0, "resumed": 0}
+    if progress:
+        progress(0, 0, len(items))
+
+    def run(item):
+        key = item["key"]
+        state = dict(checkpoint.done.get(key, {}))
+        try:
+            meal = plan_meal(day_snapshot(snapshot, item["calendar_row"]), item["meal_type"], user_input, state,
+                             lambda stage, data: checkpoint.save(key, stage, data), limiter.acquire)
+            failed = False
+        except Exception as e:
+            print(f"--- Meal plan: {key} failed: {e} ---")
+            meal = {"error": str(e)}
+            failed = True
+        with lock:
+            counts["failed" if failed else "planned"] += 1
+            if "recipe" in state:
+                counts["resumed"] += 1
+            if progress:
+                progress(counts["planned"], counts["failed"], len(items))
+        return meal
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="meal-plan") as pool:
+        meals = list(pool.map(run, items))
+
+    days = {}
+    for item, meal in zip(items, meals):
+        day = days.setdefault(item["date"], {"date": item["date"], "day": item["day"], "meals": []})
+        day["meals"].append(dict({"meal_type": item["meal_type"], "window": item["window"]}, **meal))
+    path = os.path.join(output_dir, "plan.json")
+    write_json(path, {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "data_version": repr(snapshot.version),
+        "days": list(days.values()),
+    })
+    return dict(counts, total=len(items), seconds=round(time.perf_counter() - started, 3), path=path)
+
+
+class MealPlanJobs:
+    """
+    Background meal plan jobs for the API. Jobs run one at a time, each with its
+    own worker pool. Submitting the same parameters again returns the running
+    or finished job; a job that failed, or left meals unplanned, resumes from its checkpoint.
+    """
+
+    def __init__(self, run_job, directory):
+        self._run_job = run_job  # Called as run_job(params, output_dir, progress), returns the summary
+        self.directory = directory
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="meal-plan-jobs")
+        self._lock = threading.Lock()
+        self._jobs = {}  # job_id -> status dict
+
+    def submit(self, params):
+        """Queues a job for `params` (see normalize_params) and returns its status."""
+        new_id = job_id(params)
+        with self._lock:
+            job = self._jobs.get(new_id)
+            if job is not None and (job["status"] in ("queued", "running")
+                                    or (job["status"] == "done" and not job["failed"])):
+                return dict(job)
+            job = self._jobs[new_id] = {
+                "job_id": new_id, "status": "queued", "params": params,
+                "planned": 0, "failed": 0, "total": None, "error": None,
+            }
+            status = dict(job)
+        self._executor.submit(self._run, new_id)
+        return status
+
+    def _run(self, current_id):
+        with self._lock:
+            job = self._jobs[current_id]
+            job["status"] = "running"
+
+        def progress(planned, failed, total):
+            with self._lock:
+                job.update(planned=planned, failed=failed, total=total)
+
+        try:
+            summary = self._run_job(job["params"], os.path.join(self.directory, current_id), progress)
+            with self._lock:
+                job.update(status="done", planned=summary["planned"], failed=summary["failed"],
+                           total=summary["total"], seconds=summary["seconds"])
+        except Exception as e:
+            print(f"--- Meal plan job {current_id} failed: {e} ---")
+            with self._lock:
+                job.update(status="failed", error=str(e))
+
+    def status(self, current_id):
+        """The job's status, or None if it is unknown. Plans finished before a restart are found on disk."""
+        if not current_id.isalnum():
+            return None  # Not an ID this class made; never look outside the directory
+        with self._lock:
+            job = self._jobs.get(current_id)
+            if job is not None:
+                return dict(job)
+        if os.path.exists(self.plan_path(current_id)):
+            return {"job_id": current_id, "status": "done"}
+        return None
+
+    def plan_path(self, current_id):
+        return os.path.join(self.directory, current_id, "plan.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan every meal window in the calendar and write the plans to disk.")
+    parser.add_argument("--start", help="First day to plan (YYYY-MM-DD, default: the first calendar day).")
+    parser.add_argument("--end", help="Last day to plan (YYYY-MM-DD, default: the last calendar day).")
+    parser.add_argument("--days", type=int, help="Number of days to plan from --start (instead of --end).")
+    parser.add_argument("--meals", help="Comma-separated meal types to plan (default: every meal window).")
+    parser.add_argument("--note", default="", help="Extra request for every meal, e.g. 'no onions'.")
+    parser.add_argument("--user", help="User to plan for (with PROFILE_DB).")
+    parser.add_argument("--workers", type=int, help="Meals planned at once (default: MEAL_PLAN_WORKERS).")
+    parser.add_argument("--rate", type=float, help="Max pipeline stages started per second (default: MEAL_PLAN_RATE).")
+    parser.add_argument("--out", help="Output directory (default: MEAL_PLAN_DIR/<job id>, shared with the API).")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own log output.")
+    args = parser.parse_args()
+
+    try:
+        params = normalize_params({
+            "user_id": args.user, "start": args.start, "end": args.end, "days": args.days,
+            "meals": args.meals, "userInput": args.note,
+        })
+    except ValueError as e:
+        parser.error(str(e))
+
+    def progress(planned, failed, total):
+        print(f"Planned {planned}/{total} meals" + (f" ({failed} failed)" if failed else ""), file=sys.stderr)
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        # Imported here so the app's log output is captured with the rest
+        import app as core
+
+        output_dir = args.out or os.path.join(core.MEAL_PLAN_DIR, job_id(params))
+        workers = args.workers if args.workers is not None else core.MEAL_PLAN_WORKERS
+        rate = args.rate if args.rate is not None else core.MEAL_PLAN_RATE
+        try:
+            summary = core.run_meal_plan_job(params, output_dir, progress, workers=workers, rate=rate)
+        except ValueError as e:
+            parser.error(str(e))
+    print(f"Planned {summary['planned']} of {summary['total']} meals in {summary['seconds']}s "
+          f"({summary['resumed']} from the checkpoint, {summary['failed']} failed). Plan written to {summary['path']}")
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
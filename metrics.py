@@ -0,0 +1,274 @@
+# metrics.py
+#
+# Small, dependency-free metrics registry that renders the Prometheus text
+# exposition format (served on /metrics by app.py).
+
+import threading
+
+DEFAULT_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+DEFAULT_SIZE_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> float
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _format_labels(zip(self.labelnames, key))
+                lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_SECONDS_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                base = list(zip(self.labelnames, key))
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = _format_labels(base + [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                lines.append(f"{self.name}_sum{_format_labels(base)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(base)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_SECONDS_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """
+        Registers a function that is called on every scrape and returns a list of
+        (name, type, help, [(labels_dict, value), ...]) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        grouped = {}  # Collected samples may come from several collectors
+        for collect in collectors:
+            for name, metric_type, help_text, samples in collect():
+                grouped.setdefault(name, (metric_type, help_text, []))[2].extend(samples)
+        for name, (metric_type, help_text, samples) in grouped.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# --- Hot-path metrics ---
+AGENT_CALL_SECONDS = REGISTRY.histogram(
+    "recipe_agent_call_seconds", "Wall time of agent calls.", ["agent"])
+AGENT_FIRST_CHUNK_SECONDS = REGISTRY.histogram(
+    "recipe_agent_first_chunk_seconds", "Time to the first streamed chunk of an agent call.", ["agent"])
+AGENT_CALLS = REGISTRY.counter(
+    "recipe_agent_calls_total", "Agent calls by outcome.", ["agent", "status"])
+AGENT_PROMPT_CHARS = REGISTRY.histogram(
+    "recipe_agent_prompt_chars", "Prompt size of agent calls in characters.", ["agent"], DEFAULT_SIZE_BUCKETS)
+AGENT_RESPONSE_CHARS = REGISTRY.histogram(
+    "recipe_agent_response_chars", "Response size of agent calls in characters.", ["agent"], DEFAULT_SIZE_BUCKETS)
+AGENT_TOKENS = REGISTRY.counter(
+    "recipe_agent_tokens_total", "Tokens reported by the model's usage metadata.", ["agent", "kind"])
+JSON_PARSE_FAILURES = REGISTRY.counter(
+    "recipe_json_parse_failures_total", "Agent responses that could not be parsed as JSON.", ["agent"])
+PROMPT_BYTES = REGISTRY.counter(
+    "recipe_prompt_bytes_total", "Prompt bytes before (raw) and after (compact) CSV compaction.", ["agent", "stage"])
+CSV_LOAD_SECONDS = REGISTRY.histogram(
+    "recipe_csv_load_seconds", "Time to read and parse a user data CSV file.", ["file"])
+BRIEFING_SOURCE = REGISTRY.counter(
+    "recipe_briefing_source_total", "User profile briefings by where they came from.", ["source"])
+RECIPE_VALIDATIONS = REGISTRY.counter(
+    "recipe_validator_verdicts_total", "Local recipe validator verdicts (pass skips Agent 5).", ["verdict"])
+MARKDOWN_RENDER_SECONDS = REGISTRY.histogram(
+    "recipe_markdown_render_seconds", "Time to render recipe markdown to HTML.")
+AGENT_RETRIES = REGISTRY.counter(
+    "recipe_agent_retries_total", "Agent call attempts retried after a retryable error.", ["agent"])
+AGENT_HEDGES = REGISTRY.counter(
+    "recipe_agent_hedges_total", "Duplicate agent calls sent because the first ran past the p95 latency.", ["agent"])
+AGENT_TIMEOUTS = REGISTRY.counter(
+    "recipe_agent_timeouts_total", "Agent call attempts that ran past their deadline.", ["agent"])
+
+
+def record_agent_call(agent, prompt, response, seconds, first_chunk_seconds=None):
+    """Records one agent call. `response` is None if the call failed."""
+    AGENT_CALL_SECONDS.observe(seconds, agent=agent)
+    AGENT_PROMPT_CHARS.observe(len(prompt), agent=agent)
+    if first_chunk_seconds is not None:
+        AGENT_FIRST_CHUNK_SECONDS.observe(first_chunk_seconds, agent=agent)
+    if response is None:
+        AGENT_CALLS.inc(agent=agent, status="error")
+    else:
+        AGENT_CALLS.inc(agent=agent, status="ok")
+        AGENT_RESPONSE_CHARS.observe(len(response), agent=agent)
+
+
+def record_usage(agent, prompt_tokens=0, response_tokens=0, total_tokens=0):
+    """Records token usage as reported by the model."""
+    AGENT_TOKENS.inc(prompt_tokens or 0, agent=agent, kind="prompt")
+    AGENT_TOKENS.inc(response_tokens or 0, agent=agent, kind="response")
+    AGENT_TOKENS.inc(total_tokens or 0, agent=agent, kind="total")
+
+
+def register_cache(cache):
+    """Exposes an LRUCache's hit/miss/eviction counters and size on every scrape."""
+    def collect():
+        stats = cache.stats()
+        labels = {"cache": stats["name"]}
+        return [
+            ("recipe_cache_requests_total", "counter", "Cache lookups by result.", [
+                (dict(labels, result="hit"), stats["hits"]),
+                (dict(labels, result="miss"), stats["misses"]),
+            ]),
+            ("recipe_cache_disk_hits_total", "counter", "Cache hits served from the disk tier.", [
+                (labels, stats["disk_hits"]),
+            ]),
+            ("recipe_cache_evictions_total", "counter", "Entries evicted from the cache.", [
+                (labels, stats["evictions"]),
+            ]),
+            ("recipe_cache_entries", "gauge", "Entries currently in the cache.", [
+                (labels, stats["size"]),
+            ]),
+        ]
+    REGISTRY.add_collector(collect)
+
+
+def register_request_log(request_log):
+    """Exposes the request log writer's counters on every scrape."""
+    def collect():
+        stats = request_log.stats()
+        return [
+            ("recipe_request_log_entries_total", "counter", "Request log entries by outcome.", [
+                ({"result": "written"}, stats["written"]),
+                ({"result": "dropped"}, stats["dropped"]),
+            ]),
+            ("recipe_request_log_rotations_total", "counter", "Request log file rotations.", [
+                ({}, stats["rotations"]),
+            ]),
+            ("recipe_request_log_queued", "gauge", "Entries waiting for the request log writer.", [
+                ({}, stats["queued"]),
+            ]),
+        ]
+    REGISTRY.add_collector(collect)
+
+
+def register_single_flight(flights):
+    """Exposes how many agent calls were coalesced by a SingleFlight on every scrape."""
+    def collect():
+        stats = flights.stats()
+        return [
+            ("recipe_single_flight_calls_total", "counter",
+             "Agent calls by whether they made the model call (leader) or shared one in flight.", [
+                ({"flight": stats["name"], "result": "leader"}, stats["leaders"]),
+                ({"flight": stats["name"], "result": "shared"}, stats["shared"]),
+                ({"flight": stats["name"], "result": "timeout"}, stats["timeouts"]),
+            ]),
+            ("recipe_single_flight_in_flight", "gauge", "Distinct agent calls in flight.", [
+                ({"flight": stats["name"]}, stats["in_flight"]),
+            ]),
+        ]
+    REGISTRY.add_collector(collect)
+
+
+def register_agent_caller(caller):
+    """Exposes the circuit breaker and retry budget of a resilience.AgentCaller on every scrape."""
+    states = {"closed": 0, "half_open": 1, "open": 2}
+
+    def collect():
+        stats = caller.stats()
+        return [
+            ("recipe_circuit_breaker_state", "gauge", "Model backend circuit breaker: 0 closed, 1 half-open, 2 open.", [
+                ({}, states[stats["circuit_state"]]),
+            ]),
+            ("recipe_circuit_breaker_rejections_total", "counter", "Agent calls failed fast by the open circuit.", [
+                ({}, stats["circuit_rejected"]),
+            ]),
+            ("recipe_retry_budget_tokens", "gauge", "Retries the retry budget allows right now.", [
+                ({}, stats["retry_tokens"]),
+            ]),
+            ("recipe_retry_budget_exhausted_total", "counter", "Retries skipped because the retry budget was spent.", [
+                ({}, stats["retry_budget_exhausted"]),
+            ]),
+        ]
+    REGISTRY.add_collector(collect)
@@ -0,0 +1,398 @@
+# model_backend.py
+#
+# Every agent call in the app goes through a ModelBackend, identified by the
+# agent's key ("agent_1", "agent_2", "agent_3", "agent_5", "agent_6", "agent_7").
+# - GeminiBackend talks to the real Gemini API, through a ModelRegistry that
+#   holds each agent's model settings and builds its client on first use.
+# - FakeBackend returns deterministic canned outputs with configurable latency,
+#   so the pipeline can be run, benchmarked and load-tested offline.
+
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import metrics
+from prompts import AGENT_2_RESPONSE_SCHEMA
+
+AGENTS = {
+    "agent_1": "Agent 1 (Strategist)",
+    "agent_2": "Agent 2 (Chef Options)",
+    "agent_3": "Agent 3 (Full Recipe)",
+    "agent_5": "Agent 5 (Culinary Judge)",
+    "agent_6": "Agent 6 (Technique Coach)",
+    "agent_7": "Agent 7 (Chatbot)",
+}
+
+# Agents whose output must be JSON matching a schema (structured output)
+JSON_SCHEMAS = {
+    "agent_2": AGENT_2_RESPONSE_SCHEMA,
+}
+
+
+class TransientBackendError(Exception):
+    """A model error that is worth retrying (e.g. the service is briefly unavailable)."""
+
+
+class ModelBackend:
+    """
+    Interface for the model behind the agents.
+    Subclasses implement generate() and stream(); the async versions default
+    to running the sync ones in a worker thread. `timeout` is the number of
+    seconds the call has left (None for no limit): the model request itself
+    must give up by then, so a late call doesn't keep running after its caller has stopped waiting.
+    """
+
+    def generate(self, agent, prompt, timeout=None):
+        """Returns the full response text for `prompt`."""
+        raise NotImplementedError
+
+    def stream(self, agent, prompt, timeout=None):
+        """Yields the response text in chunks as it is generated."""
+        yield self.generate(agent, prompt, timeout)
+
+    async def agenerate(self, agent, prompt, timeout=None):
+        return await asyncio.to_thread(self.generate, agent, prompt, timeout)
+
+    async def astream(self, agent, prompt, timeout=None):
+        yield await self.agenerate(agent, prompt, timeout)
+
+
+def _request_options(timeout):
+    return {"request_options": {"timeout": timeout}} if timeout is not None else {}
+
+
+def _record_gemini_usage(agent, usage):
+    if usage is not None:
+        metrics.record_usage(
+            agent,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0),
+            response_tokens=getattr(usage, "candidates_token_count", 0),
+            total_tokens=getattr(usage, "total_token_count", 0),
+        )
+
+
+def parse_agent_settings(text, convert=str):
+    """'agent_3=60,agent_5=45' -> {"agent_3": convert("60"), "agent_5": convert("45")}"""
+    settings = {}
+    for item in text.split(","):
+        agent, _, value = item.partition("=")
+        agent, value = agent.strip(), value.strip()
+        if not agent or not value:
+            continue
+        if agent not in AGENTS:
+            raise ValueError(f"Unknown agent {agent!r} in {text!r} (expected one of {', '.join(AGENTS)})")
+        settings[agent] = convert(value)
+    return settings
+
+
+class ModelRegistry:
+    """
+    Per-agent model settings (model name, generation config) and the Gemini
+    clients built from them. The SDK is imported, configured and each agent's
+    client built on that agent's first call in the process, so startup stays
+    fast, and pre-fork servers build their clients in each worker after the fork.
+    """
+
+    def __init__(self, api_key, default_model="gemini-2.5-flash", agent_models=None, max_output_tokens=None,
+                 temperatures=None):
+        self.api_key = api_key
+        self.default_model = default_model
+        self.agent_models = dict(agent_models or {})
+        self.max_output_tokens = dict(max_output_tokens or {})
+        self.temperatures = dict(temperatures or {})
+        self._lock = threading.Lock()
+        self._genai = None
+        self._pid = None  # Process the clients were built in
+        self._models = {}
+
+    def settings(self, agent):
+        """The model name and generation config of an agent."""
+        generation_config = {}
+        if agent in JSON_SCHEMAS:
+            generation_config.update(response_mime_type="application/json", response_schema=JSON_SCHEMAS[agent])
+        if agent in self.max_output_tokens:
+            generation_config["max_output_tokens"] = self.max_output_tokens[agent]
+        if agent in self.temperatures:
+            generation_config["temperature"] = self.temperatures[agent]
+        return {"model": self.agent_models.get(agent, self.default_model), "generation_config": generation_config or None}
+
+    def _configure(self):
+        # Caller must hold the lock
+        if not self.api_key:
+            raise ValueError("GEMINI_API_KEY not found. Please set it in the .env file.")
+        import google.generativeai as genai
+
+        genai.configure(api_key=self.api_key)
+        self._genai = genai
+        self._models = {}  # Clients of a parent process are not reused after a fork
+        self._pid = os.getpid()
+
+    def model(self, agent):
+        """The GenerativeModel of an agent, built on first use in this process."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._configure()
+            model = self._models.get(agent)
+            if model is None:
+                if agent not in AGENTS:
+                    raise ValueError(f"Unknown agent {agent!r}")
+                settings = self.settings(agent)
+                model = self._genai.GenerativeModel(settings["model"], generation_config=settings["generation_config"])
+                self._models[agent] = model
+                print(f"--- Model registry: {agent} uses {settings['model']} ---")
+            return model
+
+
+class GeminiBackend(ModelBackend):
+    """
+    One google.generativeai GenerativeModel per agent, from a ModelRegistry.
+    Agents in JSON_SCHEMAS get JSON mode with their response schema.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def generate(self, agent, prompt, timeout=None):
+        response = self.registry.model(agent).generate_content(prompt, **_request_options(timeout))
+        _record_gemini_usage(agent, getattr(response, "usage_metadata", None))
+        return response.text
+
+    def stream(self, agent, prompt, timeout=None):
+        usage = None
+        for chunk in self.registry.model(agent).generate_content(prompt, stream=True, **_request_options(timeout)):
+            usage = getattr(chunk, "usage_metadata", None) or usage  # Complete on the last chunk
+            if chunk.text:
+                yield chunk.text
+        _record_gemini_usage(agent, usage)
+
+    async def agenerate(self, agent, prompt, timeout=None):
+        response = await self.registry.model(agent).generate_content_async(prompt, **_request_options(timeout))
+        _record_gemini_usage(agent, getattr(response, "usage_metadata", None))
+        return response.text
+
+    async def astream(self, agent, prompt, timeout=None):
+        usage = None
+        response = await self.registry.model(agent).generate_content_async(
+            prompt, stream=True, **_request_options(timeout))
+        async for chunk in response:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            if chunk.text:
+                yield chunk.text
+        _record_gemini_usage(agent, usage)
+
+
+# --- Offline Fake ---
+FAKE_BRIEFING = """**User Profile Briefing: Alex, the Fitness-Focused Student**
+
+**1. Current Goal & Context:**
+* **Primary Goal:** Weight loss (-2kg over 14 days).
+* **Current Status:** Slightly behind on 14-day goal.
+* **Dietary Strategy:** High-protein, low sugar.
+* **Today's Context:** High activity day. Needs a quick, high-protein meal. Max cook time: 25 mins.
+
+**2. Hard Constraints (Must-Follow Rules):**
+* **Allergies:** Peanuts, Dairy.
+* **Dietary (Hard):** No pork, no alcohol.
+* **Request:** Meal Type: {meal_type}.
+
+**3. Soft Constraints (Preferences):**
+* **Time:** Prefers recipes under 25 minutes.
+
+**4. Key Ingredient Opportunities:**
+* **Must Use (High Preference/Pantry):** chicken_breast, broccoli, brown_rice.
+* **Available:** garlic, soy_sauce, olive_oil.
+"""
+
+FAKE_OPTIONS = [
+    ("Honey-Garlic Chicken Stir-Fry", ["chicken_breast", "broccoli", "garlic"], "20 mins"),
+    ("Lemon-Herb Salmon & Quinoa", ["salmon", "quinoa", "lemon"], "25 mins"),
+    ("Tofu & Veggie Brown Rice Bowl", ["tofu", "brown_rice", "zucchini"], "20 mins"),
+    ("Garlic Chicken Quinoa Salad", ["chicken_breast", "quinoa", "garlic"], "15 mins"),
+]
+
+FAKE_RECIPE = """Dish name: {dish}
+Description: A quick, high-protein dish made with pantry staples.
+
+Quantified Ingredients (per serving)
+| Ingredient | Quantity | Notes (e.g., "chopped", "optional") |
+|------------|----------|-------------------------------------|
+| chicken_breast | 150g | diced |
+| broccoli | 100g | cut into florets |
+| garlic | 2 cloves | minced |
+| soy_sauce | 1 tbsp | |
+
+Instructions
+| step no | instructions |
+|---------|--------------|
+| 1 | Heat a pan over medium-high heat with a little oil. |
+| 2 | Sear the chicken for 5-6 minutes until cooked through. |
+| 3 | Add the garlic and broccoli and stir-fry for 3 minutes. |
+| 4 | Add the soy sauce, toss to coat and serve. |
+
+Nutrition count (numeric data, per servin)
+| Nutrient | Amount |
+|----------|--------|
+| Calories | 420 kcal |
+| Protein | 42g |
+| Fat | 12g |
+| Carbs | 20g |
+"""
+
+
+class FakeBackend(ModelBackend):
+    """
+    Deterministic offline stand-in for the model.
+
+    Each call sleeps for `latency` seconds (per agent, or a single default)
+    plus a uniform random jitter in [0, jitter), drawn from a seeded RNG, and
+    then returns a canned output shaped like the real agent's output.
+
+    Faults can be injected, also from the seeded RNG: `error_rate` of the calls
+    raise TransientBackendError (after their latency), and `slow_rate` of them
+    take `slow_latency` seconds longer (tail latency). A call given a `timeout`
+    shorter than its latency raises TimeoutError at the timeout, like a real client.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0, agent_latency=None, chunk_size=80,
+                 error_rate=0.0, slow_rate=0.0, slow_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.agent_latency = dict(agent_latency or {})
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def _delay(self, agent):
+        with self._rng_lock:
+            extra = self._rng.uniform(0, self.jitter) if self.jitter else 0.0
+            if self.slow_rate and self._rng.random() < self.slow_rate:
+                extra += self.slow_latency
+        return self.agent_latency.get(agent, self.latency) + extra
+
+    def _sleep(self, seconds, timeout):
+        if timeout is not None and seconds > timeout:
+            time.sleep(max(timeout, 0))
+            raise TimeoutError(f"The fake model did not answer within {timeout:.2f}s.")
+        time.sleep(seconds)
+
+    async def _asleep(self, seconds, timeout):
+        if timeout is not None and seconds > timeout:
+            await asyncio.sleep(max(timeout, 0))
+            raise TimeoutError(f"The fake model did not answer within {timeout:.2f}s.")
+        await asyncio.sleep(seconds)
+
+    def _fault(self, agent):
+        """Raises an injected TransientBackendError for `error_rate` of the calls."""
+        with self._rng_lock:
+            failed = bool(self.error_rate) and self._rng.random() < self.error_rate
+        if failed:
+            raise TransientBackendError(f"Injected fault: the fake model is unavailable ({agent}).")
+
+    def respond(self, agent, prompt):
+        """Returns the canned output for an agent, derived from its prompt."""
+        text = self._canned(agent, prompt)
+        # Rough usage estimate (~4 characters per token) so token metrics work offline too
+        metrics.record_usage(agent, len(prompt) // 4, len(text) // 4, (len(prompt) + len(text)) // 4)
+        return text
+
+    def _canned(self, agent, prompt):
+        if agent == "agent_1":
+            match = re.search(r"- Meal Type: (.*)", prompt)
+            return FAKE_BRIEFING.format(meal_type=match.group(1).strip() if match else "Dinner")
+        if agent == "agent_2":
+            return json.dumps([
+                {
+                    "title": title,
+                    "summary": f"A simple {title.lower()} for a busy day.",
+                    "why_perfect": "Quick, high-protein and uses what you already have.",
+                    "main_ingredients": ingredients,
+                    "estimated_cook_time": cook_time,
+                    "tags": ["High Protein", "Quick"],
+                }
+                for title, ingredients, cook_time in FAKE_OPTIONS
+            ], indent=2)
+        if agent == "agent_3":
+            match = re.search(r"^Dish name: (.*)$", prompt, re.MULTILINE)
+            return FAKE_RECIPE.format(dish=match.group(1).strip() if match else "Chef's Special")
+        if agent == "agent_5":
+            # The judge approves the recipe and returns it unchanged
+            marker = "return the full, finalized recipe in the identical format.\n\n"
+            return prompt.split(marker, 1)[-1]
+        if agent == "agent_6":
+            marker = "[Instructions to Explain]\n"
+            if marker in prompt:  # Batch prompt: one explanation per step, as JSON
+                steps = json.loads(prompt.split(marker, 1)[1])
+                return json.dumps([
+                    {"step": step["step"], "explanation": f"Here is how to do step {step['step']}!\n"
+                                                          "* Get everything for this step ready before you start.\n"
+                                                          "* Use medium heat and keep things moving in the pan."}
+                    for step in steps
+                ], indent=2)
+            return ("Take it one step at a time!\n"
+                    "* Get everything for this step ready before you start.\n"
+                    "* Use medium heat and keep things moving in the pan.")
+        if agent == "agent_7":
+            return "Good question! Yes, that works fine for this step."
+        raise ValueError(f"Unknown agent: {agent}")
+
+    def generate(self, agent, prompt, timeout=None):
+        self._sleep(self._delay(agent), timeout)
+        self._fault(agent)
+        return self.respond(agent, prompt)
+
+    def stream(self, agent, prompt, timeout=None):
+        self._fault(agent)
+        text = self.respond(agent, prompt)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+        delay = self._delay(agent) / len(chunks)
+        for i, chunk in enumerate(chunks):
+            self._sleep(delay, None if timeout is None else timeout - i * delay)
+            yield chunk
+
+    async def agenerate(self, agent, prompt, timeout=None):
+        await self._asleep(self._delay(agent), timeout)
+        self._fault(agent)
+        return self.respond(agent, prompt)
+
+    async def astream(self, agent, prompt, timeout=None):
+        self._fault(agent)
+        text = self.respond(agent, prompt)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+        delay = self._delay(agent) / len(chunks)
+        for i, chunk in enumerate(chunks):
+            await self._asleep(delay, None if timeout is None else timeout - i * delay)
+            yield chunk
+
+
+def create_backend():
+    """Builds the backend selected by MODEL_BACKEND ("gemini" by default, or "fake")."""
+    kind = os.getenv("MODEL_BACKEND", "gemini").lower()
+    if kind == "fake":
+        return FakeBackend(
+            latency=float(os.getenv("FAKE_LATENCY_MS", "0")) / 1000,
+            jitter=float(os.getenv("FAKE_JITTER_MS", "0")) / 1000,
+            seed=int(os.getenv("FAKE_SEED", "0")),
+            error_rate=float(os.getenv("FAKE_ERROR_RATE", "0")),
+            slow_rate=float(os.getenv("FAKE_SLOW_RATE", "0")),
+            slow_latency=float(os.getenv("FAKE_SLOW_MS", "0")) / 1000,
+        )
+    if kind == "gemini":
+        # Nothing is imported or built here; see ModelRegistry
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            print("--- GEMINI_API_KEY is not set: agent calls will fail until it is ---")
+        return GeminiBackend(ModelRegistry(
+            api_key,
+            default_model=os.getenv("GEMINI_MODEL", "gemini-2.5-flash"),
+            agent_models=parse_agent_settings(os.getenv("AGENT_MODELS", "")),
+            max_output_tokens=parse_agent_settings(os.getenv("AGENT_MAX_OUTPUT_TOKENS", ""), int),
+            temperatures=parse_agent_settings(os.getenv("AGENT_TEMPERATURES", ""), float),
+        ))
+    raise ValueError(f"Unknown MODEL_BACKEND: {kind!r} (expected 'gemini' or 'fake')")
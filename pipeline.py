@@ -0,0 +1,152 @@
+# pipeline.py
+#
+# Lets the Flask app and the async server (asgi.py) run the same agent pipeline.
+# A route's pipeline is written once, as a generator of steps, and doesn't do
+# any I/O itself:
+#
+#     text = yield AgentCall("agent_6", prompt)          # the response text
+#     chunk = yield AgentCall("agent_3", prompt, stream=True)
+#     while chunk is not None:                           # the first chunk, then
+#         yield sse_event("progress", ...)               # anything else is an output
+#         chunk = yield NEXT_CHUNK                       # the next one (None at the end)
+#     rows = yield Blocking(load_rows, user_id)          # func(*args), kept off the event loop
+#     return 200, payload
+#
+# An error of a step is raised at its `yield`. The drivers below run the steps
+# with blocking agent calls (run/events) or awaitable ones (arun/aevents).
+
+
+class AgentCall:
+    """Step: one agent call, or a streamed one with stream=True."""
+
+    def __init__(self, agent, prompt, stream=False):
+        self.agent = agent
+        self.prompt = prompt
+        self.stream = stream
+
+
+class Blocking:
+    """Step: a blocking function call; the async server runs it in a worker thread."""
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+
+NEXT_CHUNK = object()  # Step: the next chunk of the current streamed call
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+
+# --- Blocking Driver (Flask) ---
+def _drive(steps, call, stream):
+    """Yields the outputs of `steps`, then a _Result with its return value."""
+    chunks = None
+    value, error = None, None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as done:
+                yield _Result(done.value)
+                return
+            value, error = None, None
+            try:
+                if isinstance(step, AgentCall) and step.stream:
+                    if chunks is not None:
+                        chunks.close()
+                    chunks = iter(stream(step.agent, step.prompt))
+                    value = next(chunks, None)
+                elif isinstance(step, AgentCall):
+                    value = call(step.agent, step.prompt)
+                elif step is NEXT_CHUNK:
+                    value = next(chunks, None)
+                elif isinstance(step, Blocking):
+                    value = step.func(*step.args)
+                else:
+                    yield step
+            except Exception as e:
+                error = e
+    finally:
+        if chunks is not None and hasattr(chunks, "close"):
+            chunks.close()
+        steps.close()
+
+
+def run(steps, call, stream=None):
+    """Runs `steps` with call(agent, prompt) -> text and stream(agent, prompt) -> chunks; returns its result."""
+    result = None
+    for output in _drive(steps, call, stream):
+        if isinstance(output, _Result):
+            result = output.value
+    return result
+
+
+def events(steps, call, stream=None):
+    """Like run(), but yields the outputs of `steps` (e.g. SSE events) as they are produced."""
+    for output in _drive(steps, call, stream):
+        if not isinstance(output, _Result):
+            yield output
+
+
+# --- Async Driver (asgi.py) ---
+async def _adrive(steps, call, stream, blocking):
+    chunks = None
+    value, error = None, None
+    try:
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as done:
+                yield _Result(done.value)
+                return
+            value, error = None, None
+            try:
+                if isinstance(step, AgentCall) and step.stream:
+                    if chunks is not None:
+                        await chunks.aclose()
+                    chunks = stream(step.agent, step.prompt)
+                    value = await _anext(chunks)
+                elif isinstance(step, AgentCall):
+                    value = await call(step.agent, step.prompt)
+                elif step is NEXT_CHUNK:
+                    value = await _anext(chunks)
+                elif isinstance(step, Blocking):
+                    value = await blocking(step.func, *step.args)
+                else:
+                    yield step
+            except Exception as e:
+                error = e
+    finally:
+        if chunks is not None:
+            await chunks.aclose()
+        steps.close()
+
+
+async def _anext(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def arun(steps, call, stream, blocking):
+    """
+    Runs `steps` with awaitable agent calls: `call` is a coroutine function,
+    stream(agent, prompt) an async generator and blocking(func, *args) runs func off the loop.
+    """
+    result = None
+    async for output in _adrive(steps, call, stream, blocking):
+        if isinstance(output, _Result):
+            result = output.value
+    return result
+
+
+async def aevents(steps, call, stream, blocking):
+    """Like arun(), but yields the outputs of `steps` as they are produced."""
+    async for output in _adrive(steps, call, stream, blocking):
+        if not isinstance(output, _Result):
+            yield output
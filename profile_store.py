@@ -0,0 +1,265 @@
+# profile_store.py
+#
+# Multi-user profile store in SQLite. Each user's ingredients, calendar and
+# ruleset (the same columns as the CSV files) live in three tables keyed by
+# user_id, indexed on (user_id, date), (user_id, active) and
+# (user_id, score, position). A snapshot runs targeted queries instead of reading
+# whole files:
+# - calendar:    today's row (or the latest earlier one)
+# - ruleset:     active rules only
+# - ingredients: the top PANTRY_LIMIT items by bias_adjusted_score x availability_score
+# so its cost does not grow with the number of users or the length of their history.
+# The CSV files remain the import/export format:
+#
+#     python profile_store.py import alice --dir .         # ingredients.csv, calendar.csv, ruleset.csv
+#     python profile_store.py export alice --dir backup/
+
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import threading
+import time
+
+from data_store import DataSnapshot
+from prompt_context import profile_date, to_csv
+
+# Columns of each CSV file, in file order
+CSV_COLUMNS = {
+    "ingredients": ["ingredient_id", "ingredient_name", "preference_score", "bias_adjusted_score",
+                    "availability", "availability_score", "last_updated"],
+    "calendar": ["date", "day", "time_available_min", "meal_windows", "activity_level", "goal_type", "goal_value",
+                 "goal_timeframe_days", "goal_progress", "calorie_target_day", "cook_time_pref", "special_events",
+                 "last_updated"],
+    "ruleset": ["rule_id", "rule_type", "category", "description", "enforcement", "priority_weight", "active",
+                "last_updated"],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ingredients (
+    user_id TEXT NOT NULL, position INTEGER NOT NULL,
+    ingredient_id TEXT, ingredient_name TEXT, preference_score TEXT, bias_adjusted_score TEXT,
+    availability TEXT, availability_score TEXT, last_updated TEXT,
+    score REAL NOT NULL  -- bias_adjusted_score x availability_score, for ranking
+);
+CREATE TABLE IF NOT EXISTS calendar (
+    user_id TEXT NOT NULL, position INTEGER NOT NULL,
+    date TEXT, day TEXT, time_available_min TEXT, meal_windows TEXT, activity_level TEXT, goal_type TEXT,
+    goal_value TEXT, goal_timeframe_days TEXT, goal_progress TEXT, calorie_target_day TEXT, cook_time_pref TEXT,
+    special_events TEXT, last_updated TEXT
+);
+CREATE TABLE IF NOT EXISTS ruleset (
+    user_id TEXT NOT NULL, position INTEGER NOT NULL,
+    rule_id TEXT, rule_type TEXT, category TEXT, description TEXT, enforcement TEXT, priority_weight TEXT,
+    active INTEGER NOT NULL, last_updated TEXT
+);
+CREATE INDEX IF NOT EXISTS calendar_user_date ON calendar (user_id, date);
+CREATE INDEX IF NOT EXISTS ruleset_user_active ON ruleset (user_id, active);
+DROP INDEX IF EXISTS ingredients_user_availability;
+CREATE INDEX IF NOT EXISTS ingredients_user_score ON ingredients (user_id, score DESC, position);
+"""
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _to_db(name, row):
+    """CSV row -> column values for the table (active as 0/1, plus the ingredient score)."""
+    values = {column: str(row.get(column) or "").strip() for column in CSV_COLUMNS[name]}
+    if name == "ruleset":
+        values["active"] = 1 if values["active"].lower() == "true" else 0
+    if name == "ingredients":
+        values["score"] = _float(values["bias_adjusted_score"]) * _float(values["availability_score"])
+    return values
+
+
+def _from_db(name, row):
+    """Table row -> CSV row (all values as strings, as csv.DictReader returns them)."""
+    values = {column: row[column] if row[column] is not None else "" for column in CSV_COLUMNS[name]}
+    if name == "ruleset":
+        values["active"] = "true" if row["active"] else "false"
+    return values
+
+
+class ProfileStore:
+    """
+    SQLite-backed user data. Safe to share across threads: every thread gets
+    its own connection, and the database runs in WAL mode so reads don't wait
+    on imports.
+    """
+
+    def __init__(self, path, pantry_limit=40):
+        self.path = path
+        self.pantry_limit = pantry_limit
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- Reads ---
+    def has_user(self, user_id):
+        return self._conn().execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def version(self, user_id):
+        """Returns (version, updated_at) of a user's data, or None if the user does not exist."""
+        row = self._conn().execute("SELECT version, updated_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return (row["version"], row["updated_at"]) if row else None
+
+    def users(self):
+        return [row["user_id"] for row in self._conn().execute("SELECT user_id FROM users ORDER BY user_id")]
+
+    def snapshot(self, user_id, today=None):
+        """
+        Returns a DataSnapshot of what the agents need for `user_id` today
+        (today's calendar row, active rules, top-ranked pantry), or None if
+        the user does not exist. texts holds the same rows as CSV.
+        """
+        today = (today or profile_date()).isoformat()
+        conn = self._conn()
+        conn.execute("BEGIN")  # One read transaction, so the three queries see the same data
+        try:
+            user = conn.execute("SELECT version FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if user is None:
+                return None
+            calendar = conn.execute(
+                "SELECT * FROM calendar WHERE user_id = ? AND date <= ? ORDER BY date DESC LIMIT 1",
+                (user_id, today)).fetchall()
+            if not calendar:
+                calendar = conn.execute(
+                    "SELECT * FROM calendar WHERE user_id = ? ORDER BY date LIMIT 1", (user_id,)).fetchall()
+            ruleset = conn.execute(
+                "SELECT * FROM ruleset WHERE user_id = ? AND active = 1 ORDER BY position", (user_id,)).fetchall()
+            ingredients = conn.execute(
+                "SELECT * FROM ingredients WHERE user_id = ? ORDER BY score DESC, position LIMIT ?",
+                (user_id, self.pantry_limit)).fetchall()
+        finally:
+            conn.execute("COMMIT")
+
+        rows = {
+            "ingredients": [_from_db("ingredients", row) for row in ingredients],
+            "calendar": [_from_db("calendar", row) for row in calendar],
+            "ruleset": [_from_db("ruleset", row) for row in ruleset],
+        }
+        return DataSnapshot(
+            texts={name: to_csv(rows[name], CSV_COLUMNS[name]) for name in rows},
+            rows=rows,
+            version=("profile", user_id, user["version"], today),
+        )
+
+    def export_rows(self, user_id):
+        """
+        Returns (rows, version, updated_at) with all of a user's rows in file
+        order, as {"ingredients": [...], "calendar": [...], "ruleset": [...]}, or None.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            user = conn.execute("SELECT version, updated_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if user is None:
+                return None
+            rows = {
+                name: [_from_db(name, row) for row in conn.execute(
+                    f"SELECT * FROM {name} WHERE user_id = ? ORDER BY position", (user_id,))]
+                for name in CSV_COLUMNS
+            }
+        finally:
+            conn.execute("COMMIT")
+        return rows, user["version"], user["updated_at"]
+
+    def export_csv(self, user_id, name):
+        """Returns one of a user's files as CSV text, or None if the user does not exist."""
+        exported = self.export_rows(user_id)
+        if exported is None:
+            return None
+        return to_csv(exported[0][name], CSV_COLUMNS[name])
+
+    # --- Writes ---
+    def import_csv(self, user_id, name, text):
+        """Replaces one of a user's files with CSV text (creating the user if needed). Returns the row count."""
+        if name not in CSV_COLUMNS:
+            raise ValueError(f"unknown file '{name}', expected one of {', '.join(CSV_COLUMNS)}")
+        rows = [_to_db(name, row) for row in csv.DictReader(io.StringIO(text))]
+        columns = list(rows[0]) if rows else []
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DELETE FROM {name} WHERE user_id = ?", (user_id,))
+            if rows:
+                placeholders = ", ".join("?" for _ in range(len(columns) + 2))
+                conn.executemany(
+                    f"INSERT INTO {name} (user_id, position, {', '.join(columns)}) VALUES ({placeholders})",
+                    [(user_id, position, *(row[column] for column in columns)) for position, row in enumerate(rows)])
+            conn.execute(
+                "INSERT INTO users (user_id, version, updated_at) VALUES (?, 1, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at",
+                (user_id, time.time()))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def import_files(self, user_id, files):
+        """Imports {name: path} CSV files for a user. Missing files are skipped."""
+        counts = {}
+        for name, path in files.items():
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    counts[name] = self.import_csv(user_id, name, f.read())
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import or export a user's CSV files in the SQLite profile store.")
+    parser.add_argument("command", choices=["import", "export", "users"])
+    parser.add_argument("user_id", nargs="?", help="User to import or export.")
+    parser.add_argument("--db", default=os.getenv("PROFILE_DB") or "profiles.db", help="SQLite database file.")
+    parser.add_argument("--dir", default=".", help="Directory with ingredients.csv, calendar.csv and ruleset.csv.")
+    args = parser.parse_args()
+
+    store = ProfileStore(args.db)
+    if args.command == "users":
+        print("\n".join(store.users()))
+        return
+    if not args.user_id:
+        parser.error("user_id is required")
+
+    files = {name: os.path.join(args.dir, f"{name}.csv") for name in CSV_COLUMNS}
+    if args.command == "import":
+        counts = store.import_files(args.user_id, files)
+        for name, count in counts.items():
+            print(f"Imported {count} rows into {name} for {args.user_id}")
+    else:
+        if not store.has_user(args.user_id):
+            parser.error(f"unknown user '{args.user_id}'")
+        os.makedirs(args.dir, exist_ok=True)
+        for name, path in files.items():
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                f.write(store.export_csv(args.user_id, name))
+            print(f"Exported {name} for {args.user_id} to {path}")
+
+
+if __name__ == "__main__":
+    main()
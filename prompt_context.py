@@ -0,0 +1,103 @@
+# prompt_context.py
+#
+# Deterministic, local compaction of the user data before it is pasted into
+# the agent prompts. The agents only need today's calendar row, the active
+# rules and a ranked pantry, so instead of the full raw CSVs they get:
+# - calendar:    today's row only (without last_updated)
+# - ruleset:     active rules only, hard rules first, without ids/bookkeeping columns
+# - ingredients: ranked by bias_adjusted_score x availability_score, with a
+#                single combined "score" column instead of the raw score columns
+
+import csv
+import io
+import os
+from datetime import date
+
+from cache import LRUCache, content_hash
+
+CALENDAR_COLUMNS = [
+    "date", "day", "time_available_min", "meal_windows", "activity_level", "goal_type", "goal_value",
+    "goal_timeframe_days", "goal_progress", "calorie_target_day", "cook_time_pref", "special_events",
+]
+RULESET_COLUMNS = ["rule_type", "category", "description", "enforcement", "priority_weight"]
+INGREDIENT_COLUMNS = ["ingredient_name", "preference_score", "availability", "score"]
+
+_compact_cache = LRUCache(maxsize=16, name="compact_context")
+
+
+def profile_date():
+    """The date treated as "today" for the profile (PROFILE_DATE=YYYY-MM-DD overrides it)."""
+    override = os.getenv("PROFILE_DATE")
+    return date.fromisoformat(override) if override else date.today()
+
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def select_calendar_row(calendar_rows, today):
+    """
+    Returns today's calendar row. If there is none, the latest row before today
+    is used, or the earliest row if the whole calendar is in the future.
+    """
+    dated = []
+    for row in calendar_rows:
+        try:
+            dated.append((date.fromisoformat(row.get("date", "")), row))
+        except ValueError:
+            continue
+    if not dated:
+        return None
+    dated.sort(key=lambda item: item[0])
+    past = [row for day, row in dated if day <= today]
+    return past[-1] if past else dated[0][1]
+
+
+def active_rules(ruleset_rows):
+    """Active rules, hard rules first, then by priority_weight (highest first)."""
+    rules = [row for row in ruleset_rows if str(row.get("active", "")).strip().lower() == "true"]
+    return sorted(rules, key=lambda row: (
+        row.get("enforcement", "").strip().lower() != "hard",
+        -_float(row.get("priority_weight")),
+    ))
+
+
+def ingredient_score(row):
+    return _float(row.get("bias_adjusted_score")) * _float(row.get("availability_score"))
+
+
+def rank_ingredients(ingredient_rows):
+    """Ingredients ranked by bias_adjusted_score x availability_score, with the product as "score"."""
+    ranked = sorted(ingredient_rows, key=ingredient_score, reverse=True)
+    return [dict(row, score=f"{ingredient_score(row):.2f}") for row in ranked]
+
+
+def to_csv(rows, columns):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore", lineterminator="\n")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+    return out.getvalue()
+
+
+def compact_context(snapshot, today=None):
+    """
+    Returns {"ingredients", "calendar", "ruleset"} compact CSV texts for a data
+    snapshot. The result is memoised per (data version, date).
+    """
+    today = today or profile_date()
+    key = content_hash(repr(snapshot.version), today.isoformat())
+    context = _compact_cache.get(key)
+    if context is None:
+        calendar_row = select_calendar_row(snapshot.rows["calendar"], today)
+        context = {
+            "ingredients": to_csv(rank_ingredients(snapshot.rows["ingredients"]), INGREDIENT_COLUMNS),
+            "calendar": to_csv([calendar_row] if calendar_row else [], CALENDAR_COLUMNS),
+            "ruleset": to_csv(active_rules(snapshot.rows["ruleset"]), RULESET_COLUMNS),
+        }
+        _compact_cache.set(key, context)
+    return context
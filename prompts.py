@@ -112,6 +112,31 @@ The JSON array must contain exactly 4 objects. Each object must have the followi
 ---
 """
 
+# JSON schema for Agent 2's output, passed to the model as its response schema
+# so the options come back as constrained JSON.
+AGENT_2_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string"},
+            "summary": {"type": "string"},
+            "why_perfect": {"type": "string"},
+            "main_ingredients": {"type": "array", "items": {"type": "string"}},
+            "estimated_cook_time": {"type": "string"},
+            "tags": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["title", "summary", "why_perfect", "main_ingredients", "estimated_cook_time", "tags"],
+    },
+}
+
+# Appended to the Agent 2 prompt when its previous answer could not be parsed
+AGENT_2_RETRY_TEMPLATE = """
+[IMPORTANT]
+Your previous answer could not be used: {{ERROR}}
+Return **only the JSON array** of exactly 4 objects in the format above, with no other text.
+"""
+
 
 # --- AGENT 3: CHEF (FULL RECIPE) PROMPT (Full Text) ---
 AGENT_3_PROMPT_TEMPLATE = """You are "Chef AI," an expert culinary assistant and creative chef.
@@ -201,13 +226,25 @@ You must follow this exact internal decision-making process:
     * If your decision is *NO, proceed to edit *only the instruction/method section of the recipe. Re-write the steps to correct all identified flaws, ensuring your new instructions are clear, logical, and culinarily sound, while respecting all constraints.
 4.  *Final Output:* Present the complete recipe—either the unchanged original or the version with the corrected method—in the identical format of the input.
 </PROCESS>
-
+{{VALIDATION_ISSUES}}
 ---
 Here is the complete recipe generated by Agent 3. Critique it, fix the method if necessary, and return the full, finalized recipe in the identical format.
 
 {{RECIPE_MARKDOWN}}
 """
 
+# Inserted into AGENT_5_PROMPT_TEMPLATE when the local validator (recipe_validator.py) found problems
+AGENT_5_VALIDATION_ISSUES_TEMPLATE = """
+<VALIDATION ISSUES>
+An automatic check found the following problems with this recipe. Your decision is therefore *NO*: fix every one of them, and make no other changes.
+•   A hard-rule violation (allergen or forbidden food) overrides the ingredient rule above: replace the offending ingredient with a safe alternative in a similar quantity, and update the instructions to match.
+•   A structure problem: complete or correct that part of the recipe in the same table format.
+•   A time problem: shorten the method (e.g. smaller pieces, higher heat, cooking things in parallel) so it fits the time available.
+
+{{VIOLATIONS}}
+</VALIDATION ISSUES>
+"""
+
 # --- AGENT 6: TECHNIQUE COACH PROMPT ---
 AGENT_6_PROMPT_TEMPLATE = """<SYSTEM>
 You are "Coach AI," a friendly and encouraging cooking instructor. You are teaching a beginner cook.
@@ -242,6 +279,48 @@ Your task is to provide a brief, step-by-step explanation of *how* to perform th
 {{INSTRUCTION_TEXT}}
 """
 
+# --- AGENT 6 (BATCH): EXPLAIN ALL STEPS AT ONCE ---
+AGENT_6_BATCH_PROMPT_TEMPLATE = """<SYSTEM>
+You are "Coach AI," a friendly and encouraging cooking instructor. You are teaching a beginner cook.
+Your goal is to explain *how* to perform each cooking step, not *why*.
+You must be concise, clear, and use simple language.
+</SYSTEM>
+
+<TASK>
+You will be given the [Full Recipe Context] (as plain text) and a JSON list of [Instructions to Explain].
+For **each** instruction, provide a brief, step-by-step explanation of *how* to perform that single instruction.
+
+**Constraints:**
+1.  **One Explanation per Instruction:** Each explanation only covers its own instruction.
+2.  **Be Concise:** Keep each explanation to 2-4 short sentences or bullet points.
+3.  **Assume Beginner Skill:** Do not use complex jargon. Explain terms like "mince" or "sauté" simply.
+4.  **Tone:** Encouraging and simple.
+</TASK>
+
+<FORMAT>
+Return **only the JSON array**. No extra commentary, markdown, or "```json" wrappers.
+The array must contain one object per instruction, in the same order, with the following keys:
+- "step": The step number exactly as given.
+- "explanation": The explanation (use "\\n* " for bullet points).
+
+[EXAMPLE of the required format]
+[
+  {
+    "step": "1",
+    "explanation": "Sautéing just means cooking quickly in a bit of hot oil!\\n* Put a little oil in your pan over medium heat.\\n* Stir the onion for 1-2 minutes until you can really smell it."
+  }
+]
+[END EXAMPLE]
+</FORMAT>
+
+---
+[Full Recipe Context]
+{{FULL_RECIPE_CONTEXT}}
+---
+[Instructions to Explain]
+{{STEPS_JSON}}
+"""
+
 # --- AGENT 7: COOKING CHATBOT PROMPT ---
 AGENT_7_PROMPT_TEMPLATE = """<SYSTEM>
 You are "Chef AI," a helpful and friendly cooking assistant.
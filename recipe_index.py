@@ -0,0 +1,226 @@
+# recipe_index.py
+#
+# Near-duplicate index of finished (judged) recipes, so a dish that is only a
+# rewording of one already generated ("Garlic Honey Chicken Stir Fry" after
+# "Honey-Garlic Chicken Stir-Fry") is served from memory instead of Agents 3 + 5.
+# - Similarity: TF-IDF weighted character 3-grams of the title plus the main
+#   ingredients, compared by cosine. Words are sorted first, so word order and
+#   punctuation don't matter.
+# - Hard constraints: a stored recipe is only served if it contains none of the
+#   food groups the request's hard rules forbid, and its steps fit the request's
+#   time limit (the same checks as recipe_validator.py, on the stored recipe).
+#   Each entry also keeps the hard constraints of the briefing it was made for
+#   (allergies, "no garlic", ...): it is only served to a briefing whose hard
+#   constraints are the same or a subset. Nothing is served while an active hard
+#   rule names no known food group, since the stored recipe can't be checked against it.
+# - Eviction: least recently served first, beyond `maxsize` or after `ttl` seconds.
+
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from cache import content_hash
+from prompt_context import active_rules, profile_date, select_calendar_row
+from recipe_parser import parse_recipe
+from recipe_validator import FOOD_GROUPS, find_group, forbidden_groups, step_minutes, unmapped_hard_rules
+
+# "Max cook time: 20 mins" in a briefing (the user's own limit, if any)
+_BRIEFING_TIME_LIMIT = re.compile(r"max(?:imum)?\s+cook(?:ing)?\s+time\D{0,20}(\d+)", re.IGNORECASE)
+# The briefing's "**2. Hard Constraints ...**" section, up to the next numbered heading
+_HARD_CONSTRAINTS = re.compile(r"hard constraints[^\n]*\n(.*?)(?=^\W*\d+\.\s|\Z)", re.IGNORECASE | re.DOTALL | re.MULTILINE)
+# "no garlic", "without onions", "avoid pork" in the request's custom details
+_EXCLUSION = re.compile(r"\b(?:no|without|avoid)\s+([a-z][a-z -]{1,40}?)(?=[,.;\"]|\band\b|$)", re.IGNORECASE)
+_NO_CONSTRAINT = {"", "none", "n a", "no", "nothing"}
+
+
+def normalize(text):
+    """Lowercase words of `text`, sorted: 'Honey-Garlic Stir_Fry' -> 'fry garlic honey stir'."""
+    return " ".join(sorted(re.findall(r"[a-z0-9]+", str(text or "").lower().replace("_", " "))))
+
+
+def ngrams(text, n=3):
+    """Character n-gram counts of normalized text, with word boundaries marked."""
+    padded = f" {normalize(text)} "
+    return Counter(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def recipe_fingerprint(recipe_markdown):
+    """The hard-constraint facts of a recipe: the food groups it uses and the minutes its steps name."""
+    recipe = parse_recipe(recipe_markdown)
+    texts = [f"{i['name']} {i['notes']}" for i in recipe["ingredients"]] + [s["instruction"] for s in recipe["steps"]]
+    groups = sorted(group for group in FOOD_GROUPS if any(find_group(text, group) for text in texts))
+    minutes = sum(step_minutes(step["instruction"]) for step in recipe["steps"])
+    return {"groups": groups, "minutes": minutes}
+
+
+def briefing_constraints(user_profile):
+    """
+    The hard constraints of a briefing as a frozenset of normalized clauses
+    ("peanuts", "garlic no", ...), or None if it has no Hard Constraints
+    section. Of the "Request" line only its exclusions count, not the meal type.
+    """
+    match = _HARD_CONSTRAINTS.search(user_profile or "")
+    if match is None:
+        return None
+    clauses = set()
+    for line in match.group(1).splitlines():
+        label, _, value = line.replace("*", "").partition(":")
+        if not value:
+            continue
+        if label.strip().lower() == "request":
+            parts = [f"no {item}" for item in _EXCLUSION.findall(value)]
+        else:
+            parts = re.split(r"[,;.]|\band\b", value)
+        clauses.update(normalize(part) for part in parts)
+    return frozenset(clauses - _NO_CONSTRAINT)
+
+
+def request_constraints(snapshot, user_profile="", today=None):
+    """
+    The hard constraints of a request: food groups forbidden by the active hard
+    rules, the active hard rules no food group covers, the briefing's own hard
+    constraints, and the stricter of today's time_available_min and a time limit named in the briefing.
+    """
+    limits = []
+    calendar_row = select_calendar_row(snapshot.rows["calendar"], today or profile_date()) or {}
+    match = re.search(r"\d+", str(calendar_row.get("time_available_min", "")))
+    if match:
+        limits.append(int(match.group()))
+    match = _BRIEFING_TIME_LIMIT.search(user_profile or "")
+    if match:
+        limits.append(int(match.group(1)))
+    rules = active_rules(snapshot.rows["ruleset"])
+    return {
+        "forbidden": forbidden_groups(rules),
+        "unmapped": unmapped_hard_rules(rules),
+        "briefing": briefing_constraints(user_profile),
+        "max_minutes": min(limits) if limits else None,
+    }
+
+
+def servable(constraints):
+    """False if no stored recipe can be checked against the request's hard constraints."""
+    return not constraints["unmapped"] and constraints["briefing"] is not None
+
+
+def compatible(entry, constraints):
+    fingerprint = entry.fingerprint
+    if entry.constraints is None or not constraints["briefing"] <= entry.constraints:
+        return False
+    if set(fingerprint["groups"]) & set(constraints["forbidden"]):
+        return False
+    max_minutes = constraints["max_minutes"]
+    return max_minutes is None or fingerprint["minutes"] <= max_minutes
+
+
+class _Entry:
+    def __init__(self, title, main_ingredients, recipe_markdown, user_profile):
+        self.title = title
+        self.recipe_markdown = recipe_markdown
+        self.fingerprint = recipe_fingerprint(recipe_markdown)
+        self.constraints = briefing_constraints(user_profile)  # What the recipe was made to respect
+        self.title_grams = ngrams(title)
+        self.full_grams = ngrams(f"{title} {' '.join(main_ingredients)}")
+        self.stored_at = time.time()
+
+
+class RecipeIndex:
+    def __init__(self, maxsize=500, ttl=None, threshold=0.85, name="recipe_index"):
+        self.maxsize = maxsize
+        self.ttl = ttl  # Seconds, or None for no expiry
+        self.threshold = threshold
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # content hash of the recipe -> _Entry, least recently served first
+        self._df = {"title": Counter(), "full": Counter()}  # Document frequency of each n-gram
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _count(self, entry, sign):
+        # Caller must hold the lock
+        for kind, grams in (("title", entry.title_grams), ("full", entry.full_grams)):
+            df = self._df[kind]
+            for gram in grams:
+                df[gram] += sign
+                if df[gram] <= 0:
+                    del df[gram]
+
+    def _remove(self, key):
+        # Caller must hold the lock
+        self._count(self._entries.pop(key), -1)
+        self.evictions += 1
+
+    def _evict(self):
+        # Caller must hold the lock
+        now = time.time()
+        if self.ttl is not None:
+            for key in [key for key, entry in self._entries.items() if now - entry.stored_at > self.ttl]:
+                self._remove(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def add(self, title, main_ingredients, recipe_markdown, user_profile):
+        """Indexes a finished recipe under the title and main ingredients it was requested with, for its briefing."""
+        key = content_hash(recipe_markdown + (user_profile or ""))
+        entry = _Entry(title, main_ingredients or self._ingredient_names(recipe_markdown), recipe_markdown, user_profile)
+        with self._lock:
+            if key in self._entries:
+                self._count(self._entries.pop(key), -1)
+            self._entries[key] = entry
+            self._count(entry, 1)
+            self._evict()
+
+    def _ingredient_names(self, recipe_markdown):
+        return [ingredient["name"] for ingredient in parse_recipe(recipe_markdown)["ingredients"][:4]]
+
+    def _weights(self, grams, df, total):
+        weights = {gram: count * (math.log((1 + total) / (1 + df.get(gram, 0))) + 1) for gram, count in grams.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        return weights, norm
+
+    def find(self, title, main_ingredients, constraints):
+        """
+        Returns (recipe markdown, similarity, stored title) of the most similar
+        compatible recipe at or above the threshold, or None. Without main
+        ingredients only the titles are compared.
+        """
+        if not servable(constraints):
+            with self._lock:
+                self.misses += 1
+            return None
+        kind = "full" if main_ingredients else "title"
+        query = ngrams(f"{title} {' '.join(main_ingredients)}" if main_ingredients else title)
+        with self._lock:
+            self._evict()
+            df, total = self._df[kind], len(self._entries)
+            query_weights, query_norm = self._weights(query, df, total)
+            best = None
+            for key, entry in self._entries.items():
+                grams = entry.full_grams if kind == "full" else entry.title_grams
+                if query_norm == 0 or not (grams.keys() & query.keys()):
+                    continue
+                weights, norm = self._weights(grams, df, total)
+                similarity = sum(w * weights.get(gram, 0) for gram, w in query_weights.items()) / (query_norm * norm)
+                if similarity >= self.threshold and (best is None or similarity > best[0]) \
+                        and compatible(entry, constraints):
+                    best = (similarity, key, entry)
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best[1])
+            return best[2].recipe_markdown, best[0], best[2].title
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": 0,
+                "evictions": self.evictions,
+            }
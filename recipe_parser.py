@@ -0,0 +1,192 @@
+# recipe_parser.py
+
+import re
+import time
+
+import markdown2
+
+import metrics
+from cache import LRUCache, content_hash
+
+# The three table sections of an Agent 3 / Agent 5 recipe, in the order they appear.
+# (section name, heading prefix as written by AGENT_3_PROMPT_TEMPLATE)
+RECIPE_SECTIONS = [
+    ("ingredients", "quantified ingredients"),
+    ("instructions", "instructions"),
+    ("nutrition", "nutrition count"),
+]
+
+# Rendered HTML and parsed recipes, by content hash of the markdown
+render_cache = LRUCache(maxsize=512, name="recipe_render")
+
+
+def _heading_section(line):
+    """Returns the section name if this line is one of the section headings, else None."""
+    text = line.strip().strip("#*_: ").lower()
+    if not text or line.lstrip().startswith("|"):
+        return None
+    for name, prefix in RECIPE_SECTIONS:
+        if text.startswith(prefix):
+            return name
+    return None
+
+
+class RecipeSectionStreamer:
+    """
+    Incrementally splits a streamed markdown recipe into its table sections.
+
+    Feed it text chunks as they arrive from the model. As soon as a section's
+    table is complete (the first non-table line after its rows has arrived),
+    feed() returns it as (section_name, table_markdown). Call finish() at the
+    end of the stream to flush whatever is left.
+    """
+
+    def __init__(self):
+        self._buffer = ""  # Incomplete trailing line
+        self._current = None  # Section currently being read
+        self._table_lines = []
+        self._emitted = set()
+
+    def _close_current(self):
+        section = None
+        if self._current and self._table_lines and self._current not in self._emitted:
+            section = (self._current, "\n".join(self._table_lines) + "\n")
+            self._emitted.add(self._current)
+        self._current = None
+        self._table_lines = []
+        return section
+
+    def _feed_line(self, line):
+        heading = _heading_section(line)
+        if heading:
+            closed = self._close_current()
+            self._current = heading
+            return closed
+
+        if self._current is None:
+            return None
+
+        if line.lstrip().startswith("|"):
+            self._table_lines.append(line.strip())
+            return None
+
+        # A non-table line after the table rows ends the section
+        if self._table_lines:
+            return self._close_current()
+        return None
+
+    def feed(self, chunk):
+        """Consumes a text chunk and returns a list of newly completed sections."""
+        completed = []
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            section = self._feed_line(line)
+            if section:
+                completed.append(section)
+        return completed
+
+    def finish(self):
+        """Flushes the final line and any open section at the end of the stream."""
+        completed = []
+        if self._buffer:
+            section = self._feed_line(self._buffer)
+            self._buffer = ""
+            if section:
+                completed.append(section)
+        section = self._close_current()
+        if section:
+            completed.append(section)
+        return completed
+
+
+def split_sections(recipe_markdown):
+    """Returns {section_name: table_markdown} for the table sections of a complete recipe."""
+    streamer = RecipeSectionStreamer()
+    sections = streamer.feed(recipe_markdown) + streamer.finish()
+    return dict(sections)
+
+
+def table_rows(table_markdown):
+    """Returns the body rows of a markdown table as lists of cell strings (header and separator skipped)."""
+    rows = []
+    for line in table_markdown.strip().splitlines()[1:]:
+        cells = [cell.strip() for cell in line.strip().strip("|").split("|")]
+        if all(set(cell) <= set("-: ") for cell in cells):
+            continue  # |---|---| separator
+        rows.append(cells)
+    return rows
+
+
+def _field(recipe_markdown, name):
+    match = re.search(rf"^\W*{name}\W*:\s*(.*)$", recipe_markdown, re.IGNORECASE | re.MULTILINE)
+    return match.group(1).strip().strip("*").strip() if match else ""
+
+
+def _cell(row, index):
+    return row[index] if len(row) > index else ""
+
+
+def parse_recipe(recipe_markdown):
+    """
+    Parses a complete Agent 3 / Agent 5 recipe into a plain dict:
+    {"dish_name", "description", "ingredients": [{"name", "quantity", "notes"}],
+     "steps": [{"step", "instruction"}], "nutrition": [{"nutrient", "amount"}]}
+    Memoised by content hash; treat the result as read-only.
+    """
+    key = content_hash("parsed", recipe_markdown)
+    recipe = render_cache.get(key)
+    if recipe is None:
+        recipe = _parse_recipe(recipe_markdown)
+        render_cache.set(key, recipe)
+    return recipe
+
+
+def _parse_recipe(recipe_markdown):
+    sections = {name: table_rows(table) for name, table in split_sections(recipe_markdown).items()}
+    return {
+        "dish_name": _field(recipe_markdown, "dish name"),
+        "description": _field(recipe_markdown, "description"),
+        "ingredients": [
+            {"name": _cell(row, 0), "quantity": _cell(row, 1), "notes": _cell(row, 2)}
+            for row in sections.get("ingredients", [])
+        ],
+        "steps": [
+            {"step": _cell(row, 0), "instruction": _cell(row, 1)}
+            for row in sections.get("instructions", [])
+        ],
+        "nutrition": [
+            {"nutrient": _cell(row, 0), "amount": _cell(row, 1)}
+            for row in sections.get("nutrition", [])
+        ],
+    }
+
+
+def render_markdown(recipe_markdown):
+    """Renders recipe markdown (including its tables) to HTML. Memoised by content hash."""
+    key = content_hash("html", recipe_markdown)
+    html = render_cache.get(key)
+    if html is None:
+        started = time.perf_counter()
+        html = markdown2.markdown(recipe_markdown, extras=["tables"])
+        metrics.MARKDOWN_RENDER_SECONDS.observe(time.perf_counter() - started)
+        render_cache.set(key, html)
+    return html
+
+
+def render_recipe(recipe_markdown):
+    """
+    Parses and renders a complete recipe once. Returns {"html", "sections", "recipe"}:
+    the full HTML, {section_name: table_html}, and parse_recipe()'s dict.
+    Memoised by content hash; treat the result as read-only.
+    """
+    key = content_hash("recipe", recipe_markdown)
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = {
+            "html": render_markdown(recipe_markdown),
+            "sections": {name: render_markdown(table) for name, table in split_sections(recipe_markdown).items()},
+            "recipe": parse_recipe(recipe_markdown),
+        }
+        render_cache.set(key, rendered)
+    return rendered
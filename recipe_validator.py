@@ -0,0 +1,153 @@
+# recipe_validator.py
+#
+# Local checks on an Agent 3 recipe, run before Agent 5 (Judge):
+# - structure:  dish name, and the ingredients / instructions / nutrition tables
+#               filled in as AGENT_3_PROMPT_TEMPLATE asks
+# - hard rules: no ingredient from a food group that an active hard rule in
+#               ruleset.csv forbids (e.g. "allergic to peanuts and dairy products")
+# - time:       the minutes named in the steps fit today's time_available_min
+#               from calendar.csv
+# The Judge is only needed when one of these fails, and then gets the list of
+# violations to fix.
+
+import re
+from collections import namedtuple
+
+from prompt_context import active_rules, profile_date, select_calendar_row
+from recipe_parser import parse_recipe
+
+ValidationResult = namedtuple("ValidationResult", ["violations", "checks"])
+
+# Food groups a hard rule can forbid: the words that name the group in a rule,
+# and the ingredient words that belong to it.
+FOOD_GROUPS = {
+    "peanut": (["peanut"], ["peanut", "groundnut", "satay"]),
+    "tree nut": (["tree nut", "nuts"], ["almond", "cashew", "walnut", "pecan", "hazelnut", "pistachio", "macadamia"]),
+    "dairy": (["dairy", "lactose", "milk"], ["milk", "cheese", "butter", "cream", "yogurt", "yoghurt", "ghee",
+                                             "whey", "parmesan", "mozzarella", "feta", "paneer", "ricotta"]),
+    "egg": (["egg"], ["egg", "mayonnaise", "mayo"]),
+    "gluten": (["gluten", "wheat"], ["wheat", "flour", "bread", "pasta", "noodle", "couscous", "barley", "rye"]),
+    "shellfish": (["shellfish"], ["shrimp", "prawn", "crab", "lobster", "mussel", "clam", "oyster", "scallop"]),
+    "soy": (["soy"], ["soy", "tofu", "edamame", "tempeh", "miso"]),
+    "pork": (["pork"], ["pork", "bacon", "ham", "prosciutto", "pancetta", "chorizo", "lard", "salami"]),
+    "alcohol": (["alcohol"], ["wine", "beer", "rum", "vodka", "whisky", "whiskey", "brandy", "sake", "mirin",
+                              "sherry", "liqueur", "cider"]),
+}
+# Phrases that contain a group's word but are not in the group
+NOT_IN_GROUP = {
+    "dairy": ["peanut butter", "almond butter", "nut butter", "cocoa butter", "coconut milk", "coconut cream",
+              "almond milk", "soy milk", "oat milk", "rice milk", "dairy free", "dairy-free"],
+    "egg": ["egg free", "egg-free"],
+}
+REQUIRED_NUTRIENTS = ["calories", "protein", "fat", "carbs"]
+
+_MINUTES = re.compile(r"(\d+(?:\.\d+)?)\s*(?:-|–|to)?\s*(\d+(?:\.\d+)?)?\s*(min|minute|minutes|mins|hour|hours|hr|hrs)\b")
+
+
+def _words_pattern(words):
+    return re.compile(r"\b(?:" + "|".join(re.escape(word) for word in words) + r")(?:s|es)?\b")
+
+
+def forbidden_groups(rules):
+    """Returns the FOOD_GROUPS names forbidden by the active hard rules."""
+    groups = []
+    for rule in rules:
+        if rule.get("enforcement", "").strip().lower() != "hard":
+            continue
+        description = str(rule.get("description", "")).lower()
+        for group, (rule_words, _) in FOOD_GROUPS.items():
+            if group not in groups and _words_pattern(rule_words).search(description):
+                groups.append(group)
+    return groups
+
+
+def unmapped_hard_rules(rules):
+    """Returns the descriptions of the active hard rules that name none of the FOOD_GROUPS (e.g. sesame)."""
+    return [
+        str(rule.get("description", ""))
+        for rule in rules
+        if rule.get("enforcement", "").strip().lower() == "hard"
+        and not any(_words_pattern(rule_words).search(str(rule.get("description", "")).lower())
+                    for rule_words, _ in FOOD_GROUPS.values())
+    ]
+
+
+def find_group(text, group):
+    """Returns the first word of `group` found in `text`, or None."""
+    text = str(text).lower().replace("_", " ")
+    for phrase in NOT_IN_GROUP.get(group, []):
+        text = text.replace(phrase, " ")
+    match = _words_pattern(FOOD_GROUPS[group][1]).search(text)
+    return match.group() if match else None
+
+
+def step_minutes(instruction):
+    """Minutes a step takes, from the largest duration it names ("5-6 minutes" -> 6, "1 hour" -> 60)."""
+    longest = 0.0
+    for low, high, unit in _MINUTES.findall(instruction.lower()):
+        minutes = float(high or low) * (60 if unit.startswith(("hour", "hr")) else 1)
+        longest = max(longest, minutes)
+    return longest
+
+
+def validate_recipe(recipe_markdown, snapshot, today=None):
+    """
+    Checks a recipe against structure, hard rules and today's time limit.
+    Returns ValidationResult(violations, checks): both lists of strings, and
+    `violations` is empty if the recipe passed.
+    """
+    recipe = parse_recipe(recipe_markdown)
+    ingredients, steps, nutrition = recipe["ingredients"], recipe["steps"], recipe["nutrition"]
+    violations = []
+    checks = []
+
+    # --- Structure ---
+    checks.append("structure")
+    if not recipe["dish_name"]:
+        violations.append("Structure: the 'Dish name:' line is missing.")
+    for rows, title in [(ingredients, "Quantified Ingredients"), (steps, "Instructions"), (nutrition, "Nutrition count")]:
+        if not rows:
+            violations.append(f"Structure: the '{title}' table is missing or empty.")
+
+    for ingredient in ingredients:
+        if not ingredient["quantity"]:
+            violations.append(f"Structure: ingredient '{ingredient['name']}' has no quantity.")
+
+    numbers = [step["step"] for step in steps]
+    if steps and numbers != [str(i) for i in range(1, len(numbers) + 1)]:
+        violations.append(f"Structure: steps are not numbered 1 to {len(numbers)} in order (found {', '.join(numbers)}).")
+    for step in steps:
+        if not step["instruction"]:
+            violations.append(f"Structure: step {step['step']} has no instruction text.")
+
+    amounts = {row["nutrient"].strip("* ").lower(): row["amount"] for row in nutrition}
+    for nutrient in REQUIRED_NUTRIENTS:
+        if nutrition and not re.search(r"\d", amounts.get(nutrient, "")):
+            violations.append(f"Structure: the nutrition table has no numeric '{nutrient.capitalize()}' value.")
+
+    # --- Hard rules ---
+    groups = forbidden_groups(active_rules(snapshot.rows["ruleset"]))
+    if groups:
+        checks.append(f"hard rules ({', '.join(groups)})")
+    for group in groups:
+        for ingredient in ingredients:
+            found = find_group(f"{ingredient['name']} {ingredient['notes']}", group)
+            if found:
+                violations.append(f"Hard rule: ingredient '{ingredient['name']}' contains {group} ('{found}'), which is forbidden.")
+        for step in steps:
+            found = find_group(step["instruction"], group)
+            if found:
+                violations.append(f"Hard rule: step {step['step']} uses {group} ('{found}'), which is forbidden.")
+
+    # --- Time limit ---
+    calendar_row = select_calendar_row(snapshot.rows["calendar"], today or profile_date()) or {}
+    match = re.search(r"\d+", str(calendar_row.get("time_available_min", "")))
+    if match and steps:
+        limit = int(match.group())
+        total = sum(step_minutes(step["instruction"]) for step in steps)
+        checks.append(f"time limit ({limit} mins, steps name {total:g} mins)")
+        if total > limit:
+            violations.append(f"Time: the steps add up to about {total:g} minutes, "
+                              f"but only {limit} minutes are available today.")
+
+    return ValidationResult(violations, checks)
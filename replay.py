@@ -0,0 +1,237 @@
+# replay.py
+#
+# Load generator built from recorded traffic. Reads the request log written by
+# app.py (REQUEST_LOG_PATH, rotated files included) and re-drives the recorded
+# /api/* requests against the app in-process, with the model replaced by the
+# deterministic FakeBackend, then reports latency percentiles per route and agent.
+#
+#     python replay.py logs/requests.jsonl --speed 2              # recorded timing, twice as fast
+#     python replay.py logs/requests.jsonl --rate 50 --loops 3    # fixed 50 requests/s
+#
+# Requests are started on schedule (open loop), so a slow app shows up as lag
+# instead of a lower request rate. Session and briefing IDs returned during the
+# replay are substituted for the recorded ones in later requests.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import RecordingBackend, summarize
+from request_log import read_entries
+
+# Trace IDs are random per run, so recorded trace lookups can't be replayed
+SKIPPED_PREFIXES = ("/api/traces/",)
+
+
+class IdMap:
+    """
+    Maps recorded session/briefing IDs to the ones returned during the replay.
+    IDs are kept per loop, so every pass over the log gets fresh sessions.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._ids = {}  # (loop, recorded ID) -> new ID
+        self._expected = set()
+        self._cond = threading.Condition()
+
+    def expect(self, loop, recorded_id):
+        """Marks an ID that a scheduled request will return, so later requests wait for it."""
+        self._expected.add((loop, recorded_id))
+
+    def set(self, loop, recorded_id, new_id):
+        with self._cond:
+            self._ids[(loop, recorded_id)] = new_id
+            self._cond.notify_all()
+
+    def get(self, loop, recorded_id):
+        """The new ID for a recorded one; waits for the request that returns it if that is still running."""
+        key = (loop, recorded_id)
+        if key not in self._expected:
+            return recorded_id
+        with self._cond:
+            self._cond.wait_for(lambda: key in self._ids, timeout=self.timeout)
+            return self._ids.get(key, recorded_id)
+
+
+def load_traffic(path, limit=None):
+    """The replayable entries of a request log, in recorded order."""
+    entries = []
+    for entry in read_entries(path):
+        route = entry.get("path", "")
+        if not route.startswith("/api/") or route.startswith(SKIPPED_PREFIXES):
+            continue
+        entries.append(entry)
+        if limit and len(entries) >= limit:
+            break
+    return entries
+
+
+def schedule(entries, rate, speed, loops):
+    """Returns (start offset in seconds, entry) pairs for the whole replay."""
+    plan = []
+    offset = 0.0
+    for _ in range(loops):
+        first_ts = entries[0].get("ts", 0)
+        for i, entry in enumerate(entries):
+            if rate:
+                start = offset + i / rate
+            else:
+                start = offset + max(entry.get("ts", first_ts) - first_ts, 0) / speed
+            plan.append((start, entry))
+        offset = plan[-1][0] + (1 / rate if rate else 0)
+    return plan
+
+
+def replay_request(client, entry, ids, loop):
+    """Sends one recorded request, with its IDs mapped to the replay's. Returns (status, payload)."""
+    data = entry.get("request")
+    if isinstance(data, dict):
+        data = dict(data)
+        for key in ("session_id", "briefing_id"):
+            if data.get(key):
+                data[key] = ids.get(loop, data[key])
+    route = entry["path"] + (f"?{entry['query']}" if entry.get("query") else "")
+    if entry.get("method") == "GET":
+        response = client.get(route)
+    else:
+        response = client.post(route, json=data)
+    body = response.get_data()  # Drains streamed responses too
+    response.close()
+    payload = None
+    if response.is_json:
+        payload = json.loads(body or b"null")
+    return response.status_code, payload
+
+
+def run_replay(entries, rate, speed, loops, concurrency, id_timeout):
+    # Imported here so the environment (MODEL_BACKEND etc.) is set up first
+    import app as core
+
+    recorder = RecordingBackend(core.backend)
+    core.backend = recorder
+    ids = IdMap(id_timeout)
+    plan = schedule(entries, rate, speed, loops)
+    for index, (_, entry) in enumerate(plan):
+        for recorded_id in (entry.get("response_ids") or {}).values():
+            ids.expect(index // len(entries), recorded_id)
+
+    lock = threading.Lock()
+    durations = defaultdict(list)  # route -> [seconds]
+    errors = defaultdict(int)
+    lags = []
+    local = threading.local()
+
+    def send(index, scheduled_at, entry):
+        lag = time.perf_counter() - scheduled_at
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = core.app.test_client()
+        loop = index // len(entries)
+        started = time.perf_counter()
+        try:
+            status, payload = replay_request(client, entry, ids, loop)
+        except Exception as e:
+            print(f"--- Replay request to {entry['path']} failed: {e} ---")
+            status, payload = 500, None
+        elapsed = time.perf_counter() - started
+        for key, recorded_id in (entry.get("response_ids") or {}).items():
+            new_id = payload.get(key) if isinstance(payload, dict) else None
+            ids.set(loop, recorded_id, new_id or recorded_id)
+        with lock:
+            durations[entry["path"]].append(elapsed)
+            lags.append(lag)
+            if status != entry.get("status", 200):
+                errors[entry["path"]] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, (offset, entry) in enumerate(plan):
+            scheduled_at = started + offset
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, index, scheduled_at, entry)
+    wall_time = time.perf_counter() - started
+
+    total_requests = sum(len(v) for v in durations.values())
+    report = {
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "wall_time_s": round(wall_time, 3),
+        "requests_per_s": round(total_requests / wall_time, 2) if wall_time else 0.0,
+        "start_lag": summarize(lags),
+        "routes": {
+            route: dict(summarize(values), errors=errors[route])
+            for route, values in sorted(durations.items())
+        },
+        "agents": {
+            agent: summarize([c[0] for c in calls])
+            for agent, calls in sorted(recorder.calls.items())
+        },
+    }
+    return report
+
+
+def print_report(report, source):
+    print(f"\n=== Replay of {source}: {report['requests']} requests, concurrency {report['concurrency']} ===")
+    print(f"Wall time: {report['wall_time_s']}s | {report['requests_per_s']} requests/s | "
+          f"start lag p50 {report['start_lag']['p50_ms']} ms, p99 {report['start_lag']['p99_ms']} ms")
+
+    header = f"{'':38} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print("\n" + header)
+    for route, stats in report["routes"].items():
+        errors = f"  ({stats['errors']} status mismatches)" if stats["errors"] else ""
+        print(f"{route:38} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}{errors}")
+
+    print("\n" + header)
+    for agent, stats in report["agents"].items():
+        print(f"{agent:38} {stats['count']:>6} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded API traffic against the app with a fake model.")
+    parser.add_argument("log", nargs="?", default=os.path.join("logs", "requests.jsonl"),
+                        help="Request log to replay (rotated files next to it are included).")
+    parser.add_argument("--rate", type=float, help="Fixed request rate per second (default: recorded timing).")
+    parser.add_argument("--speed", type=float, default=1.0, help="Speed-up of the recorded timing.")
+    parser.add_argument("--loops", type=int, default=1, help="Times to replay the log.")
+    parser.add_argument("--limit", type=int, help="Only replay the first N requests.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Max requests in flight.")
+    parser.add_argument("--latency-ms", type=float, default=100, help="Fake model latency per call.")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="Extra random latency per call (0 to N).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake model's jitter.")
+    parser.add_argument("--id-timeout", type=float, default=60, help="Max seconds to wait for a session/briefing ID.")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own log output.")
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    entries = load_traffic(args.log, args.limit)
+    if not entries:
+        parser.error(f"No replayable requests in {args.log}")
+
+    os.environ["MODEL_BACKEND"] = "fake"
+    os.environ["FAKE_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_JITTER_MS"] = str(args.jitter_ms)
+    os.environ["FAKE_SEED"] = str(args.seed)
+    os.environ["REQUEST_LOG_PATH"] = ""  # Don't record the replay itself
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        report = run_replay(entries, args.rate, args.speed, args.loops, args.concurrency, args.id_timeout)
+    print_report(report, args.log)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# request_log.py
+#
+# Durable log of API traffic: one JSON line per request with its body, status,
+# timing and the agent calls it made (prompt, response, seconds).
+# Request threads only put the entry on a bounded queue; a background thread
+# serializes and appends everything queued in one write, and rotates the file
+# by size (requests.jsonl -> requests.jsonl.1 -> ...). If the queue is full the
+# entry is dropped and counted, so logging never blocks a request.
+#
+# replay.py reads these files back to re-drive the recorded traffic.
+
+import atexit
+import contextvars
+import json
+import os
+import queue
+import threading
+
+# Agent calls made while handling the current request (a list, or None outside a request)
+_agent_calls = contextvars.ContextVar("request_log_agent_calls", default=None)
+
+_STOP = object()
+
+
+def start_request():
+    """Starts collecting the agent calls of the current request and returns the list they go into."""
+    calls = []
+    _agent_calls.set(calls)
+    return calls
+
+
+def note_agent_call(agent, prompt, response, seconds, shared=False):
+    """
+    Adds an agent call to the current request's entry. `response` is None if
+    the call failed; `shared` marks a call answered by an identical one in flight.
+    """
+    calls = _agent_calls.get()
+    if calls is not None:
+        call = {"agent": agent, "prompt": prompt, "response": response, "seconds": round(seconds, 4)}
+        if shared:
+            call["shared"] = True
+        calls.append(call)
+
+
+def log_files(path):
+    """The current log file and its rotated backups that exist, oldest first."""
+    backups = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        backups.append(f"{path}.{index}")
+        index += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_entries(path):
+    """Yields the entries of a log (rotated backups first). Torn or invalid lines are skipped."""
+    for file_path in log_files(path):
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+class RequestLog:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=5, queue_size=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+        self._thread = threading.Thread(target=self._run, name="request-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, entry):
+        """Queues an entry for writing. Never blocks; drops the entry if the writer is behind."""
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batch
+            entries = [entry for entry in batch if entry is not _STOP]
+            if entries:
+                try:
+                    self._write(entries)
+                except Exception as e:
+                    print(f"--- Request log write failed: {e} ---")
+                    with self._lock:
+                        self.dropped += len(entries)
+            if stop:
+                self._file.close()
+                return
+
+    def _write(self, entries):
+        data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+        size = len(data.encode("utf-8"))
+        if self._size and self._size + size > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += size
+        with self._lock:
+            self.written += len(entries)
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._size = 0
+        with self._lock:
+            self.rotations += 1
+
+    def close(self, timeout=5):
+        """Writes out everything still queued and stops the writer thread."""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "written": self.written,
+                "dropped": self.dropped,
+                "rotations": self.rotations,
+                "queued": self._queue.qsize(),
+            }
@@ -0,0 +1,468 @@
+# resilience.py
+#
+# Guards around every upstream agent call, shared by app.py and asgi.py:
+# - Deadlines: a call gets its agent's timeout, cut to what is left of the
+#   request's budget (start_budget()), so a slow model can't hold a request past
+#   the point where the answer is still useful. Late calls raise AgentTimeout.
+# - Retries: retryable errors (rate limits, 5xx-style and connection errors)
+#   are retried with full-jitter exponential backoff while the deadline allows
+#   it. A RetryBudget caps retries at a fraction of all calls, so retries can't
+#   multiply the load on an upstream that is already failing.
+# - Hedging (opt-in): a call still running after its agent's recent p95 latency
+#   gets a duplicate; the first success wins.
+# - Circuit breaker: after `failure_threshold` failures in a row, calls fail fast
+#   with CircuitOpenError for `reset_seconds`. Then one trial call decides whether
+#   the circuit closes again.
+# Streams are retried only until their first chunk has been passed on, and are not hedged.
+
+import asyncio
+import contextvars
+import queue
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+# Monotonic deadline of the current request (None outside a request, e.g. background jobs)
+_request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+# Error class names of the Gemini SDK (google.api_core) and HTTP clients that are worth retrying
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError", "BadGateway",
+    "GatewayTimeout", "DeadlineExceeded", "Aborted", "Unavailable", "TransientBackendError",
+}
+
+_STREAM_END = object()
+
+
+class AgentTimeout(TimeoutError):
+    """An agent call ran past its deadline."""
+
+
+class CircuitOpenError(Exception):
+    """The model backend has been failing; calls fail fast until the circuit closes."""
+
+
+def start_budget(seconds):
+    """Starts the time budget of the current request (None or 0 for no budget)."""
+    _request_deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def is_retryable(error):
+    if isinstance(error, (AgentTimeout, CircuitOpenError)):
+        return False  # No time left, or the backend is known to be down
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+class RetryBudget:
+    """
+    Token bucket for retries: every call deposits `ratio` of a token, a retry
+    takes a whole one. `min_per_second` keeps a few retries possible at low traffic.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_tokens=20):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _refill(self):
+        # Caller must hold the lock
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Takes a token for one retry. Returns False if the budget is spent."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raises CircuitOpenError unless a call may go to the backend now. Returns
+        True if the call is the half-open trial: it must then end in
+        record_success(), record_failure() or release_trial().
+        """
+        if not self.failure_threshold:
+            return False
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True  # Only this call tests the backend
+                return True
+            self.rejected += 1
+        retry_in = max(self.reset_seconds - (time.monotonic() - self.opened_at), 0)
+        raise CircuitOpenError(f"The AI service is unavailable right now. Please try again in {retry_in:.0f}s.")
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def release_trial(self):
+        """Ends a trial call that was abandoned (cancelled, or its stream closed) before it told anything."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"--- Circuit breaker: open after {self.failures} failures ---")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class LatencyTracker:
+    """Recent successful call latencies per agent, for the hedging threshold."""
+
+    def __init__(self, window=200):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def observe(self, agent, seconds):
+        with self._lock:
+            self._samples[agent].append(seconds)
+
+    def percentile(self, agent, pct, min_samples=20):
+        with self._lock:
+            samples = sorted(self._samples[agent])
+        if len(samples) < min_samples:
+            return None
+        return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+class AgentCaller:
+    """
+    Calls the model backend with deadlines, retries, hedging and a circuit
+    breaker. `get_backend` returns the current backend (it can be swapped at runtime).
+    """
+
+    def __init__(self, get_backend, timeout=90, agent_timeouts=None, max_attempts=3, backoff_base=0.5,
+                 backoff_max=8, retry_budget=None, hedge=False, hedge_percentile=95, hedge_min_seconds=1.0,
+                 breaker=None, max_workers=64):
+        self._get_backend = get_backend
+        self.timeout = timeout
+        self.agent_timeouts = dict(agent_timeouts or {})
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget or RetryBudget()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_seconds = hedge_min_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        # Blocking backend calls run here, so a request stops waiting at its deadline
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-call")
+
+    # --- Policy ---
+    def deadline(self, agent):
+        """Monotonic deadline of a call: the agent's timeout, cut to the request's remaining budget."""
+        deadline = time.monotonic() + self.agent_timeouts.get(agent, self.timeout)
+        request_deadline = _request_deadline.get()
+        return min(deadline, request_deadline) if request_deadline else deadline
+
+    def hedge_delay(self, agent):
+        """Seconds after which a duplicate call is sent, or None (hedging off, or too few samples)."""
+        if not self.hedge:
+            return None
+        p = self.latency.percentile(agent, self.hedge_percentile)
+        return None if p is None else max(p, self.hedge_min_seconds)
+
+    def _record_error(self, agent, error):
+        """Counts a failed attempt against the circuit breaker if it says something about the backend's health."""
+        if isinstance(error, AgentTimeout):
+            metrics.AGENT_TIMEOUTS.inc(agent=agent)
+        if isinstance(error, AgentTimeout) or is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()  # The backend answered; the request itself was bad
+
+    def _retry_delay(self, agent, error, attempt, deadline):
+        """Seconds to wait before retrying after `error`, or None if the error should be raised."""
+        self._record_error(agent, error)
+        if not is_retryable(error) or attempt >= self.max_attempts:
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if time.monotonic() + delay >= deadline or not self.retry_budget.withdraw():
+            return None
+        metrics.AGENT_RETRIES.inc(agent=agent)
+        print(f"--- {agent}: retrying after {type(error).__name__} (attempt {attempt + 1}) in {delay:.2f}s ---")
+        return delay
+
+    def _abandon(self, trial, answered=False):
+        """The caller gave up on a call. A backend that had already answered counts as healthy."""
+        if answered:
+            self.breaker.record_success()
+        elif trial:
+            self.breaker.release_trial()
+
+    def _timeout(self, agent):
+        return AgentTimeout(f"The AI took too long to respond ({agent}). Please try again.")
+
+    def _late(self, agent, error, deadline):
+        """An error at or after the deadline is the backend giving up on the time it was given: a timeout."""
+        if isinstance(error, AgentTimeout) or time.monotonic() < deadline:
+            return error
+        timeout = self._timeout(agent)
+        timeout.__cause__ = error
+        return timeout
+
+    def _remaining(self, deadline):
+        """Seconds left before `deadline`, passed to the backend so the model request stops there too."""
+        return max(deadline - time.monotonic(), 0.001)
+
+    # --- Threads (Flask) ---
+    def call(self, agent, prompt):
+        """Returns the response text of one agent call."""
+        deadline = self.deadline(agent)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            trial = self.breaker.allow()
+            try:
+                text = self._attempt(agent, prompt, deadline)
+            except Exception as e:
+                delay = self._retry_delay(agent, e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._abandon(trial)
+                raise
+            self.breaker.record_success()
+            return text
+
+    def _attempt(self, agent, prompt, deadline):
+        backend = self._get_backend()
+        started = time.monotonic()
+        hedge_at = self.hedge_delay(agent)
+        pending = {self._pool.submit(backend.generate, agent, prompt, self._remaining(deadline))}
+        error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._timeout(agent)
+            wait_for = remaining
+            if hedge_at is not None:
+                wait_for = min(remaining, max(started + hedge_at - time.monotonic(), 0))
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.latency.observe(agent, time.monotonic() - started)
+                    return future.result()
+                error = future.exception()
+            if hedge_at is not None and time.monotonic() >= started + hedge_at and pending:
+                hedge_at = None  # One duplicate at most
+                metrics.AGENT_HEDGES.inc(agent=agent)
+                pending.add(self._pool.submit(backend.generate, agent, prompt, self._remaining(deadline)))
+        raise self._late(agent, error, deadline)
+
+    def stream(self, agent, prompt):
+        """Yields the response text of one agent call in chunks."""
+        deadline = self.deadline(agent)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            trial = self.breaker.allow()
+            started = time.monotonic()
+            chunks = queue.Queue()
+            stop = threading.Event()
+            self._pool.submit(self._pump, self._get_backend(), agent, prompt, self._remaining(deadline), chunks, stop)
+            sent = False
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        chunk = chunks.get(timeout=max(remaining, 0))
+                    except queue.Empty:
+                        raise self._timeout(agent)
+                    if chunk is _STREAM_END:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise self._late(agent, chunk, deadline)
+                    sent = True
+                    yield chunk
+            except Exception as e:
+                stop.set()
+                # Chunks already passed on can't be taken back, so only a stream that sent nothing is retried
+                if sent:
+                    self._record_error(agent, e)
+                    raise
+                delay = self._retry_delay(agent, e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:  # GeneratorExit: the caller stopped reading
+                self._abandon(trial, sent)
+                raise
+            finally:
+                stop.set()  # Also when the caller stops reading
+            self.breaker.record_success()
+            self.latency.observe(agent, time.monotonic() - started)
+            return
+
+    def _pump(self, backend, agent, prompt, timeout, chunks, stop):
+        try:
+            for chunk in backend.stream(agent, prompt, timeout):
+                if stop.is_set():
+                    return
+                chunks.put(chunk)
+            chunks.put(_STREAM_END)
+        except Exception as e:
+            chunks.put(e)
+
+    # --- Event loop (asgi.py) ---
+    async def acall(self, agent, prompt):
+        """Async version of call(), using the backend's async API."""
+        deadline = self.deadline(agent)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            trial = self.breaker.allow()
+            try:
+                text = await self._aattempt(agent, prompt, deadline)
+            except Exception as e:
+                delay = self._retry_delay(agent, e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:  # Cancelled
+                self._abandon(trial)
+                raise
+            self.breaker.record_success()
+            return text
+
+    async def _aattempt(self, agent, prompt, deadline):
+        backend = self._get_backend()
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        hedge_at = self.hedge_delay(agent)
+        pending = {asyncio.ensure_future(backend.agenerate(agent, prompt, self._remaining(deadline)))}
+        error = None
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timeout(agent)
+                wait_for = remaining
+                if hedge_at is not None:
+                    wait_for = min(remaining, max(started + hedge_at - time.monotonic(), 0))
+                done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latency.observe(agent, time.monotonic() - started)
+                        return task.result()
+                    error = task.exception()
+                if hedge_at is not None and time.monotonic() >= started + hedge_at and pending:
+                    hedge_at = None
+                    metrics.AGENT_HEDGES.inc(agent=agent)
+                    pending.add(loop.create_task(backend.agenerate(agent, prompt, self._remaining(deadline))))
+            raise self._late(agent, error, deadline)
+        finally:
+            for task in pending:
+                task.cancel()  # The losing hedge, or calls past the deadline
+
+    async def astream(self, agent, prompt):
+        """Async version of stream()."""
+        deadline = self.deadline(agent)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            trial = self.breaker.allow()
+            started = time.monotonic()
+            chunks = self._get_backend().astream(agent, prompt, self._remaining(deadline)).__aiter__()
+            sent = False
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline - time.monotonic(), 0))
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise self._timeout(agent)
+                    except Exception as e:
+                        raise self._late(agent, e, deadline)
+                    sent = True
+                    yield chunk
+            except Exception as e:
+                # Chunks already passed on can't be taken back, so only a stream that sent nothing is retried
+                if sent:
+                    self._record_error(agent, e)
+                    raise
+                delay = self._retry_delay(agent, e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:  # Cancelled, or the caller stopped reading
+                self._abandon(trial, sent)
+                raise
+            finally:
+                if hasattr(chunks, "aclose"):
+                    await chunks.aclose()
+            self.breaker.record_success()
+            self.latency.observe(agent, time.monotonic() - started)
+            return
+
+    def stats(self):
+        return {
+            "circuit_state": self.breaker.state,
+            "circuit_rejected": self.breaker.rejected,
+            "retry_tokens": self.retry_budget.tokens(),
+            "retry_budget_exhausted": self.retry_budget.exhausted,
+        }
@@ -0,0 +1,259 @@
+# single_flight.py
+#
+# Coalesces identical agent calls that are in flight at the same time. The
+# first caller for a key (a hash of the agent and prompt) makes the model call;
+# callers that arrive while it is running wait for it and get the same text,
+# or the same exception. Nothing is kept once the call finishes; that is what
+# the caches are for.
+#
+# Streamed and plain calls share flights: a waiter on a streamed call gets each
+# chunk as it arrives, and a plain caller gets the joined text. So the JSON and
+# the SSE recipe routes asking for the same dish cost one model call.
+#
+# - SingleFlight:      for threads (the Flask app). The callers drive the call
+#   themselves: a stream is read on until its last reader goes away.
+# - AsyncSingleFlight: for the event loop (asgi.py). The call runs in its own task,
+#   so it finishes even if the caller that started it goes away.
+
+import asyncio
+import threading
+import time
+
+
+class _Flight:
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        # SingleFlight only: the stream's start function and iterator, whether a
+        # reader is pulling from it right now, and how many readers are left.
+        self.start = None
+        self.source = None
+        self.driving = False
+        self.readers = 0
+
+
+class SingleFlight:
+    def __init__(self, name="single_flight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> _Flight
+        self._cond = threading.Condition(self._lock)
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                flight.readers = 1
+                self.leaders += 1
+                return flight, True
+            flight.readers += 1
+            self.shared += 1
+            return flight, False
+
+    def _finish(self, key, flight, error=None):
+        with self._lock:
+            self._end(key, flight, error)
+
+    def _end(self, key, flight, error):
+        flight.error = error
+        flight.finished = True
+        flight.driving = False
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        self._cond.notify_all()
+
+    def call(self, key, func, timeout=None):
+        """
+        Returns (text, shared): func()'s result, or that of the identical call
+        already in flight. A waiter raises TimeoutError after `timeout` seconds.
+        """
+        flight, leader = self._join(key)
+        if not leader:
+            return "".join(self._read(key, flight, timeout)), True
+        with self._lock:
+            flight.driving = True
+            flight.readers -= 1
+        try:
+            text = func()
+        except Exception as e:
+            self._finish(key, flight, e)
+            raise
+        except BaseException:
+            self._finish(key, flight, RuntimeError("The shared agent call was interrupted."))
+            raise
+        with self._lock:
+            flight.chunks.append(text)
+            self._end(key, flight, None)
+        return text, False
+
+    def stream(self, key, func, timeout=None):
+        """
+        Returns (chunks, shared). Every caller with the same key reads the one
+        stream of func() and gets each chunk as it is produced; whoever is
+        reading pulls the next chunk when nobody else is, so the stream goes on
+        as long as one reader is left. Iterate the result right away: a
+        caller counts as a reader from this call until its iterator is closed.
+        """
+        flight, leader = self._join(key)
+        if leader:
+            flight.start = func
+        return self._read(key, flight, timeout), not leader
+
+    def _read(self, key, flight, timeout):
+        deadline = time.monotonic() + timeout if timeout else None
+        index = 0
+        try:
+            while True:
+                with self._lock:
+                    while index >= len(flight.chunks) and not flight.finished and (flight.driving or flight.start is None):
+                        remaining = deadline - time.monotonic() if deadline else None
+                        if remaining is not None and remaining <= 0:
+                            self.timeouts += 1
+                            raise TimeoutError(f"Waited more than {timeout:g}s for an identical agent call.")
+                        self._cond.wait(remaining)
+                    chunks = flight.chunks[index:]
+                    finished = flight.finished
+                    drive = not chunks and not finished
+                    if drive:
+                        flight.driving = True
+                if drive:
+                    self._pull(key, flight)
+                    continue
+                index += len(chunks)
+                yield from chunks
+                if finished:
+                    break
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            self._leave(key, flight)
+
+    def _pull(self, key, flight):
+        """Reads the next chunk of the flight's stream (the caller has set flight.driving)."""
+        try:
+            if flight.source is None:
+                flight.source = iter(flight.start())
+            chunk = next(flight.source)
+        except StopIteration:
+            self._finish(key, flight)
+        except Exception as e:
+            self._finish(key, flight, e)  # Raised in every reader
+        except BaseException:
+            self._finish(key, flight, RuntimeError("The shared agent call was interrupted."))
+            raise
+        else:
+            with self._lock:
+                flight.chunks.append(chunk)
+                flight.driving = False
+                self._cond.notify_all()
+
+    def _leave(self, key, flight):
+        """A reader is done. When the last one stops reading (e.g. its client disconnected) the stream is closed."""
+        with self._lock:
+            flight.readers -= 1
+            abandoned = flight.readers == 0 and not flight.finished and not flight.driving
+            if abandoned:
+                self._end(key, flight, RuntimeError("The shared agent call was abandoned."))
+        if abandoned and flight.source is not None and hasattr(flight.source, "close"):
+            flight.source.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "timeouts": self.timeouts,
+                "in_flight": len(self._flights),
+            }
+
+
+class AsyncSingleFlight:
+    """SingleFlight for one event loop. `start` is called once per flight and returns an async iterator of chunks."""
+
+    def __init__(self, name="async_single_flight"):
+        self.name = name
+        self._flights = {}  # key -> _Flight
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def _join(self, key, start):
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.shared += 1
+            return flight, True
+        flight = self._flights[key] = _Flight()
+        flight.changed = asyncio.Event()
+        flight.task = asyncio.ensure_future(self._produce(key, flight, start))
+        self.leaders += 1
+        return flight, False
+
+    async def _produce(self, key, flight, start):
+        try:
+            async for chunk in start():
+                flight.chunks.append(chunk)
+                self._notify(flight)
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("The shared agent call was cancelled.")
+            raise
+        except Exception as e:
+            flight.error = e  # Raised in every waiter instead
+        finally:
+            flight.finished = True
+            del self._flights[key]
+            self._notify(flight)
+
+    def _notify(self, flight):
+        changed, flight.changed = flight.changed, asyncio.Event()
+        changed.set()
+
+    def stream(self, key, start, timeout=None):
+        """
+        Returns (chunks, shared): an async iterator of the chunks of the flight
+        for `key`, which is started with start() if there is none. A waiter
+        raises asyncio.TimeoutError after `timeout` seconds.
+        """
+        flight, shared = self._join(key, start)
+        return self._follow(flight, timeout), shared
+
+    async def _follow(self, flight, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        index = 0
+        while True:
+            if index < len(flight.chunks):
+                chunks = flight.chunks[index:]
+                index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                continue
+            if flight.finished:
+                break
+            changed = flight.changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=max(deadline - loop.time(), 0) if deadline else None)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+        if flight.error is not None:
+            raise flight.error
+
+    async def call(self, key, start, timeout=None):
+        """Returns (text, shared) for the flight for `key`."""
+        chunks, shared = self.stream(key, start, timeout)
+        return "".join([chunk async for chunk in chunks]), shared
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "timeouts": self.timeouts,
+            "in_flight": len(self._flights),
+        }
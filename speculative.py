@@ -0,0 +1,114 @@
+# speculative.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+
+
+class SpeculativePrefetcher:
+    """
+    Runs recipe generation jobs in the background before the user asks for them.
+
+    - Jobs run in a bounded thread pool shared by all users.
+    - Each user has at most `per_user_limit` jobs running at once; the rest wait in
+      that user's queue and start as earlier jobs finish.
+    - Scheduling a new batch for a user drops their queued jobs from the previous
+      batch, and results of its still-running jobs are discarded.
+    - Finished results are kept in an LRU/TTL cache under the job key.
+    - A user is forgotten once they have nothing queued or running.
+    """
+
+    def __init__(self, run_job, max_workers=4, per_user_limit=2, cache_size=64, cache_ttl=1800):
+        self._run_job = run_job  # Called as run_job(*args), returns the result
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self._per_user_limit = per_user_limit
+        self._lock = threading.Lock()
+        self._users = {}  # user_key -> {"batch": int, "queue": [(key, args)], "running": int}
+        self._in_flight = {}  # key -> Future
+        self.results = LRUCache(maxsize=cache_size, ttl=cache_ttl, name="speculative_results")
+        self.scheduled = 0
+        self.discarded = 0
+
+    def schedule(self, user_key, jobs):
+        """Replaces the user's previous batch with `jobs`, a list of (key, args) tuples."""
+        with self._lock:
+            user = self._users.setdefault(user_key, {"batch": 0, "queue": [], "running": 0})
+            user["batch"] += 1
+            self.discarded += len(user["queue"])
+            user["queue"] = [
+                (key, args) for key, args in jobs
+                if key not in self._in_flight and self.results.get(key) is None
+            ]
+            self._start_queued(user_key, user)
+            self._drop_if_idle(user_key, user)
+
+    def _drop_if_idle(self, user_key, user):
+        # Caller must hold the lock
+        if not user["queue"] and user["running"] == 0 and self._users.get(user_key) is user:
+            del self._users[user_key]
+
+    def _start_queued(self, user_key, user):
+        # Caller must hold the lock
+        while user["queue"] and user["running"] < self._per_user_limit:
+            key, args = user["queue"].pop(0)
+            user["running"] += 1
+            self.scheduled += 1
+            future = self._executor.submit(self._run, user_key, user["batch"], key, args)
+            self._in_flight[key] = future
+
+    def _run(self, user_key, batch, key, args):
+        try:
+            result = self._run_job(*args)
+            with self._lock:
+                current = self._users[user_key]["batch"] == batch
+                if not current:
+                    self.discarded += 1  # The user has moved on to a new set of options
+            if current:
+                self.results.set(key, result)
+            return result
+        except Exception as e:
+            print(f"--- Speculative job failed for {key[:12]}: {e} ---")
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+                user = self._users[user_key]
+                user["running"] -= 1
+                self._start_queued(user_key, user)
+                self._drop_if_idle(user_key, user)
+
+    def take(self, key, timeout=None):
+        """
+        Returns the result for `key` if it is finished, or waits up to `timeout`
+        seconds for it if it is already running. Returns None otherwise, and
+        removes the key from any queue so the caller can run it inline instead.
+        """
+        result = self.results.get(key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                for user_key, user in list(self._users.items()):
+                    user["queue"] = [job for job in user["queue"] if job[0] != key]
+                    self._drop_if_idle(user_key, user)
+                return None
+
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            return None
+
+    def stats(self):
+        with self._lock:
+            queued = sum(len(user["queue"]) for user in self._users.values())
+            return {
+                "scheduled": self.scheduled,
+                "discarded": self.discarded,
+                "in_flight": len(self._in_flight),
+                "queued": queued,
+                "users": len(self._users),
+                "results": self.results.stats(),
+            }
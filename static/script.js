@@ -9,6 +9,12 @@ document.addEventListener("DOMContentLoaded", () => {
     const mealButtons = document.querySelectorAll(".meal-btn");
     const userInputLabel = document.getElementById("user-input-label");
 
+    // Profile to cook for (multi-user servers): /?user=alice. Null uses the server's default profile.
+    const userId = new URLSearchParams(window.location.search).get("user");
+    // Identifies this tab to the server (whose background recipes a new set of options replaces)
+    const clientId = sessionStorage.getItem("clientId") || Math.random().toString(36).slice(2) + Date.now().toString(36);
+    sessionStorage.setItem("clientId", clientId);
+
     // Get View "Pages" and their content
     const requestView = document.getElementById("request-view");
     const recipeView = document.getElementById("recipe-view");
@@ -63,14 +69,50 @@ document.addEventListener("DOMContentLoaded", () => {
     let currentRecipeOptions = []; // Stores the 4 options from Agent 2
     let currentRecipeHTML = ""; // Stores the raw HTML from Agent 3/5
     let currentRecipeTitle = ""; // Stores the current recipe title
+    let currentRecipe = null; // Parsed recipe from the server: { ingredients, steps, nutrition }
     let currentRecipeForChatbot = ""; // Stores the full text for the chatbot
-    let chatHistory = []; // Chatbot Memory
+    let cookingSessionPromise = null; // Resolves to the server-side session ID (recipe + chat memory)
+    let chatGreetedStep = null; // The step the chatbot last said the user is on
+    let stepExplanations = {}; // Agent 6 explanations by step number, prefetched in one call
+    let stepExplanationsPromise = null;
     
     // --- NEW: Cooking Mode State ---
     let allStepsArray = []; // Will store { step: "1", instruction: "..." }
     let currentStepIndex = 0; // The 0-based index of the allStepsArray
 
-    // --- Event Listener for Toggle Button (Unchanged) ---
+    // --- Agent Traces ---
+    // Responses only carry a trace_id; the agent logs (full prompts and outputs)
+    // are fetched from /api/traces/<id> while the debug panel is open.
+    let pendingTraceIds = [];
+
+    function showAgentTrace(data) {
+        if (data.agent_logs) {
+            data.agent_logs.forEach(addAgentLog);
+        } else if (data.trace_id) {
+            pendingTraceIds.push(data.trace_id);
+            loadPendingTraces();
+        }
+    }
+
+    async function loadPendingTraces() {
+        if (debugSidebar.classList.contains("sidebar-collapsed")) return;
+        const traceIds = pendingTraceIds;
+        pendingTraceIds = [];
+        for (const traceId of traceIds) {
+            try {
+                const response = await fetch(`/api/traces/${traceId}`);
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(data.error || `Server error: ${response.status}`);
+                }
+                data.agent_logs.forEach(addAgentLog);
+            } catch (error) {
+                logToSystem(`Could not load agent logs: ${error.message}`, 'WARN');
+            }
+        }
+    }
+
+    // --- Event Listener for Toggle Button ---
     toggleSidebarBtn.addEventListener("click", () => {
         debugSidebar.classList.toggle("sidebar-collapsed");
         if (debugSidebar.classList.contains("sidebar-collapsed")) {
@@ -79,6 +121,7 @@ document.addEventListener("DOMContentLoaded", () => {
         } else {
             toggleSidebarBtn.innerHTML = "&#x2190;"; // Left Arrow
             toggleSidebarBtn.title = "Close Panel";
+            loadPendingTraces();
         }
     });
 
@@ -164,19 +207,28 @@ document.addEventListener("DOMContentLoaded", () => {
         aiResponse.innerHTML = "Loading... Agent 1 (Strategist) is generating your profile...";
         logToSystem("Calling Agent 1 (Strategist)...");
         try {
-            const response = await fetch("/api/call-gemini", {
+            let response = await fetch("/api/call-gemini", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ mealType: selectedMealType, userInput: userText }),
+                body: JSON.stringify({ mealType: selectedMealType, userInput: userText, user_id: userId, client_id: clientId }),
             });
             logToSystem(`Received response with status: ${response.status}`);
-            const data = await response.json(); 
+            let data = await response.json(); 
+            if (!response.ok && data.briefing_id) {
+                // Agent 2 failed: retry once from Agent 2 with the stored profile
+                logToSystem("Agent 2 failed, retrying with the stored profile...", 'WARN');
+                aiResponse.innerHTML = "Loading... Agent 2 (Chef AI) is trying again...";
+                response = await fetch("/api/call-gemini", {
+                    method: "POST",
+                    headers: { "Content-Type": "application/json" },
+                    body: JSON.stringify({ briefing_id: data.briefing_id, user_id: userId, client_id: clientId }),
+                });
+                data = await response.json();
+            }
             if (!response.ok) {
                 throw new Error(data.error || `Server error: ${response.status}`);
             }
-            if (data.agent_logs) {
-                data.agent_logs.forEach(addAgentLog);
-            }
+            showAgentTrace(data);
             logToSystem("Agent 1 & 2 success. Storing profile and building recipe cards...");
             currentUserProfile = data.user_profile; 
             currentRecipeOptions = data.recipe_options;
@@ -191,7 +243,7 @@ document.addEventListener("DOMContentLoaded", () => {
                 const hash = recipe.title.split("").reduce((acc, char) => char.charCodeAt(0) + ((acc << 5) - acc), 0);
                 const color = (hash & 0x00FFFFFF).toString(16).toUpperCase();
                 img.style.backgroundColor = "#" + "000000".substring(0, 6 - color.length) + color;
-                img.style.backgroundImage = `url(/static/default_food.png)`;
+                img.style.backgroundImage = `url(${document.body.dataset.defaultImage || "/static/default_food.png"})`;
                 img.style.backgroundBlendMode = 'multiply';
                 const content = document.createElement('div');
                 content.className = 'recipe-card-content';
@@ -230,7 +282,7 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     });
 
-    // --- selectRecipe Function (Unchanged) ---
+    // --- selectRecipe Function (MODIFIED: streams the recipe via SSE) ---
     async function selectRecipe(recipe) {
         logToSystem(`User selected recipe: ${recipe.title}. Calling Agent 3...`);
         addAgentLog({ agent: "User Action", input: "Recipe Clicked", output: recipe.title });
@@ -251,58 +303,67 @@ document.addEventListener("DOMContentLoaded", () => {
         
         setupTabs();
 
+        const sectionPanels = {
+            ingredients: ingredientsPanel,
+            instructions: instructionsPanel,
+            nutrition: nutritionPanel
+        };
+        const filledSections = new Set();
+        let streamedLogCount = 0;
+
         try {
-            const response = await fetch("/api/get-recipe-details", {
+            const response = await fetch("/api/get-recipe-details/stream", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
                 body: JSON.stringify({
                     user_profile: currentUserProfile,
-                    selected_dish_name: recipe.title
+                    selected_dish_name: recipe.title,
+                    main_ingredients: recipe.main_ingredients || [],
+                    user_id: userId
                 })
             });
-            
-            const data = await response.json();
+
             if (!response.ok) {
+                const data = await response.json();
                 throw new Error(data.error || `Server error: ${response.status}`);
             }
 
-            if (data.agent_logs) {
-                data.agent_logs.forEach(addAgentLog);
-            }
-
-            logToSystem("Agent 3 success. Rendering full recipe and hero image.");
-            
-            heroImage.src = data.hero_image_url;
-            heroImage.style.display = "block";
-            
-            currentRecipeHTML = data.recipe_html; 
-            currentRecipeTitle = recipe.title;
-            
-            const tempDiv = document.createElement('div');
-            tempDiv.innerHTML = currentRecipeHTML;
-
-            const findTable = (text) => {
-                let table = null;
-                const paras = tempDiv.querySelectorAll('p');
-                paras.forEach(p => {
-                    if (p.textContent.toLowerCase().includes(text.toLowerCase())) {
-                        if (p.nextElementSibling && p.nextElementSibling.tagName === 'TABLE') {
-                            table = p.nextElementSibling;
+            await readEventStream(response, (event, data) => {
+                if (event === "progress") {
+                    // Agent 3 is still writing: show how far along it is
+                    Object.entries(sectionPanels).forEach(([name, panel]) => {
+                        if (!filledSections.has(name)) {
+                            panel.innerHTML = `<p>Loading... ${data.agent} has written ${data.chars} characters.</p>`;
                         }
+                    });
+                } else if (event === "agent_log") {
+                    addAgentLog(data);
+                    streamedLogCount++;
+                    if (data.agent.startsWith("Agent 3")) {
+                        logToSystem("Agent 3 success. Agent 5 (Judge) is reviewing the recipe...");
+                        Object.entries(sectionPanels).forEach(([name, panel]) => {
+                            if (!filledSections.has(name)) {
+                                panel.innerHTML = "<p>Loading... Agent 5 (Judge) is reviewing the recipe.</p>";
+                            }
+                        });
                     }
-                });
-                return table;
-            };
-
-            const ingredientsTable = findTable("Quantified Ingredients");
-            const instructionsTable = findTable("Instructions");
-            const nutritionTable = findTable("Nutrition count");
-
-            ingredientsPanel.innerHTML = ingredientsTable ? ingredientsTable.outerHTML : "<p>No ingredients found.</p>";
-            instructionsPanel.innerHTML = instructionsTable ? instructionsTable.outerHTML : "<p>No instructions found.</p>";
-            nutritionPanel.innerHTML = nutritionTable ? nutritionTable.outerHTML : "<p>No nutrition info found.</p>";
-
-            cookButton.style.display = "block";
+                } else if (event === "section") {
+                    // A table of the judged recipe is complete: show it right away
+                    if (sectionPanels[data.name]) {
+                        sectionPanels[data.name].innerHTML = data.html;
+                        filledSections.add(data.name);
+                    }
+                } else if (event === "done") {
+                    if (data.agent_logs) {
+                        data.agent_logs.slice(streamedLogCount).forEach(addAgentLog);
+                    } else {
+                        showAgentTrace(data);
+                    }
+                    renderRecipeDetails(data, recipe);
+                } else if (event === "error") {
+                    throw new Error(data.error);
+                }
+            });
 
         } catch (error) {
             logToSystem(error.message, 'ERROR');
@@ -310,6 +371,50 @@ document.addEventListener("DOMContentLoaded", () => {
             ingredientsPanel.innerHTML = `<p style="color: red;">Error: ${error.message}</p>`;
         }
     }
+
+    // --- NEW: Reads a Server-Sent Events response body and calls onEvent(event, data) ---
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = "message";
+                let dataText = "";
+                rawEvent.split("\n").forEach(line => {
+                    if (line.startsWith("event:")) event = line.slice(6).trim();
+                    else if (line.startsWith("data:")) dataText += line.slice(5).trim();
+                });
+                if (dataText) onEvent(event, JSON.parse(dataText));
+            }
+        }
+    }
+
+    // --- NEW: Renders the final recipe payload (same shape as /api/get-recipe-details) ---
+    function renderRecipeDetails(data, recipe) {
+        logToSystem("Agent 3 success. Rendering full recipe and hero image.");
+        
+        heroImage.src = data.hero_image_url;
+        heroImage.style.display = "block";
+        
+        currentRecipeHTML = data.recipe_html; 
+        currentRecipeTitle = recipe.title;
+        currentRecipe = data.recipe;
+
+        // The server sends each table already rendered, so nothing is re-parsed here
+        const sections = data.sections || {};
+        ingredientsPanel.innerHTML = sections.ingredients || "<p>No ingredients found.</p>";
+        instructionsPanel.innerHTML = sections.instructions || "<p>No instructions found.</p>";
+        nutritionPanel.innerHTML = sections.nutrition || "<p>No nutrition info found.</p>";
+
+        cookButton.style.display = "block";
+    }
     
     // --- setupTabs Function (Unchanged) ---
     function setupTabs() {
@@ -349,9 +454,8 @@ document.addEventListener("DOMContentLoaded", () => {
         logToSystem("User clicked 'Let's Cook!'");
         addAgentLog({ agent: "User Action", output: "Clicked 'Let's Cook!'" });
         
-        // 1. Parse steps from the instructions panel
-        const instructionsTable = instructionsPanel.querySelector('table');
-        if (!buildCookingSteps(instructionsTable)) {
+        // 1. Take the steps from the parsed recipe
+        if (!buildCookingSteps()) {
             // Abort if parsing failed
             alert("Error: Could not parse cooking steps.");
             return;
@@ -362,45 +466,88 @@ document.addEventListener("DOMContentLoaded", () => {
         cookingModeView.style.display = "block";
         cookModeTitle.textContent = `Cooking: ${currentRecipeTitle}`;
         
-        // 3. Reset chat history
-        chatHistory = [];
+        // 3. Start a cooking session (the server keeps the recipe and chat history)
+        //    and fetch the explanations of all steps in the background
+        startCookingSession();
+        prefetchStepExplanations();
         chatHistoryEl.innerHTML = `
             <div class="chat-message bot">
                 Hi! I'm your cooking assistant. I know the recipe and your current step. Ask me anything!
             </div>`;
+        chatGreetedStep = null;
         
         // 4. Display the first step
         currentStepIndex = 0;
         displayCurrentStep();
     });
 
+    // --- Cooking Session ---
+    // Sends the recipe text to the server once; Agents 6 and 7 then only get the session ID
+    function startCookingSession() {
+        cookingSessionPromise = fetch("/api/cooking-session", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ recipe_context: currentRecipeForChatbot })
+        }).then(async (response) => {
+            const data = await response.json();
+            if (!response.ok) {
+                cookingSessionPromise = null;
+                throw new Error(data.error || "Could not start a cooking session");
+            }
+            return data.session_id;
+        });
+        return cookingSessionPromise;
+    }
+
+    // POSTs to a cooking-mode route with the session ID. If the session has
+    // expired on the server, it is started again and the request retried once.
+    async function postWithSession(url, body) {
+        const send = (sessionId) => fetch(url, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ ...body, session_id: sessionId })
+        });
+        let response = await send(await (cookingSessionPromise || startCookingSession()));
+        if (response.status === 404) {
+            logToSystem("Cooking session expired, starting a new one", 'WARN');
+            if (chatHistoryEl.querySelector(".chat-message.user")) {
+                addChatMessage("(Our earlier conversation has expired, so I don't remember it anymore.)", 'bot');
+            }
+            response = await send(await startCookingSession());
+        }
+        return response;
+    }
+
+    // Explains all steps with one Agent 6 call, so "More Details" opens instantly
+    function prefetchStepExplanations() {
+        stepExplanations = {};
+        const steps = allStepsArray.map(s => ({ step: s.step, instruction: s.instruction }));
+        stepExplanationsPromise = postWithSession("/api/explain-steps", { steps })
+            .then(async (response) => {
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(data.error || "Unknown error from Agent 6");
+                }
+                stepExplanations = data.explanations || {};
+                logToSystem(`Prefetched explanations for ${Object.keys(stepExplanations).length} steps`);
+            })
+            .catch(error => logToSystem(`Could not prefetch step explanations: ${error.message}`, 'WARN'));
+        return stepExplanationsPromise;
+    }
+
     // --- buildCookingSteps Function (REWRITTEN) ---
-    // Parses steps and stores them in allStepsArray
-    function buildCookingSteps(instructionsTable) {
-        allStepsArray = []; // Clear old steps
-        
+    // Stores the steps of the parsed recipe in allStepsArray
+    function buildCookingSteps() {
         // Get the full recipe text for the chatbot
         const tempDiv = document.createElement('div');
         tempDiv.innerHTML = currentRecipeHTML;
         currentRecipeForChatbot = tempDiv.textContent || tempDiv.innerText;
 
-        if (instructionsTable) {
-            const rows = instructionsTable.querySelectorAll('tbody tr');
-            rows.forEach((row, index) => {
-                const cells = row.querySelectorAll('td');
-                if (cells.length >= 2) {
-                    const stepNumber = cells[0].textContent.trim();
-                    const instructionText = cells[1].textContent.trim();
-                    allStepsArray.push({
-                        step: stepNumber,
-                        instruction: instructionText
-                    });
-                }
-            });
-            return true; // Success
-        } else {
-            return false; // Failure
-        }
+        const steps = (currentRecipe && currentRecipe.steps) || [];
+        allStepsArray = steps
+            .filter(s => s.instruction)
+            .map(s => ({ step: s.step, instruction: s.instruction }));
+        return allStepsArray.length > 0;
     }
     
     // --- NEW: Function to show the current step in the UI ---
@@ -462,19 +609,22 @@ document.addEventListener("DOMContentLoaded", () => {
         modalBackdrop.style.display = "flex";
         
         try {
-            const response = await fetch("/api/explain-step", {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({
-                    instruction_text: instructionText,
-                    recipe_context: currentRecipeForChatbot 
-                })
-            });
-            const data = await response.json();
-            if (!response.ok) {
-                throw new Error(data.error || "Unknown error from Agent 6");
+            // Use the prefetched explanation if there is one; otherwise ask for this step alone
+            if (stepExplanationsPromise) {
+                await stepExplanationsPromise;
+            }
+            let explanation = stepExplanations[stepNumber];
+            if (!explanation) {
+                const response = await postWithSession("/api/explain-step", {
+                    instruction_text: instructionText
+                });
+                const data = await response.json();
+                if (!response.ok) {
+                    throw new Error(data.error || "Unknown error from Agent 6");
+                }
+                explanation = data.explanation;
             }
-            modalBody.innerHTML = data.explanation.replace(/\n/g, '<br>');
+            modalBody.innerHTML = explanation.replace(/\n/g, '<br>');
         } catch (error) {
             logToSystem(error.message, 'ERROR');
             modalBody.innerHTML = `<p style="color: red;">Error: ${error.message}</p>`;
@@ -495,12 +645,12 @@ document.addEventListener("DOMContentLoaded", () => {
     // Triggered by "Ask Chatbot" button
     coachAskChatbotBtn.addEventListener('click', () => {
         chatbotModalBackdrop.style.display = "flex";
-        // Reset chat history with a new greeting
-        chatHistory = [];
-        chatHistoryEl.innerHTML = `
-            <div class="chat-message bot">
-                Hi! I'm here to help. I see you're on **Step ${currentActiveStep}**. What's your question?
-            </div>`;
+        // The transcript stays, like the conversation the cooking session remembers;
+        // the bot only mentions the step again when it has changed
+        if (chatGreetedStep !== currentActiveStep) {
+            addChatMessage(`I see you're on Step ${currentActiveStep}. What's your question?`, 'bot');
+            chatGreetedStep = currentActiveStep;
+        }
     });
     
     // Close button for chatbot modal
@@ -515,18 +665,12 @@ document.addEventListener("DOMContentLoaded", () => {
         if (!question) return;
 
         addChatMessage(question, 'user');
-        chatHistory.push({ "role": "user", "content": question });
         chatInput.value = "";
         
         try {
-            const response = await fetch("/api/ask-chatbot", {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({
-                    recipe_context: currentRecipeForChatbot,
-                    current_step: currentActiveStep,
-                    chat_history: chatHistory
-                })
+            const response = await postWithSession("/api/ask-chatbot", {
+                current_step: currentActiveStep,
+                message: question
             });
             
             const data = await response.json();
@@ -535,7 +679,6 @@ document.addEventListener("DOMContentLoaded", () => {
             }
 
             addChatMessage(data.answer, 'bot');
-            chatHistory.push({ "role": "model", "content": data.answer });
 
         } catch (error) {
             logToSystem(error.message, 'ERROR');
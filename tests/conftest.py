@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the repo root; the app runs offline on the fake model backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MODEL_BACKEND", "fake")
+os.environ.setdefault("REQUEST_LOG_PATH", "")
@@ -0,0 +1,29 @@
+import app as core
+from cooking_sessions import CookingSession
+
+
+def chat(session, exchanges):
+    for _ in range(exchanges):
+        session.add_exchange("What should I do now?", "Keep going, you're doing great. Stir now and then.")
+
+
+def test_an_early_fact_still_reaches_the_prompt_after_many_turns():
+    session = CookingSession("s", "recipe", max_turns=4, summary_chars=600)
+    session.add_exchange("How hot should the oven be?",
+                         "Preheat it while you chop. Set it to 220°C so the crust gets crisp.")
+    chat(session, 60)
+
+    summary, turns = session.history("And now?")
+    assert "220°C" in summary
+    assert len(summary) <= 600
+    prompt = core.build_agent_7_prompt(session.recipe_context, 3, turns, summary)
+    assert "Set it to 220°C so the crust gets crisp." in prompt
+
+
+def test_the_summary_keeps_the_latest_turns_as_lines():
+    session = CookingSession("s", "recipe", max_turns=2)
+    session.add_exchange("How much salt?", "A pinch. Then add 2 tsp of soy sauce.")
+    chat(session, 1)
+    summary, turns = session.history()
+    assert summary.splitlines() == ["User: How much salt?", "Bot: A pinch. Then add 2 tsp of soy sauce."]
+    assert [turn["role"] for turn in turns] == ["user", "model"]
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app as core
+import asgi
+import pipeline
+from pipeline import NEXT_CHUNK, AgentCall, Blocking
+
+
+def echo_steps():
+    text = yield AgentCall("agent_6", "explain")
+    chunk = yield AgentCall("agent_3", "recipe", stream=True)
+    while chunk is not None:
+        yield chunk.upper()
+        chunk = yield NEXT_CHUNK
+    try:
+        yield AgentCall("agent_7", "fails")
+    except ValueError as e:
+        error = str(e)
+    doubled = yield Blocking(lambda value: value * 2, 21)
+    return text, error, doubled
+
+
+def call(agent, prompt):
+    if prompt == "fails":
+        raise ValueError("bad answer")
+    return f"{agent}: {prompt}"
+
+
+def stream(agent, prompt):
+    yield from ["a", "b"]
+
+
+async def acall(agent, prompt):
+    return call(agent, prompt)
+
+
+async def astream(agent, prompt):
+    for chunk in stream(agent, prompt):
+        yield chunk
+
+
+async def blocking(func, *args):
+    return func(*args)
+
+
+def test_blocking_and_async_drivers_run_the_same_steps():
+    expected = ("agent_6: explain", "bad answer", 42)
+    assert pipeline.run(echo_steps(), call, stream) == expected
+    assert asyncio.run(pipeline.arun(echo_steps(), acall, astream, blocking)) == expected
+    assert list(pipeline.events(echo_steps(), call, stream)) == ["A", "B"]
+
+
+def post_flask(path, data):
+    response = core.app.test_client().post(path, json=data)
+    return response.status_code, response.get_data(as_text=True)
+
+
+def post_asgi(path, data):
+    async def post():
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post(path, json=data)
+            return response.status_code, response.text
+    return asyncio.run(post())
+
+
+@pytest.mark.parametrize("post", [post_flask, post_asgi], ids=["flask", "asgi"])
+def test_both_servers_serve_the_agent_routes(post):
+    status, body = post("/api/call-gemini", {"mealType": "Dinner", "userInput": "something quick"})
+    assert status == 200
+    options = json.loads(body)
+    dish = options["recipe_options"][0]["title"]
+
+    recipe_request = {"user_profile": options["user_profile"], "selected_dish_name": dish}
+    status, body = post("/api/get-recipe-details", recipe_request)
+    assert status == 200
+    recipe = json.loads(body)
+    assert recipe["recipe"]["steps"]
+
+    status, body = post("/api/get-recipe-details/stream", recipe_request)
+    assert status == 200
+    assert "event: done" in body and "event: error" not in body
+
+    status, body = post("/api/cooking-session", {"recipe_context": recipe["recipe_html"]})
+    session_id = json.loads(body)["session_id"]
+    steps = recipe["recipe"]["steps"]
+    assert all(isinstance(step["instruction"], str) for step in steps)
+    status, body = post("/api/explain-steps", {"session_id": session_id, "steps": steps})
+    assert status == 200
+    assert set(json.loads(body)["explanations"]) == {str(step["step"]) for step in steps}
+    status, body = post("/api/ask-chatbot", {"session_id": session_id, "current_step": 1, "message": "Why?"})
+    assert status == 200 and json.loads(body)["answer"]
+
+    assert post("/api/call-gemini", {})[0] == 400
+    assert post("/api/explain-step", {"session_id": "gone", "instruction_text": "Stir"})[0] == 404
@@ -0,0 +1,55 @@
+import types
+
+import app as core
+from local_briefing import synthesize_briefing
+from model_backend import FakeBackend
+from recipe_index import RecipeIndex, request_constraints
+
+DISH = "Honey-Garlic Chicken Stir-Fry"
+
+
+def snapshot_with_rules(snapshot, extra_rules):
+    rows = dict(snapshot.rows, ruleset=list(snapshot.rows["ruleset"]) + extra_rules)
+    return types.SimpleNamespace(rows=rows, texts=snapshot.texts)
+
+
+def indexed(user_profile, snapshot):
+    index = RecipeIndex(threshold=0.5)
+    recipe = FakeBackend().respond("agent_3", core.build_agent_3_prompt(user_profile, DISH, snapshot))
+    index.add(DISH, ["chicken", "garlic"], recipe, user_profile)
+    return index
+
+
+def test_a_briefing_with_another_exclusion_misses_the_index():
+    snapshot = core.data_store.snapshot()
+    briefing = synthesize_briefing(snapshot, "Dinner", "")
+    no_garlic = synthesize_briefing(snapshot, "Dinner", "no garlic")
+    index = indexed(briefing, snapshot)
+
+    title = "Garlic Honey Chicken Stir Fry"
+    assert index.find(title, ["chicken", "garlic"], request_constraints(snapshot, no_garlic)) is None
+    assert index.find(title, ["chicken", "garlic"], request_constraints(snapshot, briefing)) is not None
+
+
+def test_a_stricter_recipe_serves_a_looser_briefing():
+    snapshot = core.data_store.snapshot()
+    index = indexed(synthesize_briefing(snapshot, "Dinner", "no mushrooms"), snapshot)
+    briefing = synthesize_briefing(snapshot, "Dinner", "")
+    assert index.find(DISH, ["chicken", "garlic"], request_constraints(snapshot, briefing)) is not None
+
+
+def test_nothing_is_served_while_a_hard_rule_is_not_understood():
+    snapshot = core.data_store.snapshot()
+    briefing = synthesize_briefing(snapshot, "Dinner", "")
+    index = indexed(briefing, snapshot)
+    sesame = snapshot_with_rules(snapshot, [{
+        "rule_id": "R009", "rule_type": "health", "category": "allergy", "description": "allergic to sesame",
+        "enforcement": "hard", "priority_weight": "1.0", "active": "true", "last_updated": "2025-10-06",
+    }])
+    assert index.find(DISH, ["chicken", "garlic"], request_constraints(sesame, briefing)) is None
+
+
+def test_a_briefing_without_hard_constraints_is_not_served():
+    snapshot = core.data_store.snapshot()
+    index = indexed(synthesize_briefing(snapshot, "Dinner", ""), snapshot)
+    assert index.find(DISH, ["chicken", "garlic"], request_constraints(snapshot, "Just cook something.")) is None
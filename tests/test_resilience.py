@@ -0,0 +1,213 @@
+import asyncio
+import time
+
+import pytest
+
+import metrics
+from model_backend import FakeBackend, TransientBackendError
+from resilience import AgentCaller, AgentTimeout, CircuitBreaker, CircuitOpenError, RetryBudget, start_budget
+
+
+class FlakyBackend(FakeBackend):
+    """Fails the first `failures` calls, then answers like FakeBackend."""
+
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.calls = 0
+
+    def generate(self, agent, prompt, timeout=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise TransientBackendError("unavailable")
+        return super().generate(agent, prompt, timeout)
+
+
+def make_caller(backend, **kwargs):
+    """An AgentCaller without backoff, and with a full retry budget unless one is given."""
+    kwargs.setdefault("backoff_base", 0)
+    if "retry_budget" not in kwargs:
+        kwargs["retry_budget"] = RetryBudget(min_per_second=0)
+        kwargs["retry_budget"]._tokens = kwargs["retry_budget"].max_tokens
+    return AgentCaller(lambda: backend, **kwargs)
+
+
+def open_breaker(caller):
+    caller.breaker.record_failure()
+    assert caller.breaker.state == CircuitBreaker.OPEN
+
+
+def test_retries_transient_errors():
+    backend = FlakyBackend(failures=2)
+    before = metrics.AGENT_RETRIES.value(agent="agent_7")
+    assert make_caller(backend, max_attempts=3).call("agent_7", "How hot should the pan be?")
+    assert backend.calls == 3
+    assert metrics.AGENT_RETRIES.value(agent="agent_7") == before + 2
+
+
+def test_gives_up_after_max_attempts():
+    backend = FlakyBackend(failures=5)
+    with pytest.raises(TransientBackendError):
+        make_caller(backend, max_attempts=2).call("agent_7", "p")
+    assert backend.calls == 2
+
+
+def test_retry_budget_caps_retries():
+    backend = FlakyBackend(failures=1)
+    caller = make_caller(backend, retry_budget=RetryBudget(ratio=0, min_per_second=0))
+    with pytest.raises(TransientBackendError):
+        caller.call("agent_7", "p")
+    assert backend.calls == 1
+    assert caller.retry_budget.exhausted == 1
+
+
+def test_timeout_raises_agent_timeout():
+    caller = make_caller(FakeBackend(latency=1.0), timeout=0.05)
+    started = time.monotonic()
+    with pytest.raises(AgentTimeout):
+        caller.call("agent_7", "p")
+    assert time.monotonic() - started < 0.5
+
+
+def test_request_budget_cuts_the_deadline():
+    caller = make_caller(FakeBackend(latency=1.0), timeout=30)
+    start_budget(0.05)
+    try:
+        with pytest.raises(AgentTimeout):
+            caller.call("agent_7", "p")
+    finally:
+        start_budget(None)
+
+
+def test_backend_call_stops_at_the_deadline():
+    class Watched(FakeBackend):
+        timeouts = []
+        finished = []
+
+        def generate(self, agent, prompt, timeout=None):
+            Watched.timeouts.append(timeout)
+            try:
+                return super().generate(agent, prompt, timeout)
+            finally:
+                Watched.finished.append(time.monotonic())
+
+    caller = make_caller(Watched(latency=5.0), timeout=0.1)
+    started = time.monotonic()
+    with pytest.raises(AgentTimeout):
+        caller.call("agent_7", "p")
+    assert 0 < Watched.timeouts[0] <= 0.1
+    caller._pool.shutdown(wait=True)  # The model call has already given up: nothing left running
+    assert Watched.finished and Watched.finished[0] - started < 1.0
+
+
+def test_stream_past_the_deadline_raises_agent_timeout():
+    caller = make_caller(FakeBackend(latency=5.0), timeout=0.1)
+    started = time.monotonic()
+    with pytest.raises(AgentTimeout):
+        "".join(caller.stream("agent_7", "p"))
+    caller._pool.shutdown(wait=True)
+    assert time.monotonic() - started < 1.0
+
+
+def test_async_call_passes_the_deadline_down():
+    caller = make_caller(FakeBackend(latency=5.0), timeout=0.1)
+    with pytest.raises(AgentTimeout):
+        asyncio.run(caller.acall("agent_7", "p"))
+
+
+def test_hedge_beats_a_slow_call():
+    class SlowFirst(FakeBackend):
+        calls = 0
+
+        def generate(self, agent, prompt, timeout=None):
+            SlowFirst.calls += 1
+            if SlowFirst.calls == 1:
+                time.sleep(1.0)
+            return "fast"
+
+    caller = make_caller(SlowFirst(), hedge=True, hedge_min_seconds=0.05)
+    for _ in range(20):
+        caller.latency.observe("agent_7", 0.01)
+    started = time.monotonic()
+    assert caller.call("agent_7", "p") == "fast"
+    assert time.monotonic() - started < 0.5
+
+
+def test_breaker_opens_half_opens_and_closes():
+    backend = FakeBackend(error_rate=1.0)
+    caller = make_caller(backend, max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+    for _ in range(2):
+        with pytest.raises(TransientBackendError):
+            caller.call("agent_7", "p")
+    assert caller.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        caller.call("agent_7", "p")
+
+    time.sleep(0.06)
+    backend.error_rate = 0.0
+    assert caller.call("agent_7", "p")  # The half-open trial
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_trial_reopens_the_breaker():
+    caller = make_caller(FakeBackend(error_rate=1.0), max_attempts=1,
+                         breaker=CircuitBreaker(failure_threshold=1, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+    with pytest.raises(TransientBackendError):
+        caller.call("agent_7", "p")
+    assert caller.breaker.state == CircuitBreaker.OPEN
+
+
+def test_only_one_trial_at_a_time():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    assert breaker.allow() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_closed_stream_ends_the_trial():
+    caller = make_caller(FakeBackend(chunk_size=10), breaker=CircuitBreaker(failure_threshold=1, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+    chunks = caller.stream("agent_7", "p")
+    next(chunks)
+    chunks.close()  # e.g. the client disconnected
+    assert caller.call("agent_7", "p")
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_trial_releases_the_breaker():
+    caller = make_caller(FakeBackend(latency=1.0), breaker=CircuitBreaker(failure_threshold=1, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+
+    async def main():
+        task = asyncio.ensure_future(caller.acall("agent_7", "p"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert caller.breaker.state == CircuitBreaker.HALF_OPEN
+        caller.breaker.allow()  # A new trial is allowed
+
+    asyncio.run(main())
+
+
+def test_cancelled_async_stream_releases_the_breaker():
+    caller = make_caller(FakeBackend(latency=1.0), breaker=CircuitBreaker(failure_threshold=1, reset_seconds=0.05))
+    open_breaker(caller)
+    time.sleep(0.06)
+
+    async def main():
+        async def read():
+            return [chunk async for chunk in caller.astream("agent_7", "p")]
+        task = asyncio.ensure_future(read())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        caller.breaker.allow()
+
+    asyncio.run(main())
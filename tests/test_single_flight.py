@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def slow_stream(calls, parts=5, delay=0.02):
+    def start():
+        calls.append(1)
+        for i in range(parts):
+            time.sleep(delay)
+            yield f"part{i} "
+    return start
+
+
+def test_waiters_share_one_call():
+    flights = SingleFlight()
+    calls = []
+    results = []
+
+    def call():
+        results.append(flights.call("k", lambda: "".join(slow_stream(calls)()))[0])
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ["part0 part1 part2 part3 part4 "] * 4
+
+
+def test_waiter_gets_the_full_text_when_the_streaming_leader_goes_away():
+    flights = SingleFlight()
+    calls = []
+    chunks, shared = flights.stream("k", slow_stream(calls))
+    assert not shared
+    assert next(chunks) == "part0 "
+
+    result = {}
+    waiter = threading.Thread(target=lambda: result.update(text=flights.call("k", lambda: "second call")))
+    waiter.start()
+    time.sleep(0.05)
+    chunks.close()  # The first caller's client disconnected
+    waiter.join(timeout=2)
+
+    assert result["text"] == ("part0 part1 part2 part3 part4 ", True)
+    assert len(calls) == 1
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_last_reader_leaving_closes_the_stream():
+    flights = SingleFlight()
+    closed = []
+
+    def start():
+        try:
+            while True:
+                yield "chunk"
+        finally:
+            closed.append(True)
+
+    chunks, _ = flights.stream("k", start)
+    next(chunks)
+    chunks.close()
+    assert closed == [True]
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_errors_reach_every_reader():
+    flights = SingleFlight()
+
+    def start():
+        yield "a"
+        time.sleep(0.05)
+        raise ValueError("bad chunk")
+
+    chunks, _ = flights.stream("k", start)
+    assert next(chunks) == "a"
+    errors = []
+
+    def call():
+        try:
+            flights.call("k", lambda: "unused")
+        except ValueError as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    with pytest.raises(ValueError):
+        list(chunks)
+    waiter.join(timeout=2)
+    assert len(errors) == 1
@@ -0,0 +1,34 @@
+import threading
+import time
+
+import app as core
+from speculative import SpeculativePrefetcher
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_idle_users_are_forgotten():
+    release = threading.Event()
+    prefetcher = SpeculativePrefetcher(lambda name: release.wait(2) and name.upper(), per_user_limit=1)
+    prefetcher.schedule("user:alice", [("a", ("a",)), ("b", ("b",))])
+    assert prefetcher.stats()["users"] == 1
+
+    release.set()
+    assert wait_until(lambda: prefetcher.stats()["users"] == 0)
+    assert prefetcher.take("a") == "A" and prefetcher.take("b") == "B"
+
+    prefetcher.schedule("user:bob", [("a", ("a",))])  # Already generated: nothing to run
+    assert prefetcher.stats()["users"] == 0
+
+
+def test_batches_are_per_user_not_per_address():
+    assert core.speculative_user_key({"user_id": "alice"}, "10.0.0.1") == "user:alice"
+    assert core.speculative_user_key({"client_id": "tab-1"}, "10.0.0.1") == "client:tab-1"
+    assert core.speculative_user_key({}, "10.0.0.1") == "addr:10.0.0.1"
+    assert core.speculative_user_key({"client_id": "tab-1"}, "10.0.0.1") != \
+        core.speculative_user_key({"client_id": "tab-2"}, "10.0.0.1")
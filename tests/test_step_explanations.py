@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+import app as core
+
+EXPLANATIONS = [{"step": 1, "explanation": "Heat the pan first."}, {"step": "2", "explanation": "Stir gently."}]
+
+
+def test_parses_the_array():
+    assert core.parse_step_explanations(json.dumps(EXPLANATIONS)) == {"1": "Heat the pan first.", "2": "Stir gently."}
+
+
+def test_unwraps_an_array_inside_an_object():
+    wrapped = "```json\n" + json.dumps({"explanations": EXPLANATIONS}) + "\n```"
+    assert core.parse_step_explanations(wrapped) == {"1": "Heat the pan first.", "2": "Stir gently."}
+
+
+def test_an_object_without_an_array_is_invalid():
+    with pytest.raises(ValueError):
+        core.parse_step_explanations(json.dumps({"step": 1, "explanation": "Heat the pan first."}))
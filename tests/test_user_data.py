@@ -0,0 +1,41 @@
+import pytest
+
+import app as core
+from profile_store import ProfileStore
+
+HEADER = "rule_id,rule_type,category,description,enforcement,priority_weight,active,last_updated\n"
+RULESET = HEADER + "R001,dietary,diet,no_pork,hard,1.0,true,2025-10-06\n"
+URL = "/api/users/alice/data/ruleset.csv"
+ADMIN = {"Authorization": "Bearer s3cret"}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    store = ProfileStore(str(tmp_path / "profiles.db"))
+    store.import_csv("alice", "ruleset", RULESET)
+    monkeypatch.setattr(core, "profile_store", store)
+    monkeypatch.setattr(core, "PROFILE_ADMIN_TOKEN", "s3cret")
+    return core.app.test_client()
+
+
+def test_writing_another_users_data_is_rejected(client):
+    assert client.put(URL, data=HEADER).status_code == 403
+    assert client.put(URL, data=HEADER, headers={"Authorization": "Bearer guess"}).status_code == 403
+    assert "no_pork" in client.get(URL, headers=ADMIN).get_data(as_text=True)
+
+
+def test_reading_another_users_data_is_rejected(client):
+    assert client.get(URL).status_code == 403
+    assert client.get(URL, headers={"Authorization": "Bearer guess"}).status_code == 403
+
+
+def test_admin_can_replace_a_users_data(client):
+    response = client.put(URL, data=RULESET.replace("no_pork", "no_beef"), headers=ADMIN)
+    assert response.status_code == 200 and response.json["rows"] == 1
+    assert "no_beef" in client.get(URL, headers=ADMIN).get_data(as_text=True)
+
+
+def test_data_files_are_disabled_without_a_token(client, monkeypatch):
+    monkeypatch.setattr(core, "PROFILE_ADMIN_TOKEN", "")
+    assert client.put(URL, data=RULESET, headers={"Authorization": "Bearer "}).status_code == 403
+    assert client.get(URL, headers={"Authorization": "Bearer "}).status_code == 403
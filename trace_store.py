@@ -0,0 +1,73 @@
+# trace_store.py
+#
+# Server-side store for agent traces (the exact prompts and raw outputs that
+# used to be embedded in every response as "agent_logs"). Each request's logs
+# are kept zlib-compressed under a trace ID and fetched on demand from
+# /api/traces/<id>. Retention is bounded by total compressed size, entry count
+# and age; the oldest traces are dropped first.
+
+import json
+import secrets
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+class TraceStore:
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_traces=10000, ttl=3600, name="trace_store"):
+        self.max_bytes = max_bytes
+        self.max_traces = max_traces
+        self.ttl = ttl  # Seconds, or None for no expiry
+        self.name = name
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # trace_id -> (stored_at, compressed bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self):
+        # Caller must hold the lock
+        now = time.time()
+        while self._data:
+            trace_id, (stored_at, blob) = next(iter(self._data.items()))
+            expired = self.ttl is not None and now - stored_at > self.ttl
+            if not expired and self.bytes <= self.max_bytes and len(self._data) <= self.max_traces:
+                break
+            del self._data[trace_id]
+            self.bytes -= len(blob)
+            self.evictions += 1
+
+    def save(self, agent_logs):
+        """Stores a request's agent logs and returns the new trace ID."""
+        trace_id = secrets.token_urlsafe(12)
+        blob = zlib.compress(json.dumps(agent_logs).encode("utf-8"))
+        with self._lock:
+            self._data[trace_id] = (time.time(), blob)
+            self.bytes += len(blob)
+            self._evict()
+        return trace_id
+
+    def get(self, trace_id):
+        """Returns the agent logs of a trace, or None if it is unknown or has been evicted."""
+        with self._lock:
+            self._evict()
+            entry = self._data.get(trace_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(entry[1]).decode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._data),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": 0,
+                "evictions": self.evictions,
+            }